@@ -7,7 +7,10 @@ __email__ = "yasini@usc.edu"
 import sys
 import os
 import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import LinearOperator
 import warnings
+import threading
 import pdb
 
 from cosmoboost import COSMOBOOST_DIR
@@ -18,6 +21,13 @@ from .lib import FrequencyFunctions as ff
 from .lib import MatrixHandler as mh
 from .lib import KernelODE
 from .lib import KernelRecursive as kr
+from .lib import KernelCache as kc
+from .lib import Chebyshev as cheb
+from .lib import PixelBoost as pb
+from .lib import Rotation as rot
+from .lib import Generator as gen
+from .lib.KernelCache import KernelCache, set_default_cache
+from .lib.FrequencyFunctions import register_frequency_function
 
 import logging
 
@@ -38,14 +48,18 @@ DEFAULT_PARS = {
     'frequency_function'  : "CMB",
     'method'              : 'ODE'  # set to 'ODE' to use scipy.odeint solver
                                          # set to 'Bessel' to use Bessel function approx.
+                                         # set to 'expm' to use the per-m matrix exponential
     }
 
-# TODO: add custom frequency function
-FREQ_DICT = {
-    "CMB": ff.F_nu,
-    "kSZ": ff.F_kSZ,
-    "tSZ": ff.F_tSZ,
-    }
+# memory budget [bytes] of the temporary arrays in boost_alm_batch (sets the chunk size)
+BATCH_MAX_BYTES = 2**28
+
+# frequency functions with their derivatives
+# add custom frequency functions with cb.register_frequency_function(name, func, derivative)
+FREQ_DICT = ff.FREQ_FUNCTIONS
+
+# symmetry of the boost kernels under the transpose (see BoostPlan and mh.half2band)
+HALF_BAND_SIGNS = {'T': 1, 'EE': 1, 'EB': -1}
 
 
 ##################################################
@@ -62,6 +76,10 @@ class Kernel(object):
     pars = cb.DEFAULT_PARS
     kernel = cb.Kernel(pars)
 
+    # or build the d=1 kernel on 8 processes
+
+    kernel = cb.Kernel(pars, n_workers=8)
+
     # and call the kernel coefficients simply as
 
     kernel.mLl
@@ -70,12 +88,51 @@ class Kernel(object):
 
     kernel.nu_mLl(nu)
 
+    # store and apply the kernel in single precision (float32/complex64)
+
+    kernel = cb.Kernel(pars, dtype=np.float32)
+
+    The d=1 kernel is always solved in double precision and then rounded to dtype. The
+    single precision kernel elements have a relative error of ~6e-8 (float32 epsilon), far
+    below the accuracy of the ODE solver (rtol=1e-3). The boosted alm of a float32 kernel
+    differ from the float64 ones by ~1e-7 (relative); use boost_alm(..., accumulate=np.float64)
+    to accumulate the sums in double precision.
+
+    # store only the kernel elements larger than band_tol (ragged band)
+
+    kernel = cb.Kernel(pars, band_tol=1e-10)
+
+    The half-width of the band w(ell') <= delta_ell is chosen for each ell' from the d=1
+    kernel, and all the kernels (D1, +d2, ...) are stored with 2w(ell')+1 elements per row
+    (see MatrixHandler.band2ragged). The stored kernels are kept as memory maps
+    (mh.RaggedRows) and unpacked to the usual layout (with zeros outside the band) one block
+    of rows at a time by the lifts, the BPTMs and the boost plans, which keep only the
+    elements inside the band. kernel.mLl and the K_d arrays of nu_mLl hold the full band.
+
+    # store and apply only the ell <= ell' half of the d=1 band
+
+    kernel = cb.Kernel(pars, half_band=True)
+
+    The d=1 kernel satisfies K^m_{ell ell'} = (-1)^(ell+ell') K^m_{ell' ell} (up to the
+    truncation of the band), so the D1 kernel is stored with delta_ell+1 columns and kept as
+    a memory map of the half band (mh.HalfBandRows). The other half is rebuilt from the
+    transpose one block of rows at a time by the lifts and the BPTMs, and the boost plans of
+    d=1 kernels only keep the lower half (see BoostPlan). kernel.mLl builds the full band of
+    D1 on each call, and the lifts to the other Doppler weights (e.g. at frequency nu) hold
+    the full band.
+
     """
 
     def __init__(self,
                  pars=DEFAULT_PARS,
                  overwrite=False,
-                 save_kernel=True):
+                 save_kernel=True,
+                 n_workers=1,
+                 cache=None,
+                 solver_kwargs=None,
+                 dtype=np.float64,
+                 band_tol=None,
+                 half_band=False):
 
         self.d = pars['d']
         self.s = pars['s']
@@ -87,7 +144,18 @@ class Kernel(object):
         self.normalize = pars['normalize']
         self.overwrite = overwrite
         self.save_kernel = save_kernel
-        self.freq_func = FREQ_DICT[pars["frequency_function"]]
+        self.n_workers = n_workers  # number of processes for building the d=1 kernel
+        # kernel cache (see KernelCache); the default location is set by $COSMOBOOST_CACHE_DIR
+        self.cache = kc.get_default_cache() if cache is None else cache
+        self._solver_kwargs = {} if solver_kwargs is None else dict(solver_kwargs)
+        self.dtype = np.dtype(dtype)  # dtype of the stored and applied kernel elements
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype should be float32 or float64")
+        self.band_tol = band_tol  # tolerance of the ragged band (None: full band)
+        self._widths = None  # half-widths of the ragged band (see band_widths)
+        self.half_band = bool(half_band)  # store the d=1 kernel as half of the band
+        self.frequency_function = pars["frequency_function"]
+        self.freq_func = FREQ_DICT[self.frequency_function]
         self.method = pars['method']
 
         # set ell limits
@@ -99,7 +167,9 @@ class Kernel(object):
         # TODO: add private safe ell_max parameter
 
         # dictionary for various kernel solvers
-        self.solver = {'Bessel': KernelODE.est_K_T_ODE, 'ODE': KernelODE.solve_K_T_ODE}
+        self.solver = {'Bessel': KernelODE.est_K_T_ODE,
+                       'ODE'   : KernelODE.solve_K_T_ODE,
+                       'expm'  : KernelODE.solve_K_T_expm}
 
         # TODO: move this to a private mathod self._set_delta_ell
         # set delta_ell
@@ -115,8 +185,11 @@ class Kernel(object):
 
         # initialize other attributes
         self.pars = None  # dictionary of parameters
-        self.kernel_filename = None
-        self.matrices_filename = None
+        self.kernel_filename = None  # fits file used by export_fits
+        self.store = None  # memory-mapped kernel store (entry of the kernel cache)
+        self.solver_kwargs = None  # solver tolerances
+        self._plans = {}  # boost plans (see boost_plan)
+        self._plans_lock = threading.Lock()
 
         # update the parameters
         self.update()
@@ -135,72 +208,167 @@ class Kernel(object):
             'beta_expansion_order': self.beta_exp_order,
             'derivative_dnu': self.derivative_dnu,
             'normalize'     : self.normalize,
-            'method'        : self.method
+            'method'        : self.method,
+            'frequency_function': self.frequency_function,
+            'dtype'         : self.dtype.name,
+            'band_tol'      : self.band_tol,
+            'half_band'     : self.half_band,
             }
 
+        # the solver tolerances are part of the cache key
+        self.solver_kwargs = dict(KernelODE.DEFAULT_TOLERANCES.get(self.method, {}),
+                                  **self._solver_kwargs)
+
         # determine file names based on parameters
-        self.kernel_filename = fh.get_kernel_filename(self.pars)
-        self.matrices_filename = fh.get_matrices_filename(self.pars)
+        self.store = self.cache.store(self.pars, self.solver_kwargs)
+        self._widths = None
+        self.kernel_filename = os.path.join(self.store.dir_name,
+                                            os.path.basename(fh.get_kernel_filename(self.pars)))
 
-        # initialize the matrices and coefficient matrix
-        self._init_matrices()
+        # initialize the kernel coefficients
         self._init_mLl()
+        self._plans = {}
 
         #self.mLl = []
 
+    def copy(self, **pars):
+        """return a new Kernel with the same settings, replacing the parameters given in pars
+        (e.g. kernel.copy(s=2, d=3)). This kernel is not modified."""
+
+        new_pars = dict(self.pars, d=self.d, s=self.s)
+        new_pars.update(pars)
+
+        return Kernel(new_pars,
+                      overwrite=self.overwrite,
+                      save_kernel=self.save_kernel,
+                      n_workers=self.n_workers,
+                      cache=self.cache,
+                      solver_kwargs=self._solver_kwargs,
+                      dtype=self.dtype,
+                      band_tol=self.band_tol,
+                      half_band=self.half_band)
+
+    def spin_pair(self, s=2, d=None):
+        """return the SpinPair of the spins +s and -s with the settings of this kernel
+        (and Doppler weight d, default: self.d)"""
+        return SpinPair(self, s=s, d=d)
+
+    def boost_plan(self, nu=None, polarization=False, inverse=False):
+        """return the BoostPlan of this kernel (at frequency nu [GHz] if provided)
+        if nu is an array, a list with the plans of all the frequencies is returned
+        if inverse is True, the plan removes the boost (see BoostPlan)
+        plans are built once and reused by later calls"""
+
+        if np.ndim(nu) == 1:
+            return self._boost_plans(nu, polarization, inverse)
+        if nu is not None:
+            nu = float(nu)
+
+        with self._plans_lock:
+            # a plan with polarization can also boost temperature
+            for key in ((nu, True, inverse), (nu, polarization, inverse)):
+                if key in self._plans:
+                    return self._plans[key]
+
+            plan = BoostPlan(self, nu=nu, polarization=polarization, inverse=inverse)
+            self._plans[(nu, polarization, inverse)] = plan
+
+        return plan
+
+    def _boost_plans(self, nus, polarization, inverse=False):
+        """return the BoostPlans of the frequencies nus [GHz]
+        the kernel elements of all the missing frequencies are calculated together"""
+
+        nus = [float(nu) for nu in nus]
+
+        with self._plans_lock:
+            missing = [nu for nu in nus if (nu, True, inverse) not in self._plans
+                       and (nu, polarization, inverse) not in self._plans]
+
+        if missing:
+            # intensity is boosted with Doppler weight d=3
+            kernel = self if (self.s, self.d) == (0, 3) else self.copy(s=0, d=3)
+            coefficients = {0: kernel.nu_mLl(np.array(missing))}
+            if polarization:
+                # inverse plans swap the spins (see BoostPlan._spin_pair_coefficients)
+                pair = self.spin_pair(d=3)
+                coefficients[2], coefficients[-2] = pair.nu_mLl(np.array(missing))
+
+            for i, nu in enumerate(missing):
+                plan = BoostPlan(self, nu=nu, polarization=polarization, inverse=inverse,
+                                 coefficients={s: K_nu[i] for s, K_nu in coefficients.items()})
+                with self._plans_lock:
+                    self._plans.setdefault((nu, polarization, inverse), plan)
+
+        return [self.boost_plan(nu, polarization, inverse) for nu in nus]
+
+    def as_sparse(self, component='T', nu=None, inverse=False):
+        """return the boost as a scipy.sparse CSR matrix of shape (n_alm, n_alm), so that
+        boosted_alm = K @ alm (or K @ alms for alms with shape (n_alm, n_sims))
+
+        component: 'T' for temperature, 'EE' and 'EB' for polarization
+        (E' = K_EE @ E + K_EB @ B and B' = K_EE @ B - K_EB @ E)
+        nu [GHz]: if provided the generalized kernel at this frequency is used
+        inverse: if True, the matrix removes the boost
+
+        the matrices are built once and reused by later calls"""
+
+        return self.boost_plan(nu, polarization=(component != 'T'),
+                               inverse=inverse).as_sparse(component)
+
+    def as_linear_operator(self, spin=0, nu=None, inverse=False):
+        """return the boost as a scipy.sparse.linalg.LinearOperator acting on the T alm
+        (spin=0) or on the stacked E and B alm [E, B] (spin=2), with the adjoint (rmatvec)
+        and stacked alm with shape (n_alm, n_sims) (matmat)
+
+        nu [GHz]: if provided the generalized kernel at this frequency is used
+        inverse: if True, the operator removes the boost
+        (see BoostPlan.as_linear_operator)"""
+
+        return self.boost_plan(nu, polarization=(spin != 0),
+                               inverse=inverse).as_linear_operator(spin)
+
     # ------------------------------
     #     Matrix initialization
     # ------------------------------
 
-    def _init_matrices(self):
-        """initialize the kernel matrices"""
-
-        # check to see if the file exists
-        # if it does, load it
-        if fh.file_exists(self.matrices_filename) and self.overwrite is False:
-
-            print("\nMatrices loaded from file:\n{}\n".format(self.matrices_filename))
-            self._load_matrices()
-
-        # otherwise calculate the matrices and save them to file
-        else:
-            print("Calculating the index matrices...\n")
-            self.Mmatrix, self.Lmatrix = mh.get_ML_matrix(self.delta_ell, self.lmax)
-            _, Clms = mh.get_Blm_Clm(delta_ell=self.delta_ell, lmax=self.lmax, s=self.s)
-            self.Cmatrix = Clms[self.Lmatrix, self.Mmatrix]
-            self.Smatrix = mh.get_S_matrix(self.Lmatrix, self.Mmatrix, self.s)
-
-            # save Mmatrix and Lmatrix for future use
-            # matrices_file_name = fh.matrices_filename(pars)
-            dir_name = fh.dirname(lmax=self.lmax, beta=self.beta)
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
-                fh.save_matrices(self.matrices_filename, self.Mmatrix, 'M')
-                fh.save_matrices(self.matrices_filename, self.Lmatrix, 'L')
-                # generating Clm is relatively fast so there's no need to save to file
-
-                print("Matrices saved in file:\n{}\n".format(self.matrices_filename))
-                print("Done!\n")
-
     def _init_mLl(self):
 
         # initialize kernel with d=1
         self._mLl_d1 = self._get_mLl_d1()
+        # kernels of the other Doppler weights are memoized in the ladder
+        self.ladder = kr.KernelLadder(self)
         # initialize (call setter) the mLl coefficients for d=1
         self._mLl = None
-        self._Ll = self._get_Ll()
+        self._Ll = None
+        self._Ll_cache = {}  # BPTMs (see nu_Ll and transfer_matrices)
+
+    # ------------------------------
+    #     index and coefficient matrices
+    # ------------------------------
 
-    def _load_matrices(self):
+    # the index and coefficient matrices are not stored with the kernel
+    # they are generated from the (m, ell') index arithmetic (see mh.get_ML_block)
+    # for one block of rows at a time where they are needed.
+    # the properties below return the full matrices on demand for inspection.
 
-        print("Loading the index matrices...\n")
-        self.Mmatrix = fh.load_matrix(self.matrices_filename, key="M")
-        self.Lmatrix = fh.load_matrix(self.matrices_filename, key="L")
-        # self.Lmatrix = fh.load_matrix(self.matrices_filename,key="L")
+    @property
+    def Mmatrix(self):
+        return mh.get_ML_matrix(self.delta_ell, self.lmax)[0]
 
-        _, Clms = mh.get_Blm_Clm(delta_ell=self.delta_ell, lmax=self.lmax, s=self.s)
-        self.Cmatrix = Clms[self.Lmatrix, self.Mmatrix]
-        self.Smatrix = mh.get_S_matrix(self.Lmatrix, self.Mmatrix, self.s)
-        print("Done!\n")
+    @property
+    def Lmatrix(self):
+        return mh.get_ML_matrix(self.delta_ell, self.lmax)[1]
+
+    @property
+    def Cmatrix(self):
+        Mmatrix, Lmatrix = mh.get_ML_matrix(self.delta_ell, self.lmax)
+        return mh.get_Blm_Clm_matrix(Lmatrix, Mmatrix, self.lmax, self.s)[1]
+
+    @property
+    def Smatrix(self):
+        Mmatrix, Lmatrix = mh.get_ML_matrix(self.delta_ell, self.lmax)
+        return mh.get_S_matrix(Lmatrix, Mmatrix, self.s)
 
     # ------------------------------
     #     m, ell', ell index (mLl)
@@ -211,7 +379,7 @@ class Kernel(object):
         # get values for mLl"
         if self.d == 1:
             # set d=1 values for mLl"
-            return self._mLl_d1
+            return mh.full_band(self._mLl_d1)
         else:
             if self._mLl is None:
                 self._mLl = self._get_mLl()
@@ -232,7 +400,9 @@ class Kernel(object):
     def Ll(self):
 
         # get values for mLl"
-        return self._get_Ll()
+        if self._Ll is None:
+            self._Ll = self._get_Ll()
+        return self._Ll
 
     @Ll.setter  # mLl setter
     def Ll(self, value):
@@ -243,6 +413,11 @@ class Kernel(object):
             # set d>1 values for mLl"
             self._Ll = self._get_Ll()
 
+    def _band_rows(self):
+        """returns the kernel elements of mLl as they are kept: ragged and half band kernels
+        are a mh.BandRows that rebuilds the full band for one block of rows at a time"""
+        return self.ladder.get_K_d(self.d, self.s)
+
     def _get_mLl_d1(self):
         """return the DC aberration kernel elements K^m_{\ell' \ell} for d=1
         if the kernel has been calculated before, it will be loaded
@@ -250,18 +425,147 @@ class Kernel(object):
 
         # load the aberration kernel if it exists,
         # otherwise calculate it by solving the kernel_ODE
-        if fh.file_exists(self.kernel_filename) and self.overwrite is False:
-            print("Kernel loaded from file:\n {}\n".format(self.kernel_filename))
-            K_mLl = fh.load_kernel(self.kernel_filename, key='D1')
-        else:
+        try:
+            solver = self.solver[self.method]
+        except KeyError as e :
+            raise type(e)(f"'{self.method}' is not a valid key. Use one of the following: {self.solver.keys()}")
+
+        def solve():
+            # reuse the rows of a kernel cached for another lmax
+            resized = self._resize_mLl_d1()
+            if resized is not None:
+                return resized
+
             print("Solving kernel ODE for d=1")
-            try:
-                K_mLl = self.solver[self.method](self.pars, save_kernel=self.save_kernel)
-            except KeyError as e :
-                raise type(e)(f"'{self.method}' is not a valid key. Use one of the following: {self.solver.keys()}")
+            return solver(self.pars, save_kernel=False, n_workers=self.n_workers,
+                          **self.solver_kwargs)
 
+        K_mLl = self.cached('D1', solve)
+        print("Kernel D1 in:\n {}\n".format(self.store.dir_name))
+
+        return K_mLl
+
+    def _resize_mLl_d1(self):
+        """return the d=1 kernel built from the rows of a cached kernel with another lmax
+        (see KernelODE.resize_K_T), or None if there is none. The smallest larger lmax is
+        preferred (only the edge rows are calculated), otherwise the largest smaller one is
+        extended."""
+        if self.overwrite:
+            return None
+
+        stores = self.cache.other_lmax(self.pars, 'D1', self.solver_kwargs)
+        if not stores:
+            return None
+
+        larger = [lmax for lmax in stores if lmax > self.lmax]
+        lmax_source = min(larger) if larger else max(stores)
+
+        try:
+            K_source = stores[lmax_source].load('D1')
+            widths = stores[lmax_source].load('widths') if self.band_tol is not None else None
+            K_source = mh.full_band(self._from_storage('D1', K_source, lmax_source, widths))
+        except (KeyError, OSError):  # the entry was evicted by another process
+            return None
+
+        print("Resizing the d=1 kernel of lmax = {}".format(lmax_source))
+        return KernelODE.resize_K_T(self.pars, K_source, lmax_source, **self.solver_kwargs)
+
+    def cached(self, key, compute, stored=False):
+        """return the kernel chosen by 'key' (D1, +d2, -d3, ...) from the kernel cache as a
+        memory map. If it is missing (or overwrite is True), it is calculated with compute()
+        and saved (if save_kernel is True). Concurrent processes calculate each kernel once.
+        The calculated kernel is stored as self.dtype (in the ragged layout if band_tol is
+        set, and as half of the band for D1 if half_band is set). If stored is True, compute()
+        returns the kernel already in that layout."""
+
+        def compute_dtype():
+            K_mLl = np.asarray(compute(), dtype=self.dtype)
+            return K_mLl if stored else self._to_storage(key, K_mLl)
+
+        if self.overwrite:
+            K_mLl = compute_dtype()
+            if self.save_kernel:
+                self.cache.put(self.pars, key, K_mLl, self.solver_kwargs)
+            return self._from_storage(key, K_mLl)
+
+        if not self.save_kernel:
+            K_mLl = self.cache.get(self.pars, key, self.solver_kwargs)
+            return self._from_storage(key, compute_dtype() if K_mLl is None else K_mLl)
+
+        return self._from_storage(key, self.cache.get_or_compute(self.pars, key, compute_dtype,
+                                                                 self.solver_kwargs))
+
+    def lookup(self, key):
+        """return the kernel chosen by 'key' (D1, +d2, -d3, ...) from the kernel cache as a
+        memory map, or None if it is missing (or overwrite is True)"""
+
+        if self.overwrite:
+            return None
+
+        K_mLl = self.cache.get(self.pars, key, self.solver_kwargs)
+        return None if K_mLl is None else self._from_storage(key, K_mLl)
+
+    # ------------------------------
+    #     ragged and half band
+    # ------------------------------
+
+    @property
+    def widths(self):
+        """half-widths w(ell') of the ragged band (None if band_tol is not set)
+        they are chosen from the d=1 kernel and saved in the cache next to it"""
+        if self.band_tol is None:
+            return None
+
+        if self._widths is None and not self.overwrite:
+            widths = self.cache.get(self.pars, 'widths', self.solver_kwargs)
+            if widths is not None:
+                self._widths = np.array(widths)
+
+        return self._widths
+
+    def _set_widths(self, K_mLl):
+        """choose the half-widths of the ragged band from the d=1 kernel"""
+        self._widths = mh.band_widths(K_mLl, self.lmax, self.delta_ell, self.band_tol)
+        if self._widths.max() == self.delta_ell:
+            warnings.warn("the kernel elements at |ell-ell'| = delta_ell are larger than "
+                          "band_tol = {}; increase delta_ell".format(self.band_tol))
+        if self.save_kernel:
+            self.cache.put(self.pars, 'widths', self._widths, self.solver_kwargs)
+
+    def _to_storage(self, key, K_mLl):
+        """convert the kernel chosen by 'key' to the layout it is stored in"""
+        if self.band_tol is not None and self.widths is None:
+            self._set_widths(K_mLl)
+        if self.half_band and key == 'D1':
+            K_mLl = mh.band2half(K_mLl, self.delta_ell)
+        if self.band_tol is not None:
+            K_mLl = mh.band2ragged(K_mLl, self.widths, self.lmax, self.delta_ell)
+        return K_mLl
+
+    def _from_storage(self, key, K_mLl, lmax=None, widths=None):
+        """return the stored kernel chosen by 'key' in the (n_rows, 2*delta_ell+1) layout
+        without reading it: ragged kernels are returned as a mh.RaggedRows and the half band
+        D1 as a mh.HalfBandRows of the stored half
+        lmax and widths are those of the stored kernel (default: the ones of this kernel)"""
+        lmax = self.lmax if lmax is None else lmax
+        half = self.half_band and key == 'D1'
+        if self.band_tol is not None:
+            widths = self.widths if widths is None else widths
+            K_mLl = mh.RaggedRows(K_mLl, widths, lmax, self.delta_ell, half=half)
+        if half:
+            K_mLl = mh.HalfBandRows(K_mLl, lmax, self.delta_ell)
         return K_mLl
 
+    def export_fits(self, kernel_file_name=None):
+        """write all the kernels in the kernel store (D1, +d2, -d3, ...) to a fits file
+        with one HDU per key (default: self.kernel_filename)"""
+
+        if kernel_file_name is None:
+            kernel_file_name = self.kernel_filename
+
+        self.store.export_fits(kernel_file_name)
+        print("Kernel exported to:\n{}\n".format(kernel_file_name))
+
     def _get_mLl(self):
         """return the DC aberration kernel elements K^m_{\ell' \ell} for d!=1
         if the kernel has been calculated before, it will be loaded
@@ -281,7 +585,9 @@ class Kernel(object):
         return _K_d_mLl
 
     def nu_mLl(self, nu):
-        """return the Doppler and aberration kernel elements K^m_{ell' ell} at frequency nu [GHz]"""
+        """return the Doppler and aberration kernel elements K^m_{ell' ell} at frequency nu [GHz]
+        if nu is an array, the kernel elements of all the frequencies are returned with shape
+        (len(nu), (lmax+1)*(lmax+2)/2, 2*delta_ell+1) (the K_d array is built only once)"""
         K_d_arr = kr.calc_K_d_arr(self, self.d, self.s)
 
         if self.pars['normalize'] is True:
@@ -296,57 +602,324 @@ class Kernel(object):
         """calculate the generalized Doppler and aberration kernel elements for the relevant
         Doppler weights at frequency nu [GHz]"""
 
-        # calculate the number of rows and columns required for the Kernel array
-        height, width = ((self.lmax + 1) * (self.lmax + 2) / 2, 2 * self.delta_ell + 1)
-
-        # initialize the Kernel array
         # elements of the first dimension holds terms of the beta expansion
-        K_d_arr = np.zeros((self.beta_exp_order + 1, height, width))
-
-        # calculate the Kernel array
-        for i in range(self.d, self.d - self.beta_exp_order - 1, -1):
-            K_d_arr[kr.d2indx(self.d, i)] = kr.get_K_d(self, i, self.s)
-
-        return K_d_arr
+        return self.ladder.K_d_arr(self.d, self.s)
 
     def _get_Ll(self):
         """returns the Boost Power Transfer Matrix (BPTM) K_{L,l} defined in Yasini &
         Pierpeoli 2017"""
-        K_mLl = self.mLl
-        K_Ll = np.zeros((self.lmax + 1, 2 * self.delta_ell + 1))
+        return self._mLl2Ll(self._band_rows())
+
+    # TODO: add Ll_nu function for boosting Cl in intensity
+    def nu_Ll(self, nu):
+        """returns the Boost Power Transfer Matrix (BPTM) K_{L,l} at frequency nu [GHz] defined in
+        Yasini & Pierpeoli 2017
+        if nu is an array, the BPTM of all the frequencies are returned with shape
+        (len(nu), lmax+1, 2*delta_ell+1)
+
+        the generalized kernel is a weighted sum of the K_d array (see d_arrary), so its BPTM is
+        a quadratic form of the weights with the cross moments of the K_d array (see
+        cross_moments). No kernel elements are calculated for new frequencies."""
+        return self._nu_Ll(self.cross_moments(), nu)
+
+    def cross_moments(self):
+        """returns the cross moments M[k, k', L, :] = sum_m K_{d-k} K_{d-k'} / (2L+1) of the
+        K_d array with shape (beta_exp_order+1, beta_exp_order+1, lmax+1, 2*delta_ell+1)
+        they are calculated once and reused by later calls"""
+        if 'moments' not in self._Ll_cache:
+            self._Ll_cache['moments'] = self._cross_moments(self.d_arrary())
+        return self._Ll_cache['moments']
+
+    def _nu_Ll(self, moments, nu):
+        """contract the cross moments with the K_d array weights at frequency nu"""
+        weights = kr.get_nu_weights(nu, self.pars, freq_func=self.freq_func,
+                                    return_normalize=self.pars['normalize'])
+
+        return np.einsum("...k,...q,kqLj->...Lj", weights, weights, moments)
+
+    def transfer_matrices(self, nu=None):
+        """returns the BPTMs of the temperature and polarization spectra as a dictionary
+
+        'TT': sum_m |K_T|^2       (TT -> TT)
+        'EE': sum_m |K_EE|^2      (EE -> EE and BB -> BB)
+        'EB': sum_m |K_EB|^2      (EE -> BB and BB -> EE leakage)
+        'TE': sum_m K_T K_EE      (TE -> TE)
+
+        where K_T is the s=0 kernel, K_EE = (K_{+2}+K_{-2})/2 and i*K_EB is the EB kernel
+        (see SpinPair.combine)
+        (all with the Doppler weight of this kernel, at frequency nu [GHz] if provided)
+        each matrix has shape (lmax+1, 2*delta_ell+1) (with a leading axis if nu is an array)
+        at frequency nu they are calculated from the cross moments of the K_d arrays
+        """
+
+        kernel_T = self if self.s == 0 else self.copy(s=0)
+
+        if nu is None:
+            if 'pol' not in self._Ll_cache:
+                # the rows of the (half band) kernels are combined one block at a time
+                K_T = kernel_T._band_rows()
+                K_plus, K_minus = self.spin_pair()._band_rows()
+
+                def K_EE(rows):
+                    return SpinPair.combine(K_plus[rows], K_minus[rows])[0]
+
+                def K_EB(rows):  # K_EB times i
+                    return SpinPair.combine(K_plus[rows], K_minus[rows])[1]
+
+                self._Ll_cache['pol'] = {'TT': self._mLl2Ll(K_T),
+                                         'EE': self._mLl2Ll(K_EE),
+                                         'EB': self._mLl2Ll(K_EB),
+                                         'TE': self._mLl2Ll(K_T, K_EE),
+                                         }
+            return self._Ll_cache['pol']
+
+        if 'pol_moments' not in self._Ll_cache:
+            K_T = kernel_T.d_arrary()
+            K_EE, K_EB = SpinPair.combine(*self.spin_pair().d_arrary())  # K_EB times i
+
+            self._Ll_cache['pol_moments'] = {'TT': self._cross_moments(K_T),
+                                             'EE': self._cross_moments(K_EE),
+                                             'EB': self._cross_moments(K_EB),
+                                             'TE': self._cross_moments(K_T, K_EE),
+                                             }
+
+        return {key: self._nu_Ll(moments, nu)
+                for key, moments in self._Ll_cache['pol_moments'].items()}
+
+    def _cross_moments(self, K_d_arr, K2_d_arr=None):
+        """returns sum_m K_d_arr[k] K2_d_arr[q] / (2L+1) for all pairs (k, q) with shape
+        (n_k, n_q, lmax+1, 2*delta_ell+1) in a single pass over the rows (K2_d_arr=K_d_arr by
+        default, in which case only the pairs k <= q are calculated)"""
+        symmetric = K2_d_arr is None
+        if symmetric:
+            K2_d_arr = K_d_arr
+
+        n_k, n_q = len(K_d_arr), len(K2_d_arr)
+        k, q = np.triu_indices(n_k) if symmetric else np.indices((n_k, n_q)).reshape(2, -1)
+
+        width = 2 * self.delta_ell + 1
+        moments = np.zeros((self.lmax + 1, len(k), width))
+
+        # the products of all the pairs are held for one block of rows
+        for rows in mh.row_blocks(self.lmax, max(1, mh.BLOCK_ROWS // len(k))):
+            products = K_d_arr[k, rows, :] * K2_d_arr[q, rows, :]
+            products = np.moveaxis(products, 1, 0).reshape(rows.stop - rows.start, -1)
+            moments += (mh.m_sum_matrix(rows, self.lmax) @ products).reshape(moments.shape)
+
+        cross_moments = np.empty((n_k, n_q, self.lmax + 1, width))
+        cross_moments[k, q] = np.moveaxis(moments, 1, 0)
+        if symmetric:
+            cross_moments[q, k] = cross_moments[k, q]
+
+        return cross_moments
+
+    def _mLl2Ll(self, K_mLl, K2_mLl=None):
+        """average K_mLl*K2_mLl (default K_mLl**2) over m for each ell' (the leading axes of K_mLl
+        are kept). The rows are reduced one block at a time with mh.m_sum_matrix.
+        K_mLl and K2_mLl may also be functions returning the (2D) kernel elements of a block of
+        rows (e.g. a combination of kernels)."""
+        if K2_mLl is None:
+            K2_mLl = K_mLl
+
+        def block(K, rows):
+            return K(rows) if callable(K) else K[..., rows, :]
+
+        leading = () if callable(K_mLl) else np.shape(K_mLl)[:-2]
+        K_Ll = np.zeros((self.lmax + 1,) + leading + (2 * self.delta_ell + 1,))
+
+        for rows in mh.row_blocks(self.lmax):
+            # move the rows to the first axis
+            K2 = np.moveaxis(block(K_mLl, rows) * block(K2_mLl, rows), -2, 0)
+            K_Ll += (mh.m_sum_matrix(rows, self.lmax) @ K2.reshape(len(K2), -1)).reshape(
+                K_Ll.shape)
+
+        return np.moveaxis(K_Ll, 0, -2)
+
 
-        for L in range(self.lmax + 1):
-            # find all the m mode relevant for each ell'
-            M = np.arange(self.lmin, L + 1)
+##################################################
+#           Spin Pair
+##################################################
 
-            # sum over all the m modes for each ell'
-            # m=0 has to be removed because it's counted twice
-            K_Ll[L, :] = 2 * np.sum(K_mLl[mh.mL2indx(M, L, self.lmax), :] ** 2, axis=0) \
-                         - K_mLl[mh.mL2indx(0, L, self.lmax), :] ** 2
+class SpinPair(object):
+    """The kernels of the spins +s and -s (e.g. s=2 for E and B) from a single kernel
 
-            K_Ll[L, :] /= 2 * L + 1
+    The d=1 kernel only depends on s through Blm (s^2), so both spins share one solution
+    and one cache entry. The lift to the other Doppler weights (KernelRecursive) has the spin
+    term S = s m / (ell(ell+1)), which is odd in s (the s -> -s, m -> -m symmetry of the
+    kernel), so the kernel of -s is the lift of the same D1 with -S (stored as -dN next to the
+    +dN lifts of +s, see flip). The pair is solved once and only the lift is done for each
+    sign. For d=1 the kernels of +s and -s are the same.
 
-        return K_Ll
+    E and B are mixed by the difference of the two kernels (see EE_EB). With the healpy
+    alm a_{+-s} = -(E +- iB) and the sign of S in the recursion, the EB kernel is
+    -i(K_{+s}-K_{-s})/2, which matches the pixel space boost of the Q and U maps (boost_map).
 
-    # TODO: add Ll_nu function for boosting Cl in intensity
-    def nu_Ll(self, nu):
-        """returns the Boost Power Transfer Matrix (BPTM) K_{L,l} at frequency nu [GHz] defined in
-        Yasini & Pierpeoli 2017"""
-        K_nu_mLl = self.nu_mLl(nu)
-        K_nu_Ll = np.zeros((self.lmax + 1, 2 * self.delta_ell + 1))
+    Usage example:
+
+    pair = cb.SpinPair(kernel, s=2)      # or kernel.spin_pair()
+
+    K_plus, K_minus = pair.mLl
+    K_plus, K_minus = pair.nu_mLl(nu)
+    K_EE, K_EB = pair.EE_EB(nu)          # the EB kernel is i*K_EB
+    K_plus, K_minus = pair.inverse(nu)   # kernel elements of -beta (no new solve)
+    """
+
+    def __init__(self, kernel, s=2, d=None):
+        self.s = abs(s)
+        self.d = kernel.d if d is None else d
+
+        if (kernel.s, kernel.d) != (self.s, self.d):
+            kernel = kernel.copy(s=self.s, d=self.d)
+        self.kernel = kernel  # kernel of +s
+
+    def flip(self, nu=None):
+        """returns the kernel elements of -s (at frequency nu [GHz] or array of nu if provided):
+        the lift of the D1 of +s with the opposite sign of the spin term"""
+        if nu is None:
+            return mh.full_band(self.kernel.ladder.get_K_d(self.d, -self.s))
+        return self._nu_combine(self.kernel.ladder.K_d_arr(self.d, -self.s), nu)
+
+    def _nu_combine(self, K_d_arr, nu):
+        """returns the generalized kernel of the K_d array K_d_arr at frequency nu [GHz]"""
+        kernel = self.kernel
+        return kr.get_K_nu_d(K_d_arr, nu, kernel.pars, freq_func=kernel.freq_func,
+                             return_normalize=kernel.pars['normalize'])
+
+    @property
+    def mLl(self):
+        """kernel elements of +s and -s"""
+        return self.kernel.mLl, self.flip()
+
+    def _band_rows(self):
+        """kernel elements of +s and -s as they are kept (see Kernel._band_rows)"""
+        return self.kernel._band_rows(), self.kernel.ladder.get_K_d(self.d, -self.s)
+
+    def nu_mLl(self, nu):
+        """generalized kernel elements of +s and -s at frequency nu [GHz] (or array of nu)"""
+        return self.kernel.nu_mLl(nu), self.flip(nu)
+
+    def d_arrary(self):
+        """K_d arrays of +s and -s (see Kernel.d_arrary)"""
+        return self.kernel.d_arrary(), self.kernel.ladder.K_d_arr(self.d, -self.s)
+
+    def inverse(self, nu=None):
+        """kernel elements of +s and -s for -beta (the inverse boost), at frequency nu [GHz]
+        (or array of nu) if provided
+
+        D1(-eta) = P D1(eta) P with P = diag((-1)^ell). P commutes with the spin term S of the
+        lift and changes the sign of the ell+-1 terms, so lifting D1(-eta) with -beta gives
+        K_{+-s}(-eta) = P K_{-+s}(eta) P: the kernel of -beta of each spin is the kernel of
+        the other spin with the signs (-1)^(ell+ell'). The same holds for every weight of the
+        K_d array, so also at frequency nu. Both spins are lifts of the same D1, so D1 is not
+        solved again."""
+        K_plus, K_minus = self.mLl if nu is None else self.nu_mLl(nu)
+        parity = mh.minus_one_row(self.kernel.delta_ell)
+
+        return parity * np.asarray(K_minus), parity * np.asarray(K_plus)
+
+    def EE_EB(self, nu=None):
+        """returns K_EE and K_EB (the EB kernel is i*K_EB, see combine) at frequency nu [GHz]
+        if provided"""
+        return self.combine(*(self.mLl if nu is None else self.nu_mLl(nu)))
 
-        for L in range(self.lmax + 1):
-            # find all the m mode relevant for each ell'
-            M = np.arange(self.lmin, L + 1)
+    @staticmethod
+    def combine(K_plus, K_minus):
+        """returns K_EE = (K_plus+K_minus)/2 and K_EB = (K_minus-K_plus)/2 from the kernel
+        elements of +s and -s, so that E' = K_EE E + i K_EB B and B' = K_EE B - i K_EB E
+        (see the sign of the EB kernel in SpinPair)"""
+        K_plus, K_minus = np.asarray(K_plus), np.asarray(K_minus)
 
-            # sum over all the m modes for each ell'
-            # m=0 has to be removed because it's counted twice
-            K_nu_Ll[L, :] = 2 * np.sum(K_nu_mLl[mh.mL2indx(M, L, self.lmax), :] ** 2, axis=0) \
-                            - K_nu_mLl[mh.mL2indx(0, L, self.lmax), :] ** 2
+        return 0.5 * (K_plus + K_minus), 0.5 * (K_minus - K_plus)
 
-            K_nu_Ll[L, :] /= 2 * L + 1
 
-        return K_nu_Ll
+##################################################
+#           Kernel Family
+##################################################
+
+class KernelFamily(object):
+    """Doppler and aberration kernels for any beta in [beta_min, beta_max]
+
+    The kernel is exp(eta * generator) in the rapidity eta = arctanh(beta), a smooth function of
+    eta. The family solves the kernel at n_nodes Chebyshev points in eta (each one is a regular
+    Kernel, cached as usual), and stores the Chebyshev coefficients of the kernel elements and
+    the BPTM. The kernel of any beta inside the interval is then a sum of n_nodes arrays.
+
+    The error of the interpolation is estimated from the magnitude of the last two Chebyshev
+    coefficients (family.error_mLl and family.error_Ll). This is an estimate, not a bound.
+    Increase n_nodes if it is too large. The estimate does not include the accuracy of the
+    solver at the nodes (e.g. rtol of the ODE).
+
+    The coefficients are stored in the dtype of the kernels (kernel_kwargs['dtype']) and the
+    node kernels are released once they are added to them.
+
+    Usage example:
+
+    family = cb.KernelFamily(pars, beta_min=0.0010, beta_max=0.0015, n_nodes=12)
+
+    K_mLl = family.mLl(0.00123)
+    K_Ll, error = family.Ll(0.00123, return_error=True)
+    Cl_boosted = family.boost_Cl(Cl, 0.00123)
+    """
+
+    def __init__(self, pars, beta_min, beta_max, n_nodes=16, **kernel_kwargs):
+
+        if not beta_min < beta_max:
+            raise ValueError("beta_min should be smaller than beta_max")
+
+        self.pars = dict(pars)
+        self.lmax = pars['lmax']
+        self.beta_min = beta_min
+        self.beta_max = beta_max
+        self.eta_min = np.arctanh(beta_min)
+        self.eta_max = np.arctanh(beta_max)
+        self.n_nodes = n_nodes
+
+        # the coefficients are accumulated one node at a time, so only the kernel of one node
+        # is held in memory next to them
+        self.eta_nodes = cheb.chebyshev_nodes(self.eta_min, self.eta_max, n_nodes)
+        T = cheb.chebyshev_matrix(n_nodes)
+        dtype = np.dtype(kernel_kwargs.get('dtype', np.float64))
+
+        self.delta_ell = None
+        self.coefficients_mLl = self.coefficients_Ll = None
+        for j, eta in enumerate(self.eta_nodes):
+            kernel = Kernel(dict(self.pars, beta=np.tanh(eta)), **kernel_kwargs)
+            K_mLl, K_Ll = kernel.mLl, kernel.Ll
+            if j == 0:
+                self.delta_ell = kernel.delta_ell
+                self.coefficients_mLl = np.zeros((n_nodes,) + K_mLl.shape, dtype=dtype)
+                self.coefficients_Ll = np.zeros((n_nodes,) + K_Ll.shape)
+
+            for k in range(n_nodes):
+                self.coefficients_mLl[k] += T[k, j] * K_mLl
+                self.coefficients_Ll[k] += T[k, j] * K_Ll
+            del kernel, K_mLl, K_Ll
+
+        self.error_mLl = cheb.chebyshev_error(self.coefficients_mLl)
+        self.error_Ll = cheb.chebyshev_error(self.coefficients_Ll)
+        logger.info("kernel family error estimates: mLl {:.2e}, Ll {:.2e}".format(
+            self.error_mLl, self.error_Ll))
+
+    def _eval(self, coefficients, beta):
+        if not self.beta_min <= beta <= self.beta_max:
+            raise ValueError("beta = {} is outside of the family range [{}, {}]".format(
+                beta, self.beta_min, self.beta_max))
+
+        return cheb.chebyshev_eval(coefficients, np.arctanh(beta), self.eta_min, self.eta_max)
+
+    def mLl(self, beta, return_error=False):
+        """return the kernel elements K^m_{ell' ell} at beta (and the estimated error)"""
+        K_mLl = self._eval(self.coefficients_mLl, beta)
+        return (K_mLl, self.error_mLl) if return_error else K_mLl
+
+    def Ll(self, beta, return_error=False):
+        """return the BPTM K_{L,l} at beta (and the estimated error)"""
+        K_Ll = self._eval(self.coefficients_Ll, beta)
+        return (K_Ll, self.error_Ll) if return_error else K_Ll
+
+    def boost_Cl(self, Cl, beta):
+        """boost the power spectrum Cl (shape (..., lmax+1)) with the BPTM at beta"""
+        return _apply_Ll(self.Ll(beta), np.asarray(Cl), self.lmax, self.delta_ell)
 
 
 ##################################################
@@ -356,7 +929,7 @@ class Kernel(object):
 # ------------------------------
 #           a_{ell, m}
 # ------------------------------
-def boost_alm(alm, kernel, *nu):
+def boost_alm(alm, kernel, *nu, accumulate=None, direction=None, inverse=False):
     """
     boost alm using the provided Doppler & aberration kernel
 
@@ -366,17 +939,25 @@ def boost_alm(alm, kernel, *nu):
         spherical harmonic multipole coeffient of the background radiation
     kernel: object
         an instance of the Doppler and aberration kernel
-    nu [GHz]: scalar
+    nu [GHz]: scalar or 1D array
         if provided the generalized Doppler and aberration kernel will be used at this frequency
+        (or at each of these frequencies)
+    accumulate: dtype
+        dtype of the accumulated sums (e.g. np.float64 with a float32 kernel)
+        by default the kernel dtype is used
+    direction: (theta, phi) [radians] or 3D vector
+        direction of the boost (the z axis by default). The alms are rotated into the boost
+        frame and back with cached Wigner-d matrices (see BoostPlan.apply_batch)
+    inverse: boolean
+        if True, the boost is removed (e.g. from the observed alm) with the kernel of -beta,
+        which is obtained from the same kernel without solving it again (see BoostPlan)
 
     Returns
     -------
-    The boosted a_lms
+    The boosted a_lms (complex64 for float32 kernels)
+    if nu is an array, the boosted a_lms of each frequency are stacked along a new first axis
 
     """
-    # TODO: implement parameter "beta_hat" arbitrary direction for the boost
-    #   rotate with healpy.rotate_alm method
-
     if np.ndim(alm) != 1 and (alm.shape[0] not in (1, 3)):
         raise ValueError("alm should be either 1 dimensional (T) or 3 dimentional (T, E, B)")
 
@@ -385,118 +966,757 @@ def boost_alm(alm, kernel, *nu):
         print("adding new axis to the input alm...\n")
         alm = alm[None, :]
 
-    # slice the temperature alm
-    almT = alm[0]
-
-    # initialize the boosted_alm array (1 or 3 dimensional)
-    boosted_alm = np.zeros(alm.shape, dtype=np.complex)
-
-    # set the first column to boosted almT
     if nu:
-        print("boosting T with nu [GHz] = {}".format(nu))
-        boosted_alm[0] = _boost_almT(almT, kernel, nu[0])
+        assert len(nu) == 1, "only one frequency (nu) can be provided, use an array for many"
+        print("boosting with nu [GHz] = {}".format(nu[0]))
+        plan = kernel.boost_plan(nu[0], polarization=(alm.shape[0] == 3), inverse=inverse)
     else:
-        print("boosting T")
-        boosted_alm[0] = _boost_almT(almT, kernel)
+        plan = kernel.boost_plan(polarization=(alm.shape[0] == 3), inverse=inverse)
+
+    if isinstance(plan, list):
+        # one plan per frequency
+        boosted_alm = np.array([plan_nu.apply(alm, accumulate=accumulate, direction=direction)
+                                for plan_nu in plan])
+        print("Done!")
+        return boosted_alm[:, 0] if alm.shape[0] == 1 else boosted_alm
+
+    boosted_alm = plan.apply(alm, accumulate=accumulate, direction=direction)
 
+    print("Done!")
     # return boosted T if alm is 1 dim
     if alm.shape[0] == 1:
-        print("Done!")
         return boosted_alm[0]
 
     # return boosted E and B as well, if alm is 3 dim
-    if alm.shape[0] == 3:
+    return boosted_alm
 
-        almE = alm[1]
-        almB = alm[2]
 
-        if nu:
-            print("boosting E & B with nu = {}".format(nu))
-            boosted_alm[1:3] = _boost_almEB(almE, almB, kernel, nu[0])
-        else:
-            print("boosting E & B")
-            boosted_alm[1:3] = _boost_almEB(almE, almB, kernel)
+def boost_alm_batch(alms, kernel, *nu, max_bytes=BATCH_MAX_BYTES, accumulate=None,
+                    direction=None, inverse=False):
+    """
+    boost many alm realizations at once using the provided Doppler & aberration kernel
 
-    print("Done!")
-    return boosted_alm
+    Parameters
+    ----------
+    alms: array with shape (n_sims, n_fields, (lmax+1)*(lmax+2)/2) or (n_sims, (lmax+1)*(lmax+2)/2)
+        spherical harmonic multipole coeffients of the simulations, with n_fields = 1 (T)
+        or 3 (T, E, B)
+    kernel: object
+        an instance of the Doppler and aberration kernel
+    nu [GHz]: scalar or 1D array
+        if provided the generalized Doppler and aberration kernel will be used at this frequency
+        (or at each of these frequencies)
+    max_bytes: scalar
+        memory budget of the temporary arrays (the simulations are boosted in chunks that fit in it)
+    accumulate: dtype
+        dtype of the accumulated sums (e.g. np.float64 with a float32 kernel)
+        by default the kernel dtype is used
+    direction: (theta, phi) [radians] or 3D vector
+        direction of the boost (the z axis by default). The Wigner-d matrices are cached
+        for (lmax, theta) and shared by all the simulations
+    inverse: boolean
+        if True, the boost is removed with the kernel of -beta (see boost_alm)
+
+    Returns
+    -------
+    The boosted a_lms with the same shape as alms
+    if nu is an array, the boosted a_lms of each frequency are stacked along a new first axis
 
+    """
+    alms = np.asarray(alms)
+    if alms.ndim not in (2, 3):
+        raise ValueError("alms should have shape (n_sims, n_fields, n_alm) or (n_sims, n_alm)")
 
-def _boost_almT(almT, kernel, *nu):
-    """boost temperature multipoles almT (s=0)"""
+    polarization = (alms.ndim == 3 and alms.shape[1] == 3)
 
-    logger.info("boosting T_lm")
+    if nu:
+        assert len(nu) == 1, "only one frequency (nu) can be provided, use an array for many"
+        plan = kernel.boost_plan(nu[0], polarization=polarization, inverse=inverse)
+    else:
+        plan = kernel.boost_plan(polarization=polarization, inverse=inverse)
 
-    if kernel.s != 0:
-        kernel.s = 0
-        kernel.update()
+    if isinstance(plan, list):
+        # one plan per frequency
+        return np.array([plan_nu.apply_batch(alms, max_bytes=max_bytes, accumulate=accumulate,
+                                             direction=direction)
+                         for plan_nu in plan])
 
-    lmax = kernel.lmax
+    return plan.apply_batch(alms, max_bytes=max_bytes, accumulate=accumulate,
+                            direction=direction)
 
-    extention = kernel.delta_ell
-    # pad the alm with zero
-    almT = np.append(almT, np.zeros(extention))
 
-    Mmatrix = kernel.Mmatrix
-    Lmatrix = kernel.Lmatrix
+def deboost_alm(alm, kernel, *nu, **kwargs):
+    """
+    remove the boost of the kernel from alm (e.g. the observer motion from the observed alm)
+    same as boost_alm(alm, kernel, *nu, inverse=True, **kwargs)
+    """
+    return boost_alm(alm, kernel, *nu, inverse=True, **kwargs)
 
-    # if nu is provided calculate the kernel for intensity
-    if nu:
-        assert len(nu) == 1, "only one frequency should be provide "
-        kernel.d = 3
-        kernel.update()
-        print("\nboosting intensity at nu = {} [GHz]\n\n".format(nu[0]))
-        alm_boosted = np.sum(kernel.nu_mLl(nu[0]) * almT[mh.mL2indx(Mmatrix, Lmatrix, lmax)],
-                             axis=1)
-    # otherwise do it for temperature
-    else:
-        alm_boosted = np.sum(kernel.mLl * almT[mh.mL2indx(Mmatrix, Lmatrix, lmax)], axis=1)
 
-    return alm_boosted
+def combined_beta(*betas):
+    """returns the velocity of the collinear boosts betas applied one after the other
+    (the rapidities arctanh(beta) add)"""
+    return float(np.tanh(np.sum(np.arctanh(betas))))
 
 
-def _boost_almEB(almE, almB, kernel, *nu):
-    """boost polarization multipoles almE and almB (s=2)"""
+def boost_map(maps, pars, *nu, chunk_pixels=pb.CHUNK_PIXELS, out=None, nest=False):
+    """
+    boost healpix maps in pixel space (approximate, no kernel is needed)
 
-    logger.info("boosting E_lm and B_lm")
+    each pixel of the boosted map is interpolated from the rest frame map at the aberrated
+    direction and multiplied by the Doppler weight D^d (D^3 F(nu/D)/F(nu) at frequency nu,
+    with the frequency_function F of pars). The cost is O(npix), so this can be used for
+    maps with lmax far beyond the reach of the kernels. The maps should be oversampled
+    (nside >~ lmax), since the bilinear interpolation of healpy smooths the small scales.
 
-    if kernel.s != 2:
-        kernel.s = 2
-        kernel.update()
-    if nu:
-        kernel_plus = kernel.nu_mLl(nu[0])
-    else:
-        kernel_plus = kernel.mLl
+    Parameters
+    ----------
+    maps: array with shape (npix,) or (n_fields, npix)
+        T or (T, Q, U) maps in the rest frame (may be a memory map)
+    pars: dict or object
+        dictionary of the boost parameters (beta, d, T_0, normalize, frequency_function)
+        or an instance of the Doppler and aberration kernel
+    nu [GHz]: scalar or 1D array
+        if provided the frequency dependent Doppler weight is used at this frequency
+        (or at each of these frequencies)
+    chunk_pixels: int
+        number of pixels boosted at a time
+    out: array with the shape of maps (or (len(nu),) + maps.shape if nu is an array)
+        the boosted maps are written in out (e.g. a memory map) if it is provided
+    nest: boolean
+        True for maps in the NESTED ordering
+
+    Returns
+    -------
+    The boosted maps with the shape of maps
+    if nu is an array, the boosted maps of each frequency are stacked along a new first axis
 
-    kernel.s = -2
-    kernel.update()
+    """
+    if isinstance(pars, Kernel):
+        pars = pars.pars
 
     if nu:
-        kernel_minus = kernel.nu_mLl(nu[0])
-    else:
-        kernel_minus = kernel.mLl
+        assert len(nu) == 1, "only one frequency (nu) can be provided, use an array for many"
+        if np.ndim(nu[0]) == 1:
+            # each frequency is written into its own slice of out
+            maps = np.asarray(maps)
+            shape = (len(nu[0]),) + maps.shape
+            if out is None:
+                dtype = maps.dtype if np.issubdtype(maps.dtype, np.floating) else np.float64
+                out = np.empty(shape, dtype=dtype)
+            elif out.shape != shape:
+                raise ValueError("out should have the shape (len(nu),) + maps.shape = {}"
+                                 .format(shape))
+            for i, nu_i in enumerate(nu[0]):
+                boost_map(maps, pars, nu_i, chunk_pixels=chunk_pixels, out=out[i], nest=nest)
+            return out
+
+    freq_func = FREQ_DICT[pars.get('frequency_function', 'CMB')]
+
+    # intensity is boosted with Doppler weight d=3
+    d = 3 if nu else pars['d']
+    nu = float(nu[0]) if nu else None
+
+    def weight_func(D):
+        return pb.doppler_weight(D, d, nu, freq_func, pars['T_0'], pars['normalize'])
+
+    return pb.boost_map(maps, pars['beta'], weight_func, chunk_pixels=chunk_pixels, out=out,
+                        nest=nest)
+
+
+class BoostPlan(object):
+    """Precomputed boost of the alm for a given kernel (and frequency)
+
+    The plan is built once from a Kernel: it holds the final temperature (T) and
+    polarization (EE, EB) kernel coefficients.
+    plan.apply(alm) does no I/O and does not change the kernel, and the plan is read-only,
+    so one plan can be shared by many threads.
+
+    Usage example:
+
+    plan = cb.BoostPlan(kernel)                    # or kernel.boost_plan()
+    plan = cb.BoostPlan(kernel, nu=217)            # generalized kernel at 217 GHz
+    plan = cb.BoostPlan(kernel, polarization=True)
+
+    boosted_alm = plan.apply(alm)
+    boosted_alms = plan.apply_batch(alms)  # alms with shape (n_sims, n_fields, n_alm)
+
+    For d=1 plans of a half_band kernel, T, EE and EB hold only the ell <= ell' half of the
+    band (delta_ell+1 columns). The other half is applied with the transpose of the same
+    sparse matrix (see _HalfBand), so the plan keeps about half of the kernel elements.
+
+    With inverse=True the plan removes the boost of the kernel (e.g. the observer motion from
+    the observed alm) with the kernel of -beta. D1(-eta) = (-1)^(ell+ell') D1(eta), so for
+    s=0 (at any Doppler weight and frequency) the inverse plan is the kernel of the boost
+    with the signs (-1)^(ell+ell'). The spin term of the lift is odd in s, and the kernel of
+    -beta of the spin +-s is the kernel of -+s with these signs (see SpinPair.inverse). So
+    K_EE of the inverse has the signs (-1)^(ell+ell') and K_EB also changes sign. No kernel
+    is solved again.
+    """
+
+    def __init__(self, kernel, nu=None, polarization=True, coefficients=None, inverse=False):
+
+        self.lmax = kernel.lmax
+        self.delta_ell = kernel.delta_ell
+        self.nu = nu
+        self.dtype = kernel.dtype
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+
+        # intensity is boosted with Doppler weight d=3
+        self.d = kernel.d if nu is None else 3
+
+        # the d=1 kernel is symmetric up to (-1)^(ell+ell') (see Kernel)
+        self.half_band = kernel.half_band and self.d == 1
+
+        self.inverse = inverse
+
+        logger.info("building boost plan (d = {}, nu = {}, inverse = {})".format(self.d, nu,
+                                                                                 inverse))
+
+        # precomputed kernel elements of each spin (see Kernel.boost_plan)
+        self._precomputed = {} if coefficients is None else coefficients
+
+        # T (s=0) kernel
+        K_T, widths = self._coefficients(kernel, 0)
+        self.T = self._store(lambda K_rows: K_rows, (K_T,), self.dtype, widths)
+
+        # E and B (s=+2 and s=-2) kernels
+        self.EE = self.EB = None
+        if polarization:
+            K_plus, K_minus, widths = self._spin_pair_coefficients(kernel)
+
+            def K_EE(K_plus_rows, K_minus_rows):
+                return SpinPair.combine(K_plus_rows, K_minus_rows)[0]
+
+            def K_EB(K_plus_rows, K_minus_rows):
+                return 1j * SpinPair.combine(K_plus_rows, K_minus_rows)[1]
+
+            self.EE = self._store(K_EE, (K_plus, K_minus), self.dtype, widths)
+            self.EB = self._store(K_EB, (K_plus, K_minus), self.complex_dtype, widths)
+
+        del self._precomputed
+
+        # sparse operators (see as_sparse)
+        self._sparse = {}
+        self._sparse_lock = threading.Lock()
+
+    @classmethod
+    def _from_bands(cls, plan, T, EE=None, EB=None):
+        """returns a plan with the settings of plan and the full bands T, EE and EB"""
+        new_plan = cls.__new__(cls)
+        new_plan.__dict__.update({key: getattr(plan, key)
+                                  for key in ('lmax', 'delta_ell', 'nu', 'dtype',
+                                              'complex_dtype', 'd', 'inverse')})
+        new_plan.half_band = False
+        new_plan.T = _read_only(T)
+        new_plan.EE = None if EE is None else _read_only(EE)
+        new_plan.EB = None if EB is None else _read_only(EB)
+        new_plan._sparse = {}
+        new_plan._sparse_lock = threading.Lock()
+
+        return new_plan
+
+    def _coefficients(self, kernel, s):
+        """load the kernel coefficients for spin s (without modifying the kernel) and the
+        half-widths of their ragged band (see _widths)"""
+        if s in self._precomputed:
+            return self._precomputed[s], None
+
+        if (kernel.s, kernel.d) != (s, self.d):
+            kernel = kernel.copy(s=s, d=self.d)
+
+        if self.nu is None:
+            return kernel._band_rows(), self._widths(kernel)
+        else:
+            return kernel.nu_mLl(self.nu), None
+
+    def _spin_pair_coefficients(self, kernel):
+        """load the kernel coefficients of s=+2 and s=-2 (solved once, see SpinPair) and the
+        half-widths of their ragged band (see _widths)
+        in inverse plans the spins are swapped, and with the signs of _inverse_parity these
+        are the coefficients of -beta (see SpinPair.inverse)"""
+        widths = None
+        if 2 in self._precomputed:
+            kernel_plus, kernel_minus = self._precomputed[2], self._precomputed[-2]
+        else:
+            pair = kernel.spin_pair(s=2, d=self.d)
+            if self.nu is None:
+                kernel_plus, kernel_minus = pair._band_rows()
+                widths = self._widths(pair.kernel)
+            else:
+                kernel_plus, kernel_minus = pair.nu_mLl(self.nu)
+
+        if self.inverse:
+            kernel_plus, kernel_minus = kernel_minus, kernel_plus
+
+        return kernel_plus, kernel_minus, widths
+
+    def _widths(self, kernel):
+        """returns the half-widths of the ragged band of the kernel (None for the full band)
+        the stored lifts d >= 1 are zero outside the band of D1, but the lifts to d < 1 (the
+        transposed band) can reach outside of it"""
+        return kernel.widths if self.d >= 1 else None
+
+    def _inverse_parity(self, K_mLl):
+        """in inverse plans multiply the kernel elements by (-1)^(ell+ell') (see BoostPlan)"""
+        if self.inverse:
+            parity = mh.minus_one_row(self.delta_ell)[:K_mLl.shape[-1]]
+            K_mLl = parity.astype(self.dtype) * K_mLl
+        return K_mLl
+
+    def _store(self, combine, K_mLls, dtype, widths=None):
+        """returns combine(*K_mLls) with the signs of _inverse_parity in dtype, calculated
+        one block of rows at a time (the kernels may be mh.BandRows). Half band plans keep
+        only the ell <= ell' half of the band (read from the stored half of a half band D1),
+        and if widths is given only the elements inside the ragged band are kept
+        (mh.RaggedRows)."""
+        if self.half_band:
+            K_mLls = [mh.band2half(K_mLl, self.delta_ell) for K_mLl in K_mLls]
+
+        height = (self.lmax + 1) * (self.lmax + 2) // 2
+        width = self.delta_ell + 1 if self.half_band else 2 * self.delta_ell + 1
+
+        K_stored = [] if widths is not None else np.empty((height, width), dtype=dtype)
+        for rows in mh.row_blocks(self.lmax):
+            K_rows = self._inverse_parity(combine(*(K_mLl[rows] for K_mLl in K_mLls)))
+            if widths is None:
+                K_stored[rows] = K_rows
+            else:
+                mask = mh.ragged_mask(rows, widths, self.lmax, self.delta_ell, self.half_band)
+                K_stored.append(K_rows[mask].astype(dtype))
+
+        if widths is None:
+            return _read_only(K_stored)
+
+        return mh.RaggedRows(_read_only(np.concatenate(K_stored)), widths, self.lmax,
+                             self.delta_ell, half=self.half_band)
+
+    @property
+    def polarization(self):
+        return self.EE is not None
+
+    def _full_band(self, component):
+        """returns the kernel elements of component with the full band, rebuilt one block of
+        rows at a time in half band and ragged plans (mh.BandRows, see mh.full_band)"""
+        K_mLl = getattr(self, component)
+        if self.half_band:
+            K_mLl = mh.HalfBandRows(K_mLl, self.lmax, self.delta_ell,
+                                    sign=HALF_BAND_SIGNS[component])
+        return K_mLl
+
+    def compose(self, other):
+        """return the plan of the boost of other followed by this boost
+
+        the kernels are multiplied band by band (mh.band_product) and the product is truncated
+        to delta_ell. For collinear boosts the rapidities add, so the plans of beta_1 and
+        beta_2 compose into the plan of combined_beta(beta_1, beta_2) without solving a new
+        kernel. The plans should have the same lmax, delta_ell and Doppler weight. For d != 1
+        the multipoles within delta_ell of lmax differ from the kernel of the combined beta,
+        since the lifted kernels (KernelRecursive) are truncated at lmax. Plans at a frequency
+        nu do not compose (the second boost sees the first one at nu/D).
+
+        Usage example:
+
+        plan = kernel_2.boost_plan().compose(kernel_1.boost_plan())
+        boosted_alm = plan.apply(alm)  # same as kernel_2 applied to the alm boosted by kernel_1
+        """
+        if (self.lmax, self.delta_ell, self.d) != (other.lmax, other.delta_ell, other.d):
+            raise ValueError("only plans with the same lmax, delta_ell and d can be composed")
+        if self.nu is not None or other.nu is not None:
+            raise ValueError("plans at a frequency nu cannot be composed")
+
+        def product(first, second):
+            return mh.band_product(first, second, self.lmax, self.delta_ell)
+
+        def full_band(plan, component):
+            return mh.full_band(plan._full_band(component))
+
+        T = product(full_band(self, 'T'), full_band(other, 'T'))
+
+        EE = EB = None
+        if self.polarization and other.polarization:
+            EE_1, EB_1 = full_band(self, 'EE'), full_band(self, 'EB')
+            EE_2, EB_2 = full_band(other, 'EE'), full_band(other, 'EB')
+
+            # E' = K_EE E + K_EB B and B' = K_EE B - K_EB E
+            EE = product(EE_1, EE_2) - product(EB_1, EB_2)
+            EB = product(EE_1, EB_2) + product(EB_1, EE_2)
+
+        return BoostPlan._from_bands(self, T, EE, EB)
+
+    def _check_component(self, component):
+        if component not in ('T', 'EE', 'EB'):
+            raise ValueError("component should be 'T', 'EE' or 'EB'")
+        if component != 'T' and not self.polarization:
+            raise ValueError("this plan was built without polarization")
+
+    def as_sparse(self, component='T'):
+        """return the kernel of component ('T', 'EE' or 'EB') as a scipy.sparse CSR matrix
+        acting on the alm. The matrix is built on the first call and cached."""
+
+        self._check_component(component)
+
+        with self._sparse_lock:
+            if component not in self._sparse:
+                logger.info("building sparse {} operator".format(component))
+                self._sparse[component] = _kernel2csr(self._full_band(component), self.lmax,
+                                                      self.delta_ell)
+
+        return self._sparse[component]
+
+    def _operator(self, component):
+        """return the operator used by apply_batch: the CSR matrix of as_sparse, or the
+        half of the band (see _HalfBand) in half band plans"""
+
+        if not self.half_band:
+            return self.as_sparse(component)
+
+        self._check_component(component)
+        key = ('half', component)
+        with self._sparse_lock:
+            if key not in self._sparse:
+                logger.info("building sparse {} operator (half band)".format(component))
+                lower = _kernel2csr(getattr(self, component), self.lmax, self.delta_ell)
+                self._sparse[key] = _HalfBand(lower, self.lmax, HALF_BAND_SIGNS[component])
+
+        return self._sparse[key]
+
+    def _adjoint(self, component):
+        """return the conjugate transpose of the kernel of component as a CSR matrix, built
+        from the transposed band (mh.transpose) on the first call and cached"""
+
+        self._check_component(component)
+        key = ('adjoint', component)
+        with self._sparse_lock:
+            if key not in self._sparse:
+                logger.info("building sparse {} adjoint operator".format(component))
+                K_mlL = mh.transpose(mh.full_band(self._full_band(component)), self.delta_ell)
+                self._sparse[key] = _kernel2csr(np.conj(K_mlL), self.lmax, self.delta_ell)
+
+        return self._sparse[key]
+
+    def _matmul(self, component, alm, adjoint=False):
+        """return K @ alm (or K^H @ alm if adjoint) for the kernel of component
+        in half band plans K^T = sign P K P (see _HalfBand), so the adjoint reuses the
+        half band operator"""
+
+        if not adjoint:
+            return _spmm(self._operator(component), alm, self.complex_dtype)
+
+        if not self.half_band:
+            return _spmm(self._adjoint(component), alm, self.complex_dtype)
+
+        parity = mh.parity(self.lmax).reshape((-1,) + (1,) * (alm.ndim - 1))
+        K_alm = _spmm(self._operator(component), parity * np.conj(alm), self.complex_dtype)
+        return HALF_BAND_SIGNS[component] * parity * np.conj(K_alm)
+
+    def as_linear_operator(self, spin=0):
+        """return the boost as a scipy.sparse.linalg.LinearOperator
+
+        spin=0 acts on the T alm (n_alm elements) and spin=2 on the stacked E and B alm
+        (2*n_alm elements, [E, B]). matmat boosts alms with shape (n_alm, n_sims) (or
+        (2*n_alm, n_sims)) with one sparse product per component, and rmatvec/rmatmat apply
+        the adjoint, which is built from the transposed band. No dense matrix is formed, so
+        the operator can be used in scipy.sparse.linalg solvers (e.g. cg, gmres)."""
+
+        if spin not in (0, 2):
+            raise ValueError("spin should be either 0 (T) or 2 (E and B)")
+        if spin == 2 and not self.polarization:
+            raise ValueError("this plan was built without polarization")
+
+        n_alm = len(self.T)
+
+        def boost_T(alm, adjoint=False):
+            return self._matmul('T', np.asarray(alm), adjoint)
+
+        def boost_EB(alm, adjoint=False):
+            alm = np.asarray(alm)
+            almE, almB = alm[:n_alm], alm[n_alm:]
+
+            # E' = K_EE E + K_EB B and B' = K_EE B - K_EB E (the signs of K_EB flip in the
+            # adjoint)
+            sign = -1 if adjoint else 1
+            K_EB_B = self._matmul('EB', almB, adjoint)
+            K_EB_E = self._matmul('EB', almE, adjoint)
+            return np.concatenate((self._matmul('EE', almE, adjoint) + sign * K_EB_B,
+                                   self._matmul('EE', almB, adjoint) - sign * K_EB_E))
+
+        boost = boost_T if spin == 0 else boost_EB
+        size = n_alm if spin == 0 else 2 * n_alm
 
-    kernelEE_mLl = 0.5 * (kernel_plus + kernel_minus)
-    kernelEB_mLl = 0.5j * (kernel_plus - kernel_minus)
+        def adjoint(alm):
+            return boost(alm, adjoint=True)
 
-    lmax = kernel.lmax
+        return LinearOperator((size, size), matvec=boost, rmatvec=adjoint, matmat=boost,
+                              rmatmat=adjoint, dtype=self.complex_dtype)
 
-    extention = kernel.delta_ell
-    # pad the alm with zero
-    almE = np.append(almE, np.zeros(extention))
-    almB = np.append(almB, np.zeros(extention))
+    def apply(self, alm, accumulate=None, direction=None):
+        """boost alm with shape ((lmax+1)*(lmax+2)/2) (T) or (n, (lmax+1)*(lmax+2)/2)
+        with n = 1 (T) or 3 (T, E, B)"""
 
-    Mmatrix = kernel.Mmatrix
-    Lmatrix = kernel.Lmatrix
+        alm = np.asarray(alm)
 
-    # sort and prepare alms for direct multiplication with kernel.mLl
-    alm_indx = mh.mL2indx(Mmatrix, Lmatrix, lmax)
+        if alm.ndim == 1:
+            return self.apply_batch(alm[None, :], accumulate=accumulate, direction=direction)[0]
 
-    almE_boosted = np.sum(kernelEE_mLl * almE[alm_indx], axis=1) + np.sum(kernelEB_mLl * almB[
-        alm_indx], axis=1)
-    almB_boosted = np.sum(kernelEE_mLl * almB[alm_indx], axis=1) - np.sum(kernelEB_mLl * almE[
-        alm_indx], axis=1)
+        if alm.shape[0] not in (1, 3):
+            raise ValueError("alm should be either 1 dimensional (T) or 3 dimentional (T, E, B)")
 
-    return np.vstack((almE_boosted, almB_boosted))
+        return self.apply_batch(alm[None, :, :], accumulate=accumulate, direction=direction)[0]
+
+    def apply_batch(self, alms, max_bytes=BATCH_MAX_BYTES, accumulate=None, direction=None):
+        """boost alms with shape (n_sims, n_fields, (lmax+1)*(lmax+2)/2) with n_fields = 1 (T) or
+        3 (T, E, B), or (n_sims, (lmax+1)*(lmax+2)/2) (T)
+
+        the (cached) sparse operators are applied to the simulations as sparse matrix-matrix
+        products, one chunk of simulations at a time. The chunk size is chosen so that the
+        temporary arrays fit in max_bytes.
+
+        the boosted alms have the complex dtype of the plan (complex64 for float32 kernels).
+        If accumulate (e.g. np.float64) is given, the products are accumulated in that
+        precision before rounding.
+
+        if direction ((theta, phi) or a 3D vector) is given, the boost is along direction
+        instead of the z axis: the alms are rotated into the boost frame, boosted and rotated
+        back with the cached Wigner-d matrices of (lmax, theta) (see Rotation.AlmRotation).
+        The rotations about the z axis commute with the kernel, so a direction on the z axis
+        needs no rotation.
+        """
+        alms = np.asarray(alms)
+
+        squeeze = (alms.ndim == 2)
+        if squeeze:
+            alms = alms[:, None, :]
+
+        n_sims, n_fields, n_alm = alms.shape
+        if n_fields not in (1, 3):
+            raise ValueError("alms should have either 1 (T) or 3 (T, E, B) fields")
+        if n_fields == 3 and not self.polarization:
+            raise ValueError("this plan was built without polarization")
+        if n_alm != len(self.T):
+            raise ValueError("alms should have (lmax+1)*(lmax+2)/2 = {} elements".format(len(self.T)))
+
+        boosted_alms = np.empty((n_sims, n_fields, n_alm), dtype=self.complex_dtype)
+
+        # dtype of the products (upcast from the kernel dtype if requested)
+        work_dtype = np.result_type(self.complex_dtype, accumulate or self.dtype)
+
+        rotation = None
+        if direction is not None:
+            theta, phi = rot.direction_angles(direction)
+            if theta != 0.:
+                rotation = rot.get_rotation(self.lmax, theta)
+
+        # each chunk of simulations holds a few (n_alm, n_sims) complex temporaries
+        chunk = max(1, int(max_bytes // (4 * 16 * n_alm * n_fields)))
+
+        for start in range(0, n_sims, chunk):
+            sims = slice(start, min(start + chunk, n_sims))
+
+            alms_chunk = alms[sims]
+            if rotation is not None:
+                alms_chunk = rotation.to_z(alms_chunk, phi)
+
+            # columns are the simulations
+            almT = alms_chunk[:, 0].T.astype(work_dtype)
+            boosted_alms[sims, 0] = _spmm(self._operator('T'), almT, work_dtype).T
+
+            if n_fields == 3:
+                almE = alms_chunk[:, 1].T.astype(work_dtype)
+                almB = alms_chunk[:, 2].T.astype(work_dtype)
+                K_EE, K_EB = self._operator('EE'), self._operator('EB')
+                boosted_alms[sims, 1] = (_spmm(K_EE, almE, work_dtype)
+                                         + _spmm(K_EB, almB, work_dtype)).T
+                boosted_alms[sims, 2] = (_spmm(K_EE, almB, work_dtype)
+                                         - _spmm(K_EB, almE, work_dtype)).T
+
+            if rotation is not None:
+                boosted_alms[sims] = rotation.from_z(boosted_alms[sims], phi)
+
+        if squeeze:
+            return boosted_alms[:, 0]
+        return boosted_alms
+
+
+def _read_only(arr):
+    arr.setflags(write=False)
+    return arr
+
+
+def _spmm(K, alm, dtype):
+    """return K @ alm in dtype
+    if dtype is wider than the kernel, the kernel is upcast one block of rows at a time"""
+
+    if isinstance(K, _HalfBand):
+        return K.matmul(alm, dtype)
+
+    if np.finfo(K.dtype).bits >= np.finfo(dtype).bits:
+        return K @ alm
+
+    out = np.empty((K.shape[0],) + alm.shape[1:], dtype=dtype)
+    for start in range(0, K.shape[0], mh.BLOCK_ROWS):
+        rows = slice(start, min(start + mh.BLOCK_ROWS, K.shape[0]))
+        out[rows] = K[rows].astype(dtype) @ alm
+
+    return out
+
+
+class _HalfBand(object):
+    """boost operator stored as the ell <= ell' half of the band (the CSR matrix lower)
+
+    K = lower + sign * P (lower - diag(lower))^T P with P = diag((-1)^ell), so K @ alm is
+    evaluated with lower and its transpose without building the other half."""
+
+    def __init__(self, lower, lmax, sign=1):
+        self.lower = lower
+        self.sign = sign
+        self.parity = mh.parity(lmax)
+        self.diagonal = lower.diagonal()
+        self.shape = lower.shape
+        self.dtype = lower.dtype
+
+    def matmul(self, alm, dtype):
+        parity = self.parity.reshape((-1,) + (1,) * (alm.ndim - 1))
+        diagonal = self.diagonal.reshape(parity.shape)
+
+        upper = parity * _spmm(self.lower.T, parity * alm, dtype) - diagonal * alm
+        return _spmm(self.lower, alm, dtype) + self.sign * upper
+
+
+def _kernel2csr(K_mLl, lmax, delta_ell):
+    """return the kernel elements K_mLl as a CSR matrix mapping alm to boosted alm
+
+    mL2indx is linear in ell, so the element (m, ell', ell) of the kernel row r is in column
+    r - delta_ell + (ell - ell' + delta_ell). The elements with ell < m or ell > lmax
+    (which fall in the neighboring m blocks) are dropped, and so are the zeros outside a
+    ragged band (see Kernel.widths). K_mLl may hold only the first delta_ell+1 columns
+    (the ell <= ell' half of the band, see BoostPlan).
+    """
+    height = (lmax + 1) * (lmax + 2) // 2
+
+    data, indices, counts = [], [], []
+    for rows in mh.row_blocks(lmax):
+        Mmatrix, Lmatrix = mh.get_ML_block(rows, delta_ell, lmax)
+        Mmatrix, Lmatrix = Mmatrix[:, :K_mLl.shape[1]], Lmatrix[:, :K_mLl.shape[1]]
+        K_rows = K_mLl[rows]
+        mask = (Lmatrix >= Mmatrix) & (Lmatrix <= lmax) & (K_rows != 0)
+
+        data.append(K_rows[mask])
+        indices.append(mh.mL2indx(Mmatrix, Lmatrix, lmax)[mask])
+        counts.append(mask.sum(axis=1))
+
+    indptr = np.concatenate(([0], np.cumsum(np.concatenate(counts))))
+
+    return sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                             shape=(height, height))
+
+
+class FirstOrderBoost(object):
+    """Boost of alm by a small velocity beta in any direction to first order in beta
+
+    a' = a + eta G a with the rapidity eta = arctanh(beta), where G is the generator of the
+    kernel (Generator.generator_csr). G only couples ell to ell+-1 (and m to m+-1 off the
+    z axis), so no kernel is solved and applying it costs a few sparse products. This is
+    meant for small extra velocities on top of an already boosted sky (e.g. the orbital
+    velocity changing over a survey): the error is of order (eta ell)^2.
+
+    The frequency dependent kernel at nu is D^3 F(nu/D)/F(nu), so to first order it has the
+    Doppler weight 3 - dlnF/dlnnu, which is taken from the weights of KernelRecursive.
+    The spin term of the generator mixes E and B (see Generator.spin_generators).
+
+    Usage example:
+
+    boost = cb.FirstOrderBoost(pars, beta=1e-5, direction=(theta, phi))
+    boosted_alm = boost.apply(plan.apply(alm))
+    boosted_alms = boost.apply_batch(alms)
+    """
+
+    def __init__(self, pars, beta, direction=None, nu=None, polarization=True):
+        if isinstance(pars, Kernel):
+            pars = pars.pars
+
+        self.lmax = pars['lmax']
+        self.beta = beta
+        self.eta = np.arctanh(beta)
+        self.nu = nu
+
+        theta, phi = (0., 0.) if direction is None else rot.direction_angles(direction)
+        self.direction = np.array([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi),
+                                   np.cos(theta)])
+
+        # identity term and Doppler weight of the generator
+        self.scale, self.d = 1., pars['d']
+        if nu is not None:
+            freq_func = FREQ_DICT[pars.get('frequency_function', 'CMB')]
+            weights = kr.get_nu_weights(float(nu), pars, freq_func=freq_func,
+                                        return_normalize=pars['normalize'])
+            # intensity is boosted with Doppler weight d=3 (weights of K_{3-k})
+            self.scale = float(np.sum(weights))
+            self.d = float(np.sum(weights * (3 - np.arange(len(weights))))) / self.scale
+
+        logger.info("building first order boost (d = {}, beta = {})".format(self.d, beta))
+        self.T = gen.generator_csr(self.lmax, 0, self.d, self.direction)
+        self.EE = self.EB = None
+        if polarization:
+            self.EE, self.EB = gen.spin_generators(self.lmax, 2, self.d, self.direction)
+
+    @property
+    def polarization(self):
+        return self.EE is not None
+
+    @staticmethod
+    def _generate(G, alm):
+        return G[0] @ alm + G[1] @ np.conj(alm)
+
+    def apply(self, alm):
+        """boost alm with shape ((lmax+1)*(lmax+2)/2) (T) or (n, (lmax+1)*(lmax+2)/2)
+        with n = 1 (T) or 3 (T, E, B)"""
+        alm = np.asarray(alm)
+
+        if alm.ndim == 1:
+            return self.apply_batch(alm[None, :])[0]
+
+        if alm.shape[0] not in (1, 3):
+            raise ValueError("alm should be either 1 dimensional (T) or 3 dimentional (T, E, B)")
+
+        return self.apply_batch(alm[None, :, :])[0]
+
+    def apply_batch(self, alms):
+        """boost alms with shape (n_sims, n_fields, (lmax+1)*(lmax+2)/2) with n_fields = 1 (T)
+        or 3 (T, E, B), or (n_sims, (lmax+1)*(lmax+2)/2) (T)"""
+        alms = np.asarray(alms)
+
+        squeeze = (alms.ndim == 2)
+        if squeeze:
+            alms = alms[:, None, :]
+
+        n_sims, n_fields, n_alm = alms.shape
+        if n_fields not in (1, 3):
+            raise ValueError("alms should have either 1 (T) or 3 (T, E, B) fields")
+        if n_fields == 3 and not self.polarization:
+            raise ValueError("this boost was built without polarization")
+        if n_alm != self.T[0].shape[0]:
+            raise ValueError("alms should have (lmax+1)*(lmax+2)/2 = {} elements".format(
+                self.T[0].shape[0]))
+
+        # columns are the simulations
+        almT = alms[:, 0].T.astype(complex)
+        boosted_alms = np.empty((n_sims, n_fields, n_alm), dtype=complex)
+        boosted_alms[:, 0] = (almT + self.eta * self._generate(self.T, almT)).T
+
+        if n_fields == 3:
+            almE = alms[:, 1].T.astype(complex)
+            almB = alms[:, 2].T.astype(complex)
+            boosted_alms[:, 1] = (almE + self.eta * (self._generate(self.EE, almE)
+                                                     + self._generate(self.EB, almB))).T
+            boosted_alms[:, 2] = (almB + self.eta * (self._generate(self.EE, almB)
+                                                     - self._generate(self.EB, almE))).T
+
+        boosted_alms *= self.scale
+
+        if squeeze:
+            return boosted_alms[:, 0]
+        return boosted_alms
 
 
 # ------------------------------
@@ -505,35 +1725,69 @@ def _boost_almEB(almE, almB, kernel, *nu):
 def boost_Cl(Cl, kernel, *nu):
     """
 
-    boost alm using the provided Doppler & aberration kernel
+    boost the power spectrum using the provided Doppler & aberration kernel
 
     Parameters
     ----------
-    Cl: array with shape (n, lmax+1)
+    Cl: array with shape (lmax+1), (n, lmax+1) or (..., n, lmax+1)
         spherical harmonic power spectrum of the background radiation
+        1D: the TT spectrum
+        n = 1: TT, n = 4: TT, EE, BB, TE (any leading axes are a stack of spectra)
     kernel: object
         an instance of the Doppler and aberration kernel
-    nu [GHz]: scalar
+    nu [GHz]: scalar or 1D array
         if provided the generalized Doppler and aberration kernel will be used at this frequency
+        (or at each of these frequencies, stacked along a new first axis)
 
     Returns
     -------
-    The boosted Cl
+    The boosted Cl (same shape as Cl)
     """
-    lmax = kernel.lmax
-    delta_ell = kernel.delta_ell
+    Cl = np.asarray(Cl)
+
+    if nu:
+        assert len(nu) == 1, "only one frequency (nu) can be provided, use an array for many"
+        nu = nu[0]
+    else:
+        nu = None
+
+    if Cl.ndim == 1:
+        K_Ll = kernel.Ll if nu is None else kernel.nu_Ll(nu)
+        return _apply_Ll(K_Ll, Cl, kernel.lmax, kernel.delta_ell)
+
+    if Cl.shape[-2] not in (1, 4):
+        raise ValueError("Cl should have 1 (TT) or 4 (TT, EE, BB, TE) spectra along axis -2")
+
+    if np.ndim(nu) == 1:
+        return np.array([boost_Cl(Cl, kernel, nu_i) for nu_i in nu])
+
+    if Cl.shape[-2] == 1:
+        # TT only needs the BPTM of the s=0 kernel (not the polarization kernels)
+        kernel_T = kernel if kernel.s == 0 else kernel.copy(s=0)
+        K_Ll = kernel_T.Ll if nu is None else kernel_T.nu_Ll(nu)
+        return _apply_Ll(K_Ll, Cl[..., 0, :], kernel.lmax, kernel.delta_ell)[..., None, :]
+
+    K_Ll = kernel.transfer_matrices(nu)
+
+    def apply(key, Cl_XY):
+        return _apply_Ll(K_Ll[key], Cl_XY, kernel.lmax, kernel.delta_ell)
+
+    TT, EE, BB, TE = (Cl[..., i, :] for i in range(4))
+
+    return np.stack([apply('TT', TT),
+                     apply('EE', EE) + apply('EB', BB),
+                     apply('EE', BB) + apply('EB', EE),
+                     apply('TE', TE)], axis=-2)
+
+
+def _apply_Ll(K_Ll, Cl, lmax, delta_ell):
+    """return sum_ell K_{L ell} Cl_ell for each L (along the last axis of Cl)"""
     extention = (delta_ell * (2 * lmax + 1) + delta_ell ** 2) // 2
 
-    Cl_ext = np.append(Cl, np.zeros(extention))
+    Cl_ext = np.concatenate((Cl, np.zeros(Cl.shape[:-1] + (extention,))), axis=-1)
 
     L = np.arange(lmax + 1, dtype=int)
     ell = np.tensordot(L, np.ones(2 * delta_ell + 1, dtype=int), axes=0) \
           + np.arange(-delta_ell, delta_ell + 1, dtype=int)
 
-    if nu:
-        assert len(nu) == 1, "only one frequency (nu) can be provided"
-        Cl_boosted = np.sum(kernel.nu_Ll(nu[0]) * Cl_ext[ell], axis=1)
-    else:
-        Cl_boosted = np.sum(kernel.Ll * Cl_ext[ell], axis=1)
-
-    return Cl_boosted
+    return np.sum(K_Ll * Cl_ext[..., ell], axis=-1)
@@ -0,0 +1,55 @@
+"""
+library containing the Chebyshev interpolation used by the kernel family (kernels on a beta grid)
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+
+def chebyshev_nodes(x_min, x_max, n_nodes):
+    """returns the n_nodes Chebyshev points (of the first kind) in the interval [x_min, x_max]"""
+    t = np.cos(np.pi * (np.arange(n_nodes) + 0.5) / n_nodes)
+    return 0.5 * (x_max + x_min) + 0.5 * (x_max - x_min) * t
+
+
+def chebyshev_matrix(n_nodes):
+    """returns the matrix T[k, j] that maps the samples at the chebyshev_nodes j to the
+    Chebyshev coefficients c_k"""
+    k = np.arange(n_nodes)
+    j = np.arange(n_nodes)
+
+    T = 2. / n_nodes * np.cos(np.pi * np.outer(k, j + 0.5) / n_nodes)
+    T[0] /= 2.
+
+    return T
+
+
+def chebyshev_coefficients(samples):
+    """returns the Chebyshev coefficients c_k of the function sampled at chebyshev_nodes
+    samples has shape (n_nodes, ...) and the coefficients have the same shape"""
+    return np.tensordot(chebyshev_matrix(len(samples)), samples, axes=(1, 0))
+
+
+def chebyshev_eval(coefficients, x, x_min, x_max):
+    """evaluate sum_k c_k T_k(t) at x in [x_min, x_max] (t is x mapped to [-1, 1])
+    with the Clenshaw recurrence"""
+    t = (2. * x - x_max - x_min) / (x_max - x_min)
+
+    b_1 = np.zeros(coefficients.shape[1:])
+    b_2 = np.zeros(coefficients.shape[1:])
+    for c_k in coefficients[:0:-1]:
+        b_1, b_2 = c_k + 2. * t * b_1 - b_2, b_1
+
+    return coefficients[0] + t * b_1 - b_2
+
+
+def chebyshev_error(coefficients):
+    """returns an estimate of the (maximum absolute) interpolation error: the magnitude of the
+    last two Chebyshev coefficients. It is not a bound (it assumes the coefficients keep
+    decreasing)"""
+    return float(np.max(np.abs(coefficients[-1])) + np.max(np.abs(coefficients[-2])))
@@ -0,0 +1,93 @@
+"""
+library containing advisory file locks and atomic file publication for the kernel cache
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import os
+import tempfile
+import warnings
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+
+class FileLock(object):
+    """Advisory (flock) lock on lock_file_name, shared between processes
+
+    Usage example:
+
+    with FileLock(lock_file_name):
+        # only one process at a time runs this block
+        ...
+
+    lock = FileLock(lock_file_name, blocking=False)
+    if lock.acquire():
+        ...
+        lock.release()
+
+    On platforms without fcntl the lock is a no-op.
+    """
+
+    def __init__(self, lock_file_name, blocking=True):
+        self.lock_file_name = lock_file_name
+        self.blocking = blocking
+        self._fd = None
+
+    def acquire(self):
+        """acquire the lock. Returns False if blocking=False and another process holds it"""
+        if fcntl is None:
+            warnings.warn("fcntl is not available, the kernel cache is not locked")
+            return True
+
+        os.makedirs(os.path.dirname(self.lock_file_name), exist_ok=True)
+        self._fd = os.open(self.lock_file_name, os.O_RDWR | os.O_CREAT, 0o644)
+
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            os.close(self._fd)
+            self._fd = None
+            return False
+
+        logger.info("acquired {}".format(self.lock_file_name))
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            logger.info("released {}".format(self.lock_file_name))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def atomic_write(file_name, write_func, suffix=".tmp"):
+    """write a file by calling write_func(f) on a temporary file in the same directory and
+    renaming it to file_name, so other processes see either the old or the complete new file"""
+
+    dir_name = os.path.dirname(file_name)
+    fd, tmp_file_name = tempfile.mkstemp(dir=dir_name, prefix=".", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
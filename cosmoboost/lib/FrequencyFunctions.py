@@ -5,7 +5,13 @@ library containing frequency functions of the observed radiation
 __author__ = " Siavash Yasini"
 __email__ = "yasini@usc.edu"
 
+import functools
 import numpy as np
+from numpy.polynomial.polynomial import polyval2d
+from scipy.special import factorial
+
+# h/k_B in K/GHz
+X_FACTOR = 0.0479924
 
 ############################################
 #           frequency functions
@@ -36,7 +42,6 @@ def F_nu(nu, T, normalized=False):
 #        Sunyaev-Zeldovich
 # ------------------------------
 
-@np.vectorize
 def F_tSZ(nu, T, normalized=False):
     """The frequency function of tSZ Intensity (tau*theta effect) at frequency nu (GHz)
     Default setting returns the frequency function normalized by the differential black body
@@ -52,10 +57,152 @@ def F_tSZ(nu, T, normalized=False):
         return F
 
 
-@np.vectorize
 def F_kSZ(nu, T, normalized=False):
     """The frequency function of kSZ Intensity (tau*beta effect) at frequency nu (GHz)
     Default setting returns the frequency function normalized by the differential black body
     spectrum"""
 
     return F_nu(nu, T, normalized=normalized)
+
+
+############################################
+#           frequency derivatives
+############################################
+
+# The frequency functions above are polynomials in x = h nu/(k_B T) and y = 1/(e^x-1) times
+# A = 0.0014745 (T/0.0479924)^3:
+#   F_nu  = A x^4 (y + y^2)
+#   F_tSZ = F_nu (x (1 + 2y) - 4)
+#   F_kSZ = F_nu
+# dy/dx = -y - y^2, so their derivatives are polynomials in x and y as well.
+# The coefficients are stored as c[i, j] for the terms x^i y^j.
+
+XY_COEFFS_F_nu = np.array([[0, 0, 0],
+                           [0, 0, 0],
+                           [0, 0, 0],
+                           [0, 0, 0],
+                           [0, 1, 1]], dtype=float)
+
+XY_COEFFS_F_tSZ = np.array([[0, 0, 0, 0],
+                            [0, 0, 0, 0],
+                            [0, 0, 0, 0],
+                            [0, 0, 0, 0],
+                            [0, -4, -4, 0],
+                            [0, 1, 3, 2]], dtype=float)
+
+
+def dx_xy_poly(coeffs):
+    """return the coefficients of d/dx of the polynomial sum_ij coeffs[i,j] x^i y^j with
+    y = 1/(e^x-1)"""
+
+    n_x, n_y = coeffs.shape
+    d_coeffs = np.zeros((n_x, n_y + 1))
+
+    # d(x^i)/dx = i x^(i-1)
+    d_coeffs[:-1, :-1] += coeffs[1:] * np.arange(1, n_x)[:, None]
+
+    # d(y^j)/dx = -j (y^j + y^(j+1))
+    j = np.arange(n_y)
+    d_coeffs[:, :-1] -= coeffs * j
+    d_coeffs[:, 1:] -= coeffs * j
+
+    return d_coeffs
+
+
+def xy_poly_derivative(coeffs):
+    """return the function (nu, T, n) -> d^n/dnu^n [A(T) sum_ij coeffs[i,j] x^i y^j]
+    where A(T) = 0.0014745 (T/0.0479924)^3. The derivative table is built once for each n."""
+
+    @functools.lru_cache(maxsize=None)
+    def dx_coeffs(n):
+        return coeffs if n == 0 else dx_xy_poly(dx_coeffs(n - 1))
+
+    def derivative(nu, T, n):
+        x = X_FACTOR * np.asarray(nu, dtype=float) / T
+        y = 1. / np.expm1(x)
+        A = 0.0014745 * (T / X_FACTOR)**3
+
+        # d/dnu = (x/nu) d/dx
+        return A * (X_FACTOR / T)**n * polyval2d(x, y, dx_coeffs(n))
+
+    return derivative
+
+
+@functools.lru_cache(maxsize=None)
+def central_diff_weights(n, order=13):
+    """return the weights of the order-point central finite difference of the n-th derivative"""
+    half = order // 2
+    offsets = np.arange(-half, half + 1, dtype=float)
+
+    # the weights reproduce the n-th derivative of the polynomials up to degree order-1
+    rhs = np.zeros(order)
+    rhs[n] = factorial(n)
+    return np.linalg.solve(np.vander(offsets, increasing=True).T, rhs)
+
+
+class FrequencyFunction(object):
+    """Frequency function F(nu, T) of the observed radiation and its frequency derivatives
+
+    If derivative(nu, T, n) is not provided, the derivatives are calculated with central finite
+    differences (the stencil weights and the derivatives at previously used frequencies are
+    cached).
+
+    Usage example:
+
+    freq_func = FrequencyFunction(F_nu, derivative=xy_poly_derivative(XY_COEFFS_F_nu))
+
+    freq_func(nu, T)
+    freq_func.derivative(nu, T, n)  # d^nF/dnu^n
+    """
+
+    def __init__(self, func, derivative=None, order=13):
+        self.func = func
+        self._derivative = derivative
+        self.order = order  # number of points of the finite difference stencil
+
+    def __call__(self, nu, T, **kwargs):
+        return self.func(nu, T, **kwargs)
+
+    def derivative(self, nu, T, n, dnu=1.0):
+        """returns the n-th derivative d^nF/dnu^n at frequency nu [GHz]
+        dnu [GHz] is the step of the finite difference (if no derivative was provided)"""
+        if n == 0:
+            return self.func(nu, T)
+
+        if self._derivative is not None:
+            return self._derivative(nu, T, n)
+
+        shape = np.shape(nu)
+        nu = tuple(np.ravel(nu).astype(float))
+        return np.array(self._fd_derivative(nu, T, n, dnu)).reshape(shape)
+
+    @functools.lru_cache(maxsize=256)
+    def _fd_derivative(self, nu, T, n, dnu):
+        nu = np.array(nu)
+        weights = central_diff_weights(n, self.order)
+        half = self.order // 2
+
+        derivative = 0.
+        for k, weight in enumerate(weights):
+            if weight != 0:
+                derivative = derivative + weight * self.func(nu + (k - half) * dnu, T)
+
+        return tuple(derivative / dnu**n)
+
+
+# registry of the frequency functions (see register_frequency_function)
+FREQ_FUNCTIONS = {
+    "CMB": FrequencyFunction(F_nu, derivative=xy_poly_derivative(XY_COEFFS_F_nu)),
+    "kSZ": FrequencyFunction(F_kSZ, derivative=xy_poly_derivative(XY_COEFFS_F_nu)),
+    "tSZ": FrequencyFunction(F_tSZ, derivative=xy_poly_derivative(XY_COEFFS_F_tSZ)),
+    }
+
+
+def register_frequency_function(name, func, derivative=None):
+    """register the frequency function func(nu, T) under name (pars['frequency_function'])
+
+    derivative(nu, T, n) should return the n-th derivative d^nF/dnu^n. If it is not provided,
+    the derivatives are calculated with finite differences of step pars['derivative_dnu']."""
+
+    FREQ_FUNCTIONS[name] = FrequencyFunction(func, derivative=derivative)
+    return FREQ_FUNCTIONS[name]
@@ -0,0 +1,131 @@
+"""
+library containing the generator of the boost (the first order kernel) in any direction
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import numpy as np
+import scipy.sparse as sparse
+
+from cosmoboost.lib import MatrixHandler as mh
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+
+def clebsch_gordan_1(ell, m, q, dl):
+    """returns the Clebsch-Gordan coefficients <ell m; 1 q | ell+dl m+q> (dl = -1, 0 or 1)"""
+    ell = np.asarray(ell, dtype=float)
+    M = m + q
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if dl == 1:
+            cg = {1: np.sqrt((ell + M) * (ell + M + 1) / ((2 * ell + 1) * (2 * ell + 2))),
+                  0: np.sqrt((ell - M + 1) * (ell + M + 1) / ((2 * ell + 1) * (ell + 1))),
+                  -1: np.sqrt((ell - M) * (ell - M + 1) / ((2 * ell + 1) * (2 * ell + 2)))}[q]
+        elif dl == 0:
+            cg = {1: -np.sqrt((ell + M) * (ell - M + 1) / (2 * ell * (ell + 1))),
+                  0: M / np.sqrt(ell * (ell + 1)),
+                  -1: np.sqrt((ell - M) * (ell + M + 1) / (2 * ell * (ell + 1)))}[q]
+        else:
+            cg = {1: np.sqrt((ell - M) * (ell - M + 1) / (2 * ell * (2 * ell + 1))),
+                  0: -np.sqrt((ell - M) * (ell + M) / (ell * (2 * ell + 1))),
+                  -1: np.sqrt((ell + M + 1) * (ell + M) / (2 * ell * (2 * ell + 1)))}[q]
+
+    return np.nan_to_num(cg, nan=0., posinf=0., neginf=0.)
+
+
+def reduced_elements(ell, dl, s, d):
+    """returns the reduced matrix elements <ell+dl || G || ell> of the boost generator
+
+    Along the z axis the generator of the kernel of Doppler weight d is
+    (G a)_{ell'} = (B_{ell'} + (d-1) C_{ell'}) a_{ell'-1} + (-B_{ell'+1} + (d-1) C_{ell'+1}) a_{ell'+1}
+                   + (d-1) s m / (ell'(ell'+1)) a_{ell'}
+    (the first order term of the ODE in KernelODE and of the recursion in KernelRecursive, with
+    Blm and Clm of mh.get_Blm_Clm). G_z divided by <ell m; 1 0 | ell' m> does not depend on m,
+    and the generator is a vector operator, so this is all that is needed for the other
+    directions (Wigner-Eckart theorem)."""
+    ell = np.asarray(ell, dtype=float)
+    L = ell + 1 if dl == 1 else ell
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # B_L = beta_L sqrt(L^2-m^2)
+        beta_L = np.sqrt(np.clip(L ** 2 - s ** 2, 0, None) / (4 * L ** 2 - 1))
+        if dl == 1:
+            reduced = beta_L * (1 + (d - 1) / L) * np.sqrt((2 * L - 1) * L)
+        elif dl == -1:
+            reduced = beta_L * (1 - (d - 1) / L) * np.sqrt(L * (2 * L + 1))
+        else:
+            reduced = (d - 1) * s / np.sqrt(ell * (ell + 1)) * (ell >= s)
+
+    return np.nan_to_num(reduced, nan=0., posinf=0., neginf=0.)
+
+
+def spherical_components(direction):
+    """returns the spherical components {q: n_q} of the unit vector direction (x, y, z)"""
+    x, y, z = np.asarray(direction, dtype=float) / np.linalg.norm(direction)
+    return {1: -(x + 1j * y) / np.sqrt(2), 0: z + 0j, -1: (x - 1j * y) / np.sqrt(2)}
+
+
+def generator_csr(lmax, s, d, direction=(0., 0., 1.), dls=(-1, 0, 1)):
+    """returns the generator of the boost along direction as a pair of CSR matrices (G, G_conj)
+    acting on the healpy alm (m >= 0) of a real field: G a = G @ alm + G_conj @ conj(alm)
+
+    G = sum_q (-1)^q n_{-q} G_q changes m by q. The m' = 0 alm also receive the m = -1 alm,
+    which are -conj(a_{ell,1}) for real fields, hence G_conj.
+    Only the terms that change ell by dls are included: dls=(-1, 1) is the aberration of
+    the multipoles and dls=(0,) the spin term, which is odd in s (see spin_generators)."""
+
+    height = (lmax + 1) * (lmax + 2) // 2
+    m, ell = mh.indx2mL(np.arange(height), lmax)
+    n = spherical_components(direction)
+
+    data, rows, cols = [], [], []
+    data_conj, rows_conj, cols_conj = [], [], []
+    for dl in dls:
+        reduced = reduced_elements(ell, dl, s, d)
+        for q in (-1, 0, 1):
+            if n[-q] == 0:
+                continue
+            coefficient = (-1) ** q * n[-q] * reduced * clebsch_gordan_1(ell, m, q, dl)
+
+            ell_out, m_out = ell + dl, m + q
+            valid = (m_out >= 0) & (m_out <= ell_out) & (ell_out <= lmax) & (coefficient != 0)
+            data.append(coefficient[valid])
+            rows.append(mh.mL2indx(m_out[valid], ell_out[valid], lmax))
+            cols.append(np.arange(height)[valid])
+
+            if q == 1:
+                # a_{ell,-1} = -conj(a_{ell,1}) raised to m' = 0
+                ones = (m == 1)
+                coefficient = (-1) * n[-1] * reduced[ones] * clebsch_gordan_1(ell[ones], -1, 1, dl)
+                ell_out = ell[ones] + dl
+                valid = (ell_out >= 0) & (ell_out <= lmax) & (coefficient != 0)
+                data_conj.append(-coefficient[valid])
+                rows_conj.append(mh.mL2indx(0, ell_out[valid], lmax))
+                cols_conj.append(np.arange(height)[ones][valid])
+
+    def csr(data, rows, cols):
+        if not data:
+            return sparse.csr_matrix((height, height), dtype=complex)
+        return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows),
+                                                         np.concatenate(cols))),
+                                 shape=(height, height), dtype=complex)
+
+    return csr(data, rows, cols), csr(data_conj, rows_conj, cols_conj)
+
+
+def spin_generators(lmax, s, d, direction=(0., 0., 1.)):
+    """returns the generators of the E and B alm of spin s as (G_EE, G_EB), each a pair of CSR
+    matrices (see generator_csr): E' = G_EE E + G_EB B and B' = G_EE B - G_EB E
+
+    The spin term of the generator changes sign with s, so it drops out of
+    G_EE = (G_{+s} + G_{-s})/2 and mixes E and B through G_EB = -i(G_{+s} - G_{-s})/2
+    = -i G_spin, the first order term of the EB kernel (see SpinPair). The spin term is a
+    vector operator like the rest of the generator, so this holds in any direction. Both
+    preserve the reality of the fields."""
+    G_EE = generator_csr(lmax, s, d, direction, dls=(-1, 1))
+    G_EB = tuple(-1j * G for G in generator_csr(lmax, s, d, direction, dls=(0,)))
+
+    return G_EE, G_EB
@@ -0,0 +1,300 @@
+"""
+library containing the content-addressed kernel cache
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import warnings
+
+from cosmoboost.lib.KernelStore import KernelStore, LOCK_DIRNAME
+from cosmoboost.lib.FileLock import FileLock, atomic_write
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+# environment variables for configuring the default cache
+CACHE_DIR_ENV = "COSMOBOOST_CACHE_DIR"
+CACHE_MAX_BYTES_ENV = "COSMOBOOST_CACHE_MAX_BYTES"
+
+PARS_NAME = "pars.json"
+LAST_USED_NAME = "last_used"
+
+
+def default_cache_dir():
+    """returns $COSMOBOOST_CACHE_DIR if it is set, otherwise $XDG_CACHE_HOME/cosmoboost
+    (~/.cache/cosmoboost)"""
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),
+                                                                   ".cache")
+    return os.path.join(cache_home, "cosmoboost")
+
+
+def canonical_pars(pars, solver_kwargs=None):
+    """returns the parameters that determine the stored kernels in a canonical form
+    beta is normalized as a float (0.00123 and 1.23e-3 are the same key), s by its absolute
+    value (the sign is carried by the keys of the Doppler weights) and solver_kwargs holds the
+    solver tolerances (e.g. rtol, atol or tol). The dtype is included if it is not float64
+    and band_tol and half_band if the kernels are stored in the ragged or half band layout."""
+
+    canonical = {'beta'     : float(pars['beta']),
+                 'lmax'     : int(pars['lmax']),
+                 'delta_ell': int(pars['delta_ell']),
+                 's'        : abs(int(pars['s'])),
+                 'method'   : str(pars['method']),
+                 }
+    # single precision kernels are stored separately (double precision keeps the old keys)
+    if pars.get('dtype', 'float64') != 'float64':
+        canonical['dtype'] = str(pars['dtype'])
+    # ragged kernels (see MatrixHandler.band2ragged) are stored separately
+    if pars.get('band_tol') is not None:
+        canonical['band_tol'] = float(pars['band_tol'])
+    # the d=1 kernel is stored as half of the band (see MatrixHandler.band2half)
+    if pars.get('half_band'):
+        canonical['half_band'] = True
+    for key, value in sorted((solver_kwargs or {}).items()):
+        canonical[key] = float(value)
+
+    return canonical
+
+
+def kernel_hash(pars, solver_kwargs=None):
+    """returns the sha256 hash of the canonical kernel parameters"""
+    canonical = canonical_pars(pars, solver_kwargs)
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+class KernelCache(object):
+    """Content-addressed cache of kernel stores with a byte budget and LRU eviction
+
+    Each entry is a KernelStore in cache_dir/<hash>, where <hash> is the kernel_hash of the
+    parameters that affect the kernel. When the total size of the cache exceeds max_bytes,
+    the least recently used entries are removed.
+
+    The cache can be shared by many processes: kernels are published atomically and
+    get_or_compute lets only the first process compute a missing kernel while the others wait
+    for it and memory map the result (single-flight).
+
+    Usage example:
+
+    cache = KernelCache("/scratch/cosmoboost", max_bytes=50e9)
+    kernel = cb.Kernel(pars, cache=cache)
+
+    cache.stats  # {'hits': ..., 'misses': ..., 'evictions': ...}
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        if max_bytes is None and os.environ.get(CACHE_MAX_BYTES_ENV):
+            max_bytes = float(os.environ[CACHE_MAX_BYTES_ENV])
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    # ------------------------------
+    #           entries
+    # ------------------------------
+
+    def entry_dirname(self, pars, solver_kwargs=None):
+        """returns the directory of the cache entry for the kernel parameters"""
+        return os.path.join(self.cache_dir, kernel_hash(pars, solver_kwargs))
+
+    def store(self, pars, solver_kwargs=None):
+        """returns the KernelStore of the cache entry for the kernel parameters"""
+        return KernelStore(self.entry_dirname(pars, solver_kwargs))
+
+    def entries(self):
+        """returns the directories of all the entries in the cache"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                if os.path.isdir(os.path.join(self.cache_dir, name))]
+
+    def entry_pars(self, entry_dirname):
+        """returns the canonical parameters of a cache entry"""
+        with open(os.path.join(entry_dirname, PARS_NAME), "r") as f:
+            return json.load(f)
+
+    def other_lmax(self, pars, key, solver_kwargs=None):
+        """returns {lmax: store} for the entries holding the kernel chosen by 'key' with the
+        same parameters except for lmax"""
+        canonical = canonical_pars(pars, solver_kwargs)
+        del canonical['lmax']
+
+        stores = {}
+        for entry in self.entries():
+            try:
+                entry_pars = self.entry_pars(entry)
+            except (OSError, ValueError):  # the entry is being written or evicted
+                continue
+            lmax = entry_pars.pop('lmax', None)
+            if entry_pars == canonical and lmax != pars['lmax'] and key in KernelStore(entry):
+                stores[lmax] = KernelStore(entry)
+
+        return stores
+
+    def _touch(self, entry_dirname):
+        """mark the entry as the most recently used"""
+        try:
+            with open(os.path.join(entry_dirname, LAST_USED_NAME), "w") as f:
+                f.write(repr(time.time()))
+        except OSError:  # the entry was evicted by another process
+            pass
+
+    @staticmethod
+    def _last_used(entry_dirname):
+        try:
+            return os.path.getmtime(os.path.join(entry_dirname, LAST_USED_NAME))
+        except OSError:
+            return 0.
+
+    @staticmethod
+    def entry_size(entry_dirname):
+        """returns the size of a cache entry in bytes"""
+        size = 0
+        for root, _, files in os.walk(entry_dirname):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
+
+    def size(self):
+        """returns the total size of the cache in bytes"""
+        return sum(self.entry_size(entry) for entry in self.entries())
+
+    # ------------------------------
+    #        get / put kernels
+    # ------------------------------
+
+    def get(self, pars, key, solver_kwargs=None):
+        """returns the kernel chosen by 'key' (D1, +d2, -d3, ...) as a memory map,
+        or None if it is not in the cache"""
+        store = self.store(pars, solver_kwargs)
+
+        kernel = None
+        if key in store:
+            try:
+                kernel = store.load(key)
+            except (KeyError, OSError):  # the entry was evicted by another process
+                kernel = None
+
+        if kernel is not None:
+            self.stats['hits'] += 1
+            self._touch(store.dir_name)
+            logger.info("cache hit: {} in {}".format(key, store.dir_name))
+            return kernel
+
+        self.stats['misses'] += 1
+        logger.info("cache miss: {} in {}".format(key, store.dir_name))
+        return None
+
+    def put(self, pars, key, kernel, solver_kwargs=None):
+        """saves the kernel chosen by 'key' in the cache entry of the kernel parameters and
+        evicts the least recently used entries if the cache is over its byte budget"""
+        store = self.store(pars, solver_kwargs)
+        store.save(key, kernel)
+
+        text = json.dumps(canonical_pars(pars, solver_kwargs), indent=1, sort_keys=True)
+        atomic_write(os.path.join(store.dir_name, PARS_NAME), lambda f: f.write(text.encode()))
+        self._touch(store.dir_name)
+
+        self.evict(keep=store.dir_name)
+
+        return store
+
+    def get_or_compute(self, pars, key, compute, solver_kwargs=None):
+        """returns the kernel chosen by 'key' from the cache, or computes it with compute() and
+        saves it. Only one process computes a missing kernel; the others block on its lock
+        and load the published result as a memory map."""
+        kernel = self.get(pars, key, solver_kwargs)
+        if kernel is not None:
+            return kernel
+
+        store = self.store(pars, solver_kwargs)
+        with store.lock(key):
+            # another process may have published the kernel while we were waiting
+            if key in store:
+                self.stats['misses'] -= 1
+                return self.get(pars, key, solver_kwargs)
+
+            kernel = compute()
+            self.put(pars, key, kernel, solver_kwargs)
+
+        return kernel
+
+    def evict(self, keep=None):
+        """remove the least recently used entries (except keep) until the cache fits in
+        max_bytes"""
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self.entries(), key=self._last_used)
+        sizes = {entry: self.entry_size(entry) for entry in entries}
+        total = sum(sizes.values())
+
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep or not self._remove_entry(entry):
+                continue
+            total -= sizes[entry]
+            self.stats['evictions'] += 1
+            logger.info("evicted {}".format(entry))
+
+        if total > self.max_bytes:
+            warnings.warn("the kernel cache ({:.3g} bytes) does not fit in max_bytes = {:.3g}"
+                          .format(total, self.max_bytes))
+
+    @staticmethod
+    def _remove_entry(entry_dirname):
+        """remove a cache entry unless another process is computing one of its kernels
+        returns True if the entry was removed"""
+        lock_dirname = os.path.join(entry_dirname, LOCK_DIRNAME)
+        lock_names = os.listdir(lock_dirname) if os.path.isdir(lock_dirname) else []
+
+        locks = []
+        try:
+            for name in lock_names:
+                lock = FileLock(os.path.join(lock_dirname, name), blocking=False)
+                if not lock.acquire():
+                    return False
+                locks.append(lock)
+            shutil.rmtree(entry_dirname, ignore_errors=True)
+            return True
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def clear(self):
+        """remove all the entries from the cache"""
+        for entry in self.entries():
+            self._remove_entry(entry)
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """returns the cache used by kernels that are not given one explicitly"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = KernelCache()
+    return _default_cache
+
+
+def set_default_cache(cache_dir=None, max_bytes=None):
+    """set the location and byte budget of the default cache"""
+    global _default_cache
+    _default_cache = KernelCache(cache_dir=cache_dir, max_bytes=max_bytes)
+    return _default_cache
@@ -4,7 +4,6 @@ library containing differential equation solver for d=1 kernel elements
 __author__ = " Siavash Yasini"
 __email__ = "yasini@usc.edu"
 
-import os
 import numpy as np
 from scipy.special import factorial
 import pdb
@@ -13,8 +12,9 @@ np.seterr(divide='ignore', invalid='ignore')
 
 from scipy import special
 from scipy.integrate import odeint, solve_ivp
-from cosmoboost.lib import FileHandler as fh
 from cosmoboost.lib import MatrixHandler as mh
+from cosmoboost.lib import KernelPool as kp
+from cosmoboost.lib import KernelCache as kc
 from cosmoboost.lib.mytimer import timeit
 
 import logging
@@ -24,6 +24,12 @@ logger.setLevel(logging.WARN)
 # number of steps for returning the solution to the Differential Equation
 N = 2  # first and last
 
+# default tolerances of the solvers (part of the kernel cache key)
+DEFAULT_TOLERANCES = {'Bessel': {},
+                      'ODE'   : {'rtol': 1.e-3, 'atol': 1.e-6},
+                      'expm'  : {'tol': 1.e-10},
+                      }
+
 
 def dK_deta(Kstore, eta, Bmatrix):
     '''The derivative of the Kernel for index m and L'''
@@ -31,7 +37,281 @@ def dK_deta(Kstore, eta, Bmatrix):
 
     return K_return
 
-def est_K_T_ODE(pars, save_kernel=True):
+def expm_dK_deta(K0, Bmatrix, eta, tol=1.e-10, theta=3., max_terms=100):
+    '''returns exp(eta*A) K0, where A is the (tridiagonal in ell) generator of the kernel ODE
+    defined by dK_deta. The action of the matrix exponential is evaluated with a truncated
+    Taylor series and the scaling and squaring of eta into substeps.
+
+    Parameters
+    ----------
+    K0 : 2D numpy array
+        initial value of the kernel rows (one row per (m,ell'))
+
+    Bmatrix : 2D numpy array
+        Blm coefficients corresponding to the elements of K0
+
+    eta : scalar
+        rapidity (arctanh(beta)) at which the kernel is evaluated
+
+    tol : scalar
+        maximum relative contribution of the neglected Taylor terms accumulated over all
+        substeps
+
+    theta : scalar
+        maximum 1-norm of the generator times the substep size
+
+    max_terms : int
+        maximum number of Taylor terms per substep
+
+    Returns
+    -------
+    K : 2D numpy array
+        kernel rows at eta with the same shape as K0
+
+    '''
+    # the 1-norm of the generator is bounded by twice the largest Blm in the block
+    norm = 2. * np.abs(eta) * np.max(np.abs(Bmatrix), initial=0.)
+    n_steps = max(1, int(np.ceil(norm / theta)))
+    h = eta / n_steps
+    step_tol = tol / n_steps
+
+    K = np.array(K0, dtype=float)
+    for _ in range(n_steps):
+        term = K
+        for k in range(1, max_terms + 1):
+            term = dK_deta(term, h, Bmatrix) * (h / k)
+            K = K + term
+            if np.max(np.abs(term), initial=0.) <= step_tol * np.max(np.abs(K), initial=0.):
+                break
+        else:
+            raise RuntimeError("Taylor series of the kernel did not converge to tol = {} in "
+                               "{} terms".format(tol, max_terms))
+
+    return K
+
+
+def m_blocks(lmax, block_rows, m_min=0, m_max=None):
+    '''split the m modes m_min <= m < m_max into contiguous (m_start, m_stop) ranges with
+    about block_rows (m,ell') rows each'''
+    if m_max is None:
+        m_max = lmax + 1
+
+    m_start = m_min
+    while m_start < m_max:
+        m_stop = m_start + 1
+        n_rows = lmax + 1 - m_start
+        while m_stop < m_max and n_rows + lmax + 1 - m_stop <= block_rows:
+            n_rows += lmax + 1 - m_stop
+            m_stop += 1
+        yield m_start, m_stop
+        m_start = m_stop
+
+
+def get_Bmatrix(pars, m_start=0, m_stop=None):
+    '''returns the Blm coefficients corresponding to the kernel rows m_start <= m < m_stop'''
+    s = pars['s']
+    delta_ell = pars['delta_ell']
+    lmax = pars['lmax']
+
+    Mmatrix, Lmatrix = mh.get_ML_matrix(delta_ell=delta_ell, lmax=lmax,
+                                        m_start=m_start, m_stop=m_stop)
+    Bmatrix, _ = mh.get_Blm_Clm_matrix(Lmatrix, Mmatrix, lmax, s=s)
+
+    return Bmatrix
+
+
+# ------------------------------
+#  kernel rows for a range of m
+# ------------------------------
+
+def m_blocked(row_solver, pars, m_start, m_stop, block_rows=2**16, **solver_kwargs):
+    '''evaluates the kernel rows m_start <= m < m_stop with row_solver(pars, Bmatrix,
+    **solver_kwargs) for sub-blocks of about block_rows rows, so that the coefficient
+    matrices and the temporaries of the solver are only built for one sub-block at a time'''
+    delta_ell = pars['delta_ell']
+    lmax = pars['lmax']
+
+    offset = mh.mL2indx(m_start, m_start, lmax)
+
+    K_T = np.zeros((mh.mL2indx(m_stop, m_stop, lmax) - offset, 2 * delta_ell + 1))
+    for m_lo, m_hi in m_blocks(lmax, block_rows, m_start, m_stop):
+        rows = slice(mh.mL2indx(m_lo, m_lo, lmax) - offset, mh.mL2indx(m_hi, m_hi, lmax) - offset)
+        K_T[rows] = row_solver(pars, get_Bmatrix(pars, m_lo, m_hi), **solver_kwargs)
+
+    return K_T
+
+
+def est_K_T_block(pars, m_start, m_stop, block_rows=2**16):
+    '''analytically estimates the kernel rows m_start <= m < m_stop, block_rows rows at a
+    time (see est_K_T_ODE)'''
+    return m_blocked(est_K_T_B, pars, m_start, m_stop, block_rows=block_rows)
+
+
+def est_K_T_B(pars, Bmatrix):
+    '''analytically estimates the kernel rows with the Blm coefficients Bmatrix'''
+    beta = pars['beta']
+    delta_ell = pars['delta_ell']
+
+    # construct delta_ell matrix
+    dl = np.array([np.arange(delta_ell, -delta_ell - 1, -1)] * Bmatrix.shape[0])
+
+    eta = np.arctanh(beta)
+    # use J(v) function from scipy to analytically estimate K matrix
+    return special.jv(dl, 2. * Bmatrix * eta)
+
+
+def solve_K_T_block(pars, m_start, m_stop, rtol=1.e-3, atol=1.e-6, mxstep=0, block_rows=2**16):
+    '''solves the kernel ODE for the rows m_start <= m < m_stop, block_rows rows at a time
+    (see solve_K_T_ODE)'''
+    return m_blocked(solve_K_T_B, pars, m_start, m_stop, block_rows=block_rows,
+                     rtol=rtol, atol=atol, mxstep=mxstep)
+
+
+def solve_K_T_B(pars, Bmatrix, rtol=1.e-3, atol=1.e-6, mxstep=0):
+    '''solves the kernel ODE for the rows with the Blm coefficients Bmatrix'''
+    beta = pars['beta']
+    delta_ell = pars['delta_ell']
+
+    height, width = Bmatrix.shape
+
+    # initialize the K0 = dirac_delta(ell,ell') (initial condition for the ODE)
+    K0 = np.zeros(width)
+    K0[delta_ell] = 1
+    K0 = np.tensordot(np.ones(height), K0, axes=0)
+
+    # (safety) pad K and B matrices to avoid leakage from the edges
+    # necessary when using odeint solver
+    # add two zeros to the end of each row
+    # FIXME: is two enough for all ell?
+    K0 = np.insert(K0, [2 * delta_ell + 1, 2 * delta_ell + 1], 0, axis=1)
+    Bmatrix = np.insert(Bmatrix, [2 * delta_ell + 1, 2 * delta_ell + 1], 0, axis=1)
+
+    # reshape all the 2D matrices to 1D arrays so that the ODE can be solved in vectorized mode
+    K0 = K0.reshape((width + 2) * height)
+    Bmatrix = Bmatrix.reshape((width + 2) * height)
+
+    # initialize the eta = np.arctanh(beta) array for ODE iterations
+    # the index (N-1) will give the final result
+    eta = np.linspace(0, np.arctanh(beta), N)
+
+    # solve the ODE for a range of ell'  between lmin=0 and lmax
+    # dK_deta is the derivative of the aberration kernel with respect to eta is defined
+    sol = odeint(dK_deta, K0, eta, args=(Bmatrix,), rtol=rtol, atol=atol, mxstep=mxstep,
+                 printmessg=True)
+
+    # TODO: try scipy.ode_inv
+    # sol = solve_ivp(dK_deta, eta, K0, args=(Bmatrix,), rtol=rtol, atol=atol, mxstep=mxstep,
+    #             printmessg=True)
+
+    # store the results in the K_T matrix
+    K_T = sol[N - 1].reshape(height, width + 2)
+
+    # remove the zero padding from the final solution
+    return np.delete(K_T, [2 * delta_ell + 1, 2 * delta_ell + 2], axis=1)
+
+
+def expm_K_T_block(pars, m_start, m_stop, tol=1.e-10, block_rows=2**16):
+    '''evaluates the kernel rows m_start <= m < m_stop with the matrix exponential of the
+    ODE generator, propagating sub-blocks of about block_rows rows (see solve_K_T_expm)'''
+    return m_blocked(expm_K_T_B, pars, m_start, m_stop, block_rows=block_rows, tol=tol)
+
+
+def expm_K_T_B(pars, Bmatrix, tol=1.e-10):
+    '''evaluates the kernel rows with the Blm coefficients Bmatrix with the matrix
+    exponential of the ODE generator'''
+    delta_ell = pars['delta_ell']
+
+    # initialize the K0 = dirac_delta(ell,ell') (initial condition)
+    K0 = np.zeros(Bmatrix.shape)
+    K0[:, delta_ell] = 1
+
+    return expm_dK_deta(K0, Bmatrix, np.arctanh(pars['beta']), tol=tol)
+
+
+# ------------------------------
+#  kernel rows for a set of rows
+# ------------------------------
+
+# kernel rows from their Blm coefficients for each method
+ROW_SOLVERS = {'Bessel': est_K_T_B,
+               'ODE'   : solve_K_T_B,
+               'expm'  : expm_K_T_B,
+               }
+
+
+def get_Bmatrix_rows(pars, indx):
+    '''returns the Blm coefficients corresponding to the kernel rows indx (array of row
+    indices, see mL2indx)'''
+    Mmatrix, Lmatrix = mh.get_ML_block(indx, pars['delta_ell'], pars['lmax'])
+    Bmatrix, _ = mh.get_Blm_Clm_matrix(Lmatrix, Mmatrix, pars['lmax'], s=pars['s'])
+
+    return Bmatrix
+
+
+def solve_K_T_rows(pars, indx, block_rows=2**16, **solver_kwargs):
+    '''evaluates only the kernel rows indx (array of row indices) with pars['method'],
+    block_rows rows at a time. Each row evolves independently, so the rows are the same as
+    the ones in the full kernel (up to the solver tolerances).'''
+    row_solver = ROW_SOLVERS[pars['method']]
+
+    K_T = np.zeros((len(indx), 2 * pars['delta_ell'] + 1))
+    for start in range(0, len(indx), block_rows):
+        rows = slice(start, min(start + block_rows, len(indx)))
+        K_T[rows] = row_solver(pars, get_Bmatrix_rows(pars, indx[rows]), **solver_kwargs)
+
+    return K_T
+
+
+def resize_K_T(pars, K_T_source, lmax_source, **solver_kwargs):
+    '''returns the kernel for pars['lmax'] using the rows of K_T_source, the kernel with the
+    same (beta, delta_ell, s) calculated for lmax_source.
+
+    Blm vanishes for ell > lmax, and the generator of the kernel ODE only couples the
+    elements of the same (m,ell') row, so a row only depends on lmax if its band reaches
+    beyond it (ell'+delta_ell > lmax). The interior rows of both kernels are copied and only
+    the edge rows and the new rows (ell' > lmax_source) are calculated.
+
+    Parameters
+    ----------
+    pars : dict
+        dictionary of the kernel parameters
+
+    K_T_source : 2D numpy array (or memory map)
+        d=1 kernel for lmax_source
+
+    lmax_source : int
+        lmax of K_T_source (smaller or larger than pars['lmax'])
+
+    solver_kwargs :
+        solver tolerances passed to solve_K_T_rows
+
+    Returns
+    -------
+    K_T : 2D numpy array
+        d=1 kernel for pars['lmax']
+    '''
+    lmax = pars['lmax']
+    delta_ell = pars['delta_ell']
+
+    indx = np.arange((lmax + 1) * (lmax + 2) // 2)
+    m, L = mh.indx2mL(indx, lmax)
+
+    interior = L + delta_ell <= min(lmax, lmax_source)
+    print("reusing {} of {} rows of the kernel with lmax = {}"
+          .format(np.count_nonzero(interior), len(indx), lmax_source))
+
+    K_T = np.zeros((len(indx), 2 * delta_ell + 1))
+    K_T[interior] = K_T_source[mh.mL2indx(m[interior], L[interior], lmax_source)]
+    K_T[~interior] = solve_K_T_rows(pars, indx[~interior], **solver_kwargs)
+
+    return K_T
+
+
+# ------------------------------
+#     full kernel solvers
+# ------------------------------
+
+def est_K_T_ODE(pars, save_kernel=True, block_rows=2**16, n_workers=1):
     '''constructs the kernel analytically using the unmarked equation on page
     10 of Dai, Chluba 2014 arXiv:1403.6117v2
 
@@ -44,6 +324,12 @@ def est_K_T_ODE(pars, save_kernel=True):
     save_kernel : bool, optional
         If True, the kernel elements will be saved to a file for later use
 
+    block_rows: int
+        approximate number of (m,ell') rows evaluated together
+
+    n_workers : int or None, optional
+        number of processes used for building the kernel (see KernelPool.build_kernel)
+
 
     Returns
     -------
@@ -55,49 +341,19 @@ def est_K_T_ODE(pars, save_kernel=True):
     '''
     # logger.info("rtol = {}\natol = {}".format(rtol, atol))
     with timeit("Analytically determining the Doppler and aberration Kernel elements"):
-        # ------------------------------
-        # set up parameters and matrices
-        # ------------------------------
-        beta = pars['beta']
-        s = pars['s']
-        delta_ell = pars['delta_ell']
-        lmax = pars['lmax']
-
-        # initialize matrices file name from input parameters
-        matrices_file_name = fh.get_matrices_filename(pars)
-
-        # if they already exist, load them from disc
-        if fh.file_exists(matrices_file_name):
-            Mmatrix = fh.load_matrix(matrices_file_name, key='M')
-            Lmatrix = fh.load_matrix(matrices_file_name, key='L')
-        else:
-            Mmatrix, Lmatrix = mh.get_ML_matrix(delta_ell=delta_ell, lmax=lmax)
-
-        # construct the Bmatrix
-        Blms, _ = mh.get_Blm_Clm(delta_ell, lmax, s=s)
-        Bmatrix = Blms[Lmatrix, Mmatrix]
-        Bmatrix[np.isnan(Bmatrix)] = 0
-
-        # construct delta_ell matrix
-        dl = np.array([np.arange(delta_ell, -delta_ell - 1, -1)] * Bmatrix.shape[0])
-        # use J(v) function from scipy to analytically estimate K matrix
-
-        eta = np.arctanh(beta)
-        #pdb.set_trace()
-        # use J(v) function from scipy to analytically estimate K matrix
-        K_T = special.jv(dl, 2. * Bmatrix * eta)
-        #K_T = analytical(dl, Bmatrix, eta)
+        K_T = kp.build_kernel(est_K_T_block, pars, n_workers=n_workers, block_rows=block_rows)
 
     # ------------------------------
     #         save to file
     # ------------------------------
     if save_kernel:
-        save_KT2file(pars, K_T)
+        save_KT2file(pars, K_T, {})
 
     return K_T
 
 
-def solve_K_T_ODE(pars, save_kernel=True, rtol=1.e-3, atol=1.e-6, mxstep=0):
+def solve_K_T_ODE(pars, save_kernel=True, rtol=1.e-3, atol=1.e-6, mxstep=0, block_rows=2**16,
+                  n_workers=1):
     '''solves the ODE to find the temperature aberration kernel elements
     uses Eq. 44 in Dai, Chluba 2014 arXiv:1403.6117v2
 
@@ -113,6 +369,13 @@ def solve_K_T_ODE(pars, save_kernel=True, rtol=1.e-3, atol=1.e-6, mxstep=0):
     rtol, atol, mxstep: scalars
         passed to scipy.odeint to set precision
 
+    block_rows: int
+        approximate number of (m,ell') rows solved together (the rows are independent, but
+        odeint chooses the steps for all the rows of a block at once)
+
+    n_workers : int or None, optional
+        number of processes used for building the kernel (see KernelPool.build_kernel)
+
     Returns
     -------
     K_T : 2D numpy array
@@ -124,98 +387,76 @@ def solve_K_T_ODE(pars, save_kernel=True, rtol=1.e-3, atol=1.e-6, mxstep=0):
     logger.info("rtol = {}\natol = {}".format(rtol, atol))
     with timeit("calculating the Doppler and aberration Kernel elements"):
 
-        # ------------------------------
-        # set up parameters and matrices
-        # ------------------------------
-        beta = pars['beta']
-        s = pars['s']
-        delta_ell = pars['delta_ell']
-        lmax = pars['lmax']
-        # lmin= pars['lmin']
+        print("beta (v/c) : ", pars['beta'])
+        print("eta (arctanh(beta)) : ", np.arctanh(pars['beta']))
 
-        # set the height and width of the aberration kernel storage matrix.
         # the storage matrix is set around each value of ell' for a neighborhood of delta_ell
         # on each side. The middle value of each row corresponds to ell'=ell or delta_ell=0
         # the number of columns corresponds to different values of ell' for each m mode.
-        height, width = ((lmax + 1) * (lmax + 2) // 2, 2 * delta_ell + 1)
-
-        # initialize the K0 = dirac_delta(ell,ell') (initial condition for the ODE)
-        K0 = np.zeros(width)
-        K0[delta_ell] = 1
-        K0 = np.tensordot(np.ones(height), K0, axes=0)
-
-        # initialize matrices file name from input parameters
-        matrices_file_name = fh.get_matrices_filename(pars)
-        # if they already exist, load them from disc
-        if fh.file_exists(matrices_file_name):
-            Mmatrix = fh.load_matrix(matrices_file_name, key='M')
-            Lmatrix = fh.load_matrix(matrices_file_name, key='L')
-        else:
-            Mmatrix, Lmatrix = mh.get_ML_matrix(delta_ell=delta_ell, lmax=lmax)
+        K_T = kp.build_kernel(solve_K_T_block, pars, n_workers=n_workers,
+                              rtol=rtol, atol=atol, mxstep=mxstep, block_rows=block_rows)
+
+    # ------------------------------
+    #         save to file
+    # ------------------------------
+    if save_kernel:
+        save_KT2file(pars, K_T, {'rtol': rtol, 'atol': atol})
+
+    return K_T
+
+
+def solve_K_T_expm(pars, save_kernel=True, tol=1.e-10, block_rows=2**16, n_workers=1):
+    '''evaluates the temperature aberration kernel elements block by block in m using the
+    action of the matrix exponential of the ODE generator (Eq. 44 in Dai, Chluba 2014
+    arXiv:1403.6117v2). For a fixed m the generator dK_deta is tridiagonal in ell, so each
+    block is propagated with banded matrix-vector products only.
 
-        # construct the Bmatrix corresponding to the elements of K0
-        Blms, _ = mh.get_Blm_Clm(delta_ell, lmax, s=s)
-        Bmatrix = Blms[Lmatrix, Mmatrix]
-        Bmatrix[np.isnan(Bmatrix)] = 0
 
-        # (safety) pad K and B matrices to avoid leakage from the edges
-        # necessary when using odeint solver
-        # add two zeros to the end of each row
-        # FIXME: is two enough for all ell?
-        K0 = np.insert(K0, [2 * delta_ell + 1, 2 * delta_ell + 1], 0, axis=1)
-        Bmatrix = np.insert(Bmatrix, [2 * delta_ell + 1, 2 * delta_ell + 1], 0, axis=1)
+    Parameters
+    ----------
+    pars : dict
+        dictionary of the kernel parameters
 
-        # reshape all the 2D matrices to 1D arrays so that the ODE can be solved in vectorized mode
-        K0 = K0.reshape((width + 2) * height)
-        Bmatrix = Bmatrix.reshape((width + 2) * height)
+    save_kernel : bool, optional
+        If True, the kernel elements will be saved to a file for later use
 
-        # ------------------------------
-        #           solve ODE
-        # ------------------------------
+    tol: scalar
+        relative tolerance of the truncated Taylor series (see expm_dK_deta)
 
-        # initialize the eta = np.arctanh(beta) array for ODE iterations
-        # the index (N-1) will give the final result
-        eta = np.linspace(0, np.arctanh(beta), N)
+    block_rows: int
+        approximate number of (m,ell') rows propagated together
 
-        print("beta (v/c) : ", beta)
-        print("eta (arctanh(beta)) : ", eta[-1])
+    n_workers : int or None, optional
+        number of processes used for building the kernel (see KernelPool.build_kernel)
 
-        # solve the ODE for a range of ell'  between lmin=0 and lmax
-        # dK_deta is the derivative of the aberration kernel with respect to eta is defined
-        sol = odeint(dK_deta, K0, eta, args=(Bmatrix,), rtol=rtol, atol=atol, mxstep=mxstep,
-                     printmessg=True)
+    Returns
+    -------
+    K_T : 2D numpy array
+        Each row corresponds to the (m,ell') index calculated with the getindx
+        scheme in the file_handler  . The rows correspond to different values of
+        ell for a neighborhood of delta_ell around ell'.
 
-        # TODO: try scipy.ode_inv
-        # sol = solve_ivp(dK_deta, eta, K0, args=(Bmatrix,), rtol=rtol, atol=atol, mxstep=mxstep,
-        #             printmessg=True)
+    '''
+    logger.info("tol = {}".format(tol))
+    with timeit("calculating the Doppler and aberration Kernel elements (expm)"):
 
-        # store the results in the K_T matrix
-        K_T = sol[N - 1].reshape(height, width + 2)
+        print("beta (v/c) : ", pars['beta'])
+        print("eta (arctanh(beta)) : ", np.arctanh(pars['beta']))
 
-        # remove the zero padding from the final solution
-        K_T = np.delete(K_T, [2 * delta_ell + 1, 2 * delta_ell + 2], axis=1)
+        K_T = kp.build_kernel(expm_K_T_block, pars, n_workers=n_workers,
+                              tol=tol, block_rows=block_rows)
 
     # ------------------------------
     #         save to file
     # ------------------------------
     if save_kernel:
-        save_KT2file(pars, K_T)
+        save_KT2file(pars, K_T, {'tol': tol})
 
     return K_T
 
 
-def save_KT2file(pars, K_T):
-    lmax = pars["lmax"]
-    beta = pars["beta"]
-
-    kernel_file_name = fh.get_kernel_filename(pars)
-    dir_name = fh.dirname(lmax=lmax, beta=beta)
-    print(f"dirname = {dir_name}")
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
-        print(f"The following directory was created to save the kernel file:\n{dir_name}")
-
-    # save the kernel to file
+def save_KT2file(pars, K_T, solver_kwargs=None):
+    # save the kernel to the default kernel cache
     # tag as D1 (Doppler weight =1)
-    fh.save_kernel(kernel_file_name, K_T, 'D1')
-    print(f"Kernel saved in:\n{kernel_file_name}")
+    store = kc.get_default_cache().put(pars, 'D1', K_T, solver_kwargs=solver_kwargs)
+    print(f"Kernel saved in:\n{store.dir_name}")
@@ -0,0 +1,104 @@
+"""
+library containing the process pool used for building the kernel elements in parallel
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from cosmoboost.lib import MatrixHandler as mh
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+# number of m-ranges assigned to each worker (for load balancing)
+CHUNKS_PER_WORKER = 4
+
+
+def balanced_m_ranges(lmax, n_parts):
+    """split the m modes into n_parts contiguous (m_start, m_stop) ranges with about the same
+    number of (m,ell') rows in each. The number of rows (lmax+1-m) shrinks as m grows, so the
+    ranges get wider at high m."""
+
+    height = (lmax + 1) * (lmax + 2) // 2
+
+    # index of the first row of each m block
+    m = np.arange(lmax + 2)
+    row_start = mh.mL2indx(m, m, lmax)
+
+    targets = np.arange(1, n_parts) * height / n_parts
+    edges = np.unique(np.concatenate(([0], np.searchsorted(row_start, targets), [lmax + 1])))
+
+    return [(int(m_start), int(m_stop)) for m_start, m_stop in zip(edges[:-1], edges[1:])]
+
+
+def _fill_slab(block_func, pars, m_start, m_stop, shm_name, shape, block_kwargs):
+    """calculate the kernel rows m_start <= m < m_stop and write them into the shared buffer"""
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        K_T = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        rows = slice(mh.mL2indx(m_start, m_start, pars['lmax']),
+                     mh.mL2indx(m_stop, m_stop, pars['lmax']))
+        K_T[rows] = block_func(pars, m_start, m_stop, **block_kwargs)
+    finally:
+        shm.close()
+
+    return m_start, m_stop
+
+
+def build_kernel(block_func, pars, n_workers=1, **block_kwargs):
+    """build the d=1 kernel elements by evaluating block_func(pars, m_start, m_stop,
+    **block_kwargs) over balanced m-ranges
+
+    Parameters
+    ----------
+    block_func: function
+        returns the kernel rows for m_start <= m < m_stop
+    pars: dict
+        dictionary of the kernel parameters
+    n_workers: int or None
+        number of worker processes. If None, all the available cores are used.
+        If 1, the whole kernel is evaluated by block_func in this process (which splits it
+        into blocks of rows, see KernelODE.m_blocked).
+
+    Returns
+    -------
+    K_T: 2D numpy array
+        kernel elements of shape ((lmax+1)*(lmax+2)/2, 2*delta_ell+1)
+    """
+    lmax = pars['lmax']
+    delta_ell = pars['delta_ell']
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers == 1:
+        return block_func(pars, 0, lmax + 1, **block_kwargs)
+
+    shape = ((lmax + 1) * (lmax + 2) // 2, 2 * delta_ell + 1)
+    m_ranges = balanced_m_ranges(lmax, n_workers * CHUNKS_PER_WORKER)
+    print("building the kernel with {} workers over {} m-ranges".format(n_workers, len(m_ranges)))
+
+    # the workers write their slabs directly into this buffer
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_fill_slab, block_func, dict(pars), m_start, m_stop,
+                                   shm.name, shape, block_kwargs)
+                       for m_start, m_stop in m_ranges]
+            for future in futures:
+                m_start, m_stop = future.result()
+                logger.info("m in [{}, {}) done".format(m_start, m_stop))
+
+        K_T = np.array(np.ndarray(shape, dtype=float, buffer=shm.buf))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return K_T
@@ -5,10 +5,11 @@ library containing recursive equations for the Doppler and aberration kernel ele
 __author__ = " Siavash Yasini"
 __email__ = "yasini@usc.edu"
 
+import threading
+import contextlib
 import numpy as np
-from . import FileHandler as fh
 from . import MatrixHandler as mh
-from scipy.misc import derivative
+from .FrequencyFunctions import FrequencyFunction
 from scipy.special import factorial, comb
 
 import logging
@@ -30,6 +31,7 @@ def get_K_d(K, d, s):
     """Calculate the Kernel of Doppler weight d, from the Doppler weight 1, using the recursive
     expressions in Yasini & Pierpaoli 2017 (http://arxiv.org/abs/1709.08298) Eq 15 & 16 and
     Dai & Chluba 2014 (http://arxiv.org/abs/1403.6117) Eqs 8 & 9
+    The result is memoized in the ladder of the kernel (K.ladder)
 
 
     Parameters
@@ -45,76 +47,206 @@ def get_K_d(K, d, s):
     -------
         ndarray((lmax+1)*(lmax+2)/2,2*delta_ell+1): K_mLl matrix with Doppler weight d"""
 
-    if d >= 1:
-        # call the recursive function directly
-        K_d_mLl = _K_d_lift(K, d, s)
-        return K_d_mLl
+    return mh.full_band(K.ladder.get_K_d(d, s))
 
-    elif d < 1:
-        # use the symmetry property of the Kernel to save calculation time
-        # convert d to positive number and use transpose of the Kernel
-        K_d_mLl = _K_d_lift(K, 2 - d, -s)
-        K_d_mlL = mh.transpose(K_d_mLl, K.delta_ell)
 
-        return mh.minus_one_LplusLp(K.delta_ell, K.lmax) * K_d_mlL
+class KernelLadder(object):
+    """In-memory ladder of the kernel elements of all the Doppler weights of a kernel
 
+    The lifts d>1 are calculated in a single upward sweep from the highest weight that is
+    already available (in memory or in the kernel cache). The coefficient matrices of each block
+    of rows are built once and shared by all the weights of the sweep. Every result is memoized
+    by (d, s), so repeated get_K_d and calc_K_d_arr (nu_mLl) calls are lookups.
 
-def _K_d_lift(K, d, s):
-    """
-    Lift the Doppler weight of the kernel by d>1 using the recursive formula in
-    Yasini & Pierpaoli 2017 (http://arxiv.org/abs/1709.08298) Eq 15 & 16
+    Usage example:
 
-    Parameters
-    ----------
-    K:  object
-        Kernel class instance
-    d:  scalar
-        Desired Doppler weight of the kernel
-    s:  scalar
-        Spin weight of the kernel
-
-    Returns
-    -------
-        K_mLl matrix with Doppler weight d
+    ladder = KernelLadder(kernel)  # kernel.ladder
 
+    K_3 = ladder.get_K_d(3, s)
+    K_d_arr = ladder.K_d_arr(3, s)  # weights 3, 2, ..., 3-beta_exp_order
     """
 
-    assert(d >= 1)
-
-    # no need to do anything if d=1
-    if d == 1:
-        return K._mLl_d1
+    def __init__(self, K):
+        self.K = K
+        self._lifts = {}  # (d, sign) -> K_mLl of the lift d>=2 (see lift_key)
+        self._K_d = {}  # (d, s) -> K_mLl
+        self._K_d_arr = {}  # (d, s) -> K_d_arr
+        self._lock = threading.RLock()
+
+    def lift_sign(self, s):
+        """returns the sign of the spin term of the lift for spin s. D1 only depends on s^2,
+        so the kernel (and its cache entry) is the same for K.s and -K.s, and the lift of spin
+        s is that of abs(K.s) with the sign of s (0 for K.s = 0, which has no spin term)"""
+        return int(np.sign(s)) if self.K.s != 0 else 0
+
+    def lift_key(self, d, s):
+        """returns the cache key of the lift d for spin s (+dN, -dN or 0dN, see lift_sign)"""
+        return sign_pref[self.lift_sign(s)]+"d{}".format(d)
+
+    def get_K_d(self, d, s):
+        """returns the kernel elements of Doppler weight d and spin s"""
+        with self._lock:
+            if (d, s) not in self._K_d:
+                self._K_d[(d, s)] = self._get_K_d(d, s)
+            return self._K_d[(d, s)]
+
+    def _get_K_d(self, d, s):
+        if d >= 1:
+            return self.lift(d, s)
 
-    elif d > 1:
-        key = sign_pref[np.sign(s)]+"d{}".format(d)
-        logger.info("key = {}".format(key))
-
-        try:
-            if K.overwrite:
-                raise LookupError("Kernel should be calculated")
-            logger.info("loading key {}".format(key))
-            K_d = fh.load_matrix(K.kernel_filename, key=key)
-        except:
-            logger.info("calculating key {}".format(key))
-
-            # start the recursive calculation
-            K_d_minusone = _K_d_lift(K, d-1, s)
-
-            # calculate K_{ell', ell+1} and C_{ell+1,m} for Kernel weight d-1
-            K_l_plusone_d_minusone = mh.shift_left(K_d_minusone)
-            C_l_plusone = mh.shift_left(K.Cmatrix)
-
-            # calculate K_{ell', ell-1} for Kernel weight d-1
-            K_l_minusone_d_minusone = mh.shift_right(K_d_minusone)
-
-            K_d = K.gamma*K_d_minusone + K.gamma*K.beta*(C_l_plusone * K_l_plusone_d_minusone
-                                                         + np.sign(s) * K.Smatrix*K_d_minusone
-                                                         + K.Cmatrix * K_l_minusone_d_minusone)
-
-            logger.info("adding key {} to kernel file".format(key))
-            fh.append_kernel(K.kernel_filename, K_d, key=key)
-
-        return K_d
+        # use the symmetry property of the Kernel to save calculation time
+        # convert d to positive number and use transpose of the Kernel
+        K_d_mLl = mh.full_band(self.lift(2 - d, -s))
+        K_d_mlL = mh.transpose(K_d_mLl, self.K.delta_ell)
+
+        return mh.minus_one_row(self.K.delta_ell) * K_d_mlL
+
+    def K_d_arr(self, d, s):
+        """returns the kernel array of the Doppler weights d to d-beta_exp_order
+        (see calc_K_d_arr)"""
+        K = self.K
+        with self._lock:
+            if (d, s) not in self._K_d_arr:
+                height, width = ((K.lmax+1)*(K.lmax+2)//2, 2*K.delta_ell+1)
+                K_d_arr = np.zeros((K.beta_exp_order+1, height, width), dtype=K.dtype)
+                for i in range(d, d-K.beta_exp_order-1, -1):
+                    logger.info("d, i = {},{}".format(d, i))
+                    # the half band D1 is rebuilt one block of rows at a time
+                    K_i = self.get_K_d(i, s)
+                    for rows in mh.row_blocks(K.lmax):
+                        K_d_arr[d2indx(d, i), rows] = K_i[rows]
+                self._K_d_arr[(d, s)] = K_d_arr
+
+            return self._K_d_arr[(d, s)]
+
+    def lift(self, d, s):
+        """
+        Lift the Doppler weight of the kernel by d>1 using the recursive formula in
+        Yasini & Pierpaoli 2017 (http://arxiv.org/abs/1709.08298) Eq 15 & 16
+
+        Parameters
+        ----------
+        d:  scalar
+            Desired Doppler weight of the kernel
+        s:  scalar
+            Spin weight of the kernel
+
+        Returns
+        -------
+            K_mLl matrix with Doppler weight d
+
+        """
+        assert(d >= 1)
+
+        K = self.K
+
+        # no need to do anything if d=1
+        if d == 1:
+            return K._mLl_d1
+
+        sign = self.lift_sign(s)
+        with self._lock:
+            if (d, sign) in self._lifts:
+                return self._lifts[(d, sign)]
+
+            start, K_start = self._highest(d, s)
+
+            if start < d:
+                with self._sweep_lock(s):
+                    # another process may have published the weights while we were waiting
+                    start, K_start = self._highest(d, s)
+                    if start < d:
+                        self._sweep(K_start, range(start+1, d+1), s)
+
+            return self._lifts[(d, sign)]
+
+    def _highest(self, d, s):
+        """returns the highest weight <= d that is already available (in memory or in the
+        kernel cache) and its kernel elements"""
+        K = self.K
+        sign = self.lift_sign(s)
+        for i in range(d, 1, -1):
+            K_i = self._lifts.get((i, sign))
+            if K_i is None:
+                K_i = K.lookup(self.lift_key(i, s))
+            if K_i is not None:
+                self._lifts[(i, sign)] = K_i
+                return i, K_i
+
+        return 1, K._mLl_d1
+
+    def _sweep_lock(self, s):
+        """returns the inter-process lock of the lifts of sign(s), so that only one process
+        sweeps the missing weights while the others wait and load them from the cache
+        (the lifts are not shared if overwrite is True or save_kernel is False)"""
+        K = self.K
+        if K.overwrite or not K.save_kernel:
+            return contextlib.nullcontext()
+        return K.store.lock(sign_pref[self.lift_sign(s)]+"lift")
+
+    def _sweep(self, K_start, weights, s):
+        """lift K_start to all the Doppler weights in weights (consecutive) in one pass over the
+        blocks of rows, and save them in the kernel cache
+        with a ragged band (K.band_tol) the rows are read from the stored kernel and only the
+        elements inside the band of each block are kept (see Kernel.widths)"""
+        K = self.K
+        logger.info("calculating keys {}".format([self.lift_key(d, s) for d in weights]))
+
+        ragged = K.band_tol is not None
+        K_d = {d: [] if ragged else np.empty(K_start.shape, dtype=K.dtype) for d in weights}
+        for rows in mh.row_blocks(K.lmax):
+            coefficients = _lift_coefficients(K, rows)
+            if ragged:
+                mask = mh.ragged_mask(rows, K.widths, K.lmax, K.delta_ell)
+
+            K_d_rows = K_start[rows]
+            for d in weights:
+                K_d_rows = _K_d_lift_block(K, K_d_rows, coefficients, self.lift_sign(s))
+                if ragged:
+                    K_d[d].append(K_d_rows[mask].astype(K.dtype))
+                else:
+                    K_d[d][rows] = K_d_rows
+
+        sign = self.lift_sign(s)
+        for d in weights:
+            K_d_stored = np.concatenate(K_d.pop(d)) if ragged else K_d.pop(d)
+            self._lifts[(d, sign)] = K.cached(self.lift_key(d, s), lambda K_d=K_d_stored: K_d,
+                                              stored=ragged)
+
+
+def _lift_coefficients(K, rows):
+    """returns the coefficient matrices of the lift (C_{ell,m}, C_{ell+1,m}, S) for the kernel
+    rows rows.start <= indx < rows.stop. They do not depend on the Doppler weight."""
+
+    # the coefficient matrices are evaluated for abs(K.s)
+    # (the sign of the spin term is set by the spin of the lift, see KernelLadder.lift_sign)
+    Mmatrix, Lmatrix = mh.get_ML_block(rows, K.delta_ell, K.lmax)
+    _, Cmatrix = mh.get_Blm_Clm_matrix(Lmatrix, Mmatrix, K.lmax, s=K.s)
+    Smatrix = mh.get_S_matrix(Lmatrix, Mmatrix, abs(K.s))
+
+    # calculate C_{ell+1,m}
+    C_l_plusone = mh.shift_left(Cmatrix)
+
+    return Cmatrix, C_l_plusone, Smatrix
+
+
+def _K_d_lift_block(K, K_d_minusone, coefficients, sign):
+    """lift the Doppler weight of a block of kernel rows by one, using Yasini & Pierpaoli 2017
+    (http://arxiv.org/abs/1709.08298) Eq 15 & 16
+    coefficients are the output of _lift_coefficients for the same rows, and sign is the sign
+    of the spin term S = s m / (ell(ell+1)), which is odd in s (see KernelLadder.lift_sign)"""
+
+    Cmatrix, C_l_plusone, Smatrix = coefficients
+
+    # calculate K_{ell', ell+1} for Kernel weight d-1
+    K_l_plusone_d_minusone = mh.shift_left(K_d_minusone)
+
+    # calculate K_{ell', ell-1} for Kernel weight d-1
+    K_l_minusone_d_minusone = mh.shift_right(K_d_minusone)
+
+    return K.gamma*K_d_minusone + K.gamma*K.beta*(C_l_plusone * K_l_plusone_d_minusone
+                                                  + sign * Smatrix*K_d_minusone
+                                                  + Cmatrix * K_l_minusone_d_minusone)
 
 
 # ------------------------------
@@ -137,62 +269,86 @@ def calc_K_d_arr(K, d, s):
     Returns
     -------
         ndarray(beta_exp_order,(lmax+1)*(lmax+2)/2,2*delta_ell+1)
+        (memoized in the ladder of the kernel)
     """
-    height, width = ((K.lmax+1)*(K.lmax+2)//2, 2*K.delta_ell+1)
-    K_d_arr = np.zeros((K.beta_exp_order+1, height, width))
-    for i in range(d, d-K.beta_exp_order-1, -1):
-        logger.info("d, i = {},{}".format(d, i))
-        K_d_arr[d2indx(d, i)] = get_K_d(K, i, s)
-    
-    return K_d_arr
+    return K.ladder.K_d_arr(d, s)
 
 
 # FIXME: change derivative_dnu to dnu
-def get_K_nu_d(K_d_arr, nu, pars, freq_func=None, return_normalize=True):
+def get_nu_weights(nu, pars, freq_func=None, return_normalize=True):
     """
-    Calculate the frequency dependent generalized Kernel by adding the K_d array with the
-    appropriate weights
+    Calculate the weights of the K_d array elements in the generalized Kernel at frequency nu
 
     Parameters
     ----------
-    K_d_arr: matrix
-        output of the calc_K_d_arr function
-    nu:     scalar
-        frequency at which the kernel is calculated
+    nu:     scalar or 1D array
+        frequencies at which the kernel is calculated
     pars: dict
         parameter dictionary
-    freq_func:  function
+    freq_func:  FrequencyFunction or function
         frequency function of the observed radiation
         library of functions can be found in FreqyencyFunctions.py
+        plain functions are differentiated with finite differences
     return_normalize: boolean
-        if True, normalizes the output to temperature units
+        if True, normalizes the weights to temperature units
 
     Returns
     -------
-    Generalized kernel elements of Doppler weight d at frequency nu
-
+        ndarray(len(nu), beta_exp_order+1) (or ndarray(beta_exp_order+1) for scalar nu)
+        weights of K_d_arr[k] at each frequency
     """
     # extract some parameters
     beta_exp_order = pars['beta_expansion_order']
     T = pars['T_0']
     dx = pars['derivative_dnu']
 
-    # calculate the weights and add the kernel matrices together
-    Kernel = 0.0
+    if not isinstance(freq_func, FrequencyFunction):
+        freq_func = FrequencyFunction(freq_func)
+
+    nu = np.asarray(nu, dtype=float)
+
+    # the n-th term of the expansion is nu^n/n! d^nF/dnu^n sum_k (-1)^(n+k) C(n,k) K_d_arr[k]
+    weights = np.zeros(nu.shape + (beta_exp_order+1,))
     for n in range(beta_exp_order+1):
-        kfactor = 0.0
+        nu_term = np.true_divide(nu**n, factorial(n)) * freq_func.derivative(nu, T, n, dnu=dx)
         for k in range(n+1):
-            KLlm = K_d_arr[k]
-            kfactor += KLlm * (-1.0)**(n+k) * comb(n, k)
-        
-        Kernel = Kernel + np.true_divide(kfactor, factorial(n))*nu**n * \
-                            derivative(freq_func, nu, dx=dx, n=n, args=(T,), order=13)
+            weights[..., k] += nu_term * (-1.0)**(n+k) * comb(n, k)
 
     if return_normalize:
-        return np.true_divide(Kernel, freq_func(nu, pars['T_0']))
+        weights = np.true_divide(weights, np.asarray(freq_func(nu, T))[..., None])
+
+    return weights
+
+
+def get_K_nu_d(K_d_arr, nu, pars, freq_func=None, return_normalize=True):
+    """
+    Calculate the frequency dependent generalized Kernel by adding the K_d array with the
+    appropriate weights
+
+    Parameters
+    ----------
+    K_d_arr: matrix
+        output of the calc_K_d_arr function
+    nu:     scalar or 1D array
+        frequencies at which the kernel is calculated
+    pars: dict
+        parameter dictionary
+    freq_func:  function
+        frequency function of the observed radiation
+        library of functions can be found in FreqyencyFunctions.py
+    return_normalize: boolean
+        if True, normalizes the output to temperature units
+
+    Returns
+    -------
+    Generalized kernel elements of Doppler weight d at frequency nu
+    (with an extra leading axis over the frequencies if nu is an array)
+
+    """
+    weights = get_nu_weights(nu, pars, freq_func=freq_func, return_normalize=return_normalize)
 
-    else:
-        return Kernel
+    # a single contraction over the Doppler weights for all the frequencies
+    return np.tensordot(weights, K_d_arr, axes=(-1, 0))
 
 
 def d2indx(d, i):
@@ -0,0 +1,124 @@
+"""
+library containing the memory-mapped kernel store (raw .npy segments indexed by a manifest)
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import os
+import json
+import numpy as np
+
+from cosmoboost.lib.FileLock import FileLock, atomic_write
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+MANIFEST_NAME = "manifest.json"
+LOCK_DIRNAME = "locks"
+
+
+def key2filename(key):
+    """returns the name of the segment file holding the kernel chosen by 'key'
+    (D1, +d2, -d3, ...)"""
+    return key.replace("+", "p").replace("-", "m") + ".npy"
+
+
+class KernelStore(object):
+    """Directory of kernel matrices stored as raw .npy segments, one per key (D1, +d2, -d3, ...)
+    The manifest (manifest.json) maps each key to its segment, shape and dtype, so a kernel is
+    looked up by key and loaded as a read-only memory map instead of being decoded and copied.
+    Segments and manifest are written to temporary files and renamed into place, so other
+    processes never see a partially written kernel.
+
+    Usage example:
+
+    store = KernelStore(dir_name)
+    store.save('D1', K_mLl)
+
+    K_mLl = store.load('D1')               # np.memmap
+    K_rows = store.load_rows('D1', rows)   # reads only the requested rows
+
+    store.export_fits(kernel_file_name)    # FITS file with one HDU per key
+    """
+
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+
+    @property
+    def manifest_filename(self):
+        return os.path.join(self.dir_name, MANIFEST_NAME)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_filename, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest):
+        text = json.dumps(manifest, indent=1, sort_keys=True)
+        atomic_write(self.manifest_filename, lambda f: f.write(text.encode()))
+
+    def lock(self, key, blocking=True):
+        """returns the inter-process lock of the kernel chosen by 'key'"""
+        lock_file_name = os.path.join(self.dir_name, LOCK_DIRNAME,
+                                      key2filename(key).replace(".npy", ".lock"))
+        return FileLock(lock_file_name, blocking=blocking)
+
+    def keys(self):
+        """returns the keys of all the kernels in the store"""
+        return list(self._read_manifest().keys())
+
+    def __contains__(self, key):
+        return key in self._read_manifest()
+
+    def filename(self, key):
+        """returns the address of the segment file of the kernel chosen by 'key'"""
+        return os.path.join(self.dir_name, key2filename(key))
+
+    def save(self, key, kernel):
+        """saves the kernel chosen by 'key' to its own segment file
+        an existing kernel with the same key is replaced"""
+
+        os.makedirs(self.dir_name, exist_ok=True)
+
+        kernel = np.ascontiguousarray(kernel)
+        atomic_write(self.filename(key), lambda f: np.save(f, kernel))
+
+        # publish the segment in the manifest (one writer at a time)
+        with FileLock(os.path.join(self.dir_name, LOCK_DIRNAME, "manifest.lock")):
+            manifest = self._read_manifest()
+            manifest[key] = {"file" : key2filename(key),
+                             "shape": list(kernel.shape),
+                             "dtype": kernel.dtype.str,
+                             }
+            self._write_manifest(manifest)
+        logger.info("key {} saved in {}".format(key, self.dir_name))
+
+    def load(self, key, mmap_mode='r'):
+        """loads the kernel chosen by 'key' as a memory map (no data is read until it is used)
+        set mmap_mode=None to read the whole kernel into memory"""
+
+        entry = self._read_manifest()[key]
+        return np.load(os.path.join(self.dir_name, entry["file"]), mmap_mode=mmap_mode)
+
+    def load_rows(self, key, rows):
+        """reads only the rows (slice or index array) of the kernel chosen by 'key'"""
+        return np.array(self.load(key)[rows])
+
+    def export_fits(self, kernel_file_name, keys=None):
+        """writes the kernels chosen by 'keys' (default: all) to a fits file with one HDU
+        per key"""
+        from astropy.io import fits
+
+        if keys is None:
+            keys = sorted(self.keys(), key=lambda key: key != "D1")
+
+        hdus = [fits.PrimaryHDU()]
+        hdus[0].name = keys[0]
+        hdus[0].data = np.array(self.load(keys[0]))
+        for key in keys[1:]:
+            hdus.append(fits.ImageHDU(data=np.array(self.load(key)), name=key))
+
+        fits.HDUList(hdus).writeto(str(kernel_file_name), overwrite=True)
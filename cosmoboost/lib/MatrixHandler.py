@@ -5,7 +5,12 @@ library containing coefficient matrices for the ODE and recursive equations
 __author__ = " Siavash Yasini"
 __email__ = "yasini@usc.edu"
 
+import functools
 import numpy as np
+import scipy.sparse as sparse
+
+# number of kernel rows processed at once by the block functions
+BLOCK_ROWS = 2**16
 
 #######################################################
 #              B,C,M,Lp,L,S matrices
@@ -42,14 +47,37 @@ def get_Blm_Clm(delta_ell, lmax,s):
 
     return Blm, Clm
 
-def get_ML_matrix(delta_ell, lmax, lmin=0):
+def get_Blm_Clm_matrix(Lmatrix, Mmatrix, lmax, s):
+    """calculate the Blm and Clm coefficients for each element of a block of the kernel matrix
+    directly from the (ell, m) index values. Returns the same values as looking up
+    get_Blm_Clm(delta_ell, lmax, s) at [Lmatrix, Mmatrix], including 0 for ell < 0 and
+    ell > lmax, without constructing the full (ell, m) grid."""
+
+    L = np.asarray(Lmatrix, dtype=float)
+    M = np.asarray(Mmatrix, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Eq. 23 in Dai, Chluba 2014 arXiv:1403.6117v2
+        Blm = np.sqrt((L**2-s**2)*np.true_divide(L**2-M**2, 4.0*L**2-1))
+        Blm[~np.isfinite(Blm) | (L < 0) | (L > lmax)] = 0
+
+        Clm = np.true_divide(Blm, L)
+        Clm[~np.isfinite(Clm)] = 0
+
+    return Blm, Clm
+
+
+def get_ML_matrix(delta_ell, lmax, lmin=0, m_start=0, m_stop=None):
     """calculate the Mmatrix and Lmatrix:
-    the Xmatrix returns the x index values for each element of the kernel matrix"""
+    the Xmatrix returns the x index values for each element of the kernel matrix
+    if provided, only the rows with m_start <= m < m_stop are returned"""
 
     width = 2*delta_ell+1
+    if m_stop is None:
+        m_stop = lmax+1
 
-    Mmatrix = np.concatenate([m*np.ones(lmax+1-max(lmin, m)) for m in range(0, lmax+1)])
-    Lpmatrix = np.concatenate([np.arange(max(lmin, m), lmax+1) for m in range(0, lmax+1)])
+    Mmatrix = np.concatenate([m*np.ones(lmax+1-max(lmin, m)) for m in range(m_start, m_stop)])
+    Lpmatrix = np.concatenate([np.arange(max(lmin, m), lmax+1) for m in range(m_start, m_stop)])
 
     Mmatrix = np.tensordot(Mmatrix, np.ones(width), axes=0)
     Lpmatrix = np.tensordot(Lpmatrix, np.ones(width), axes=0)
@@ -74,11 +102,25 @@ def get_MLpL_matrix(delta_ell, lmax, lmin=0):
     return Mmatrix.astype(int), Lpmatrix.astype(int), Lmatrix.astype(int)
 
 
+def get_ML_block(rows, delta_ell, lmax):
+    """calculate the Mmatrix and Lmatrix for the kernel rows rows.start <= indx < rows.stop
+    (or for an array of row indices) using the (m, ell') index arithmetic of mL2indx"""
+
+    indx = np.arange(rows.start, rows.stop) if isinstance(rows, slice) else np.asarray(rows)
+    m, Lp = indx2mL(indx, lmax)
+
+    Mmatrix = np.tensordot(m, np.ones(2*delta_ell+1, dtype=int), axes=0)
+    Lmatrix = Lp[:, None] + np.arange(-delta_ell, delta_ell+1)
+
+    return Mmatrix, Lmatrix
+
+
 def get_S_matrix(Lmatrix, Mmatrix, s=0):
     """calculate the Smatrix:
     the Smatrix returns the s index values for each element of the kernel matrix for polarized observables"""
     
-    Smatrix = s * np.true_divide(Mmatrix, Lmatrix*(Lmatrix+1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Smatrix = s * np.true_divide(Mmatrix, Lmatrix*(Lmatrix+1))
     Smatrix[~np.isfinite(Smatrix)] = 0
     return Smatrix
 
@@ -87,14 +129,21 @@ def get_S_matrix(Lmatrix, Mmatrix, s=0):
 #           Matrix Manipulation functions
 #######################################################
 
+def minus_one_row(delta_ell):
+    """calculates (-1)**(l+lp) for a single row of the kernel matrix"""
+
+    width = 2*delta_ell+1
+
+    parity = delta_ell % 2
+    return (-1)**np.arange(parity, width+parity)
+
+
 def minus_one_LplusLp(delta_ell, lmax):
     """calculates (-1)**(l+lp)"""
  
-    height, width = ((lmax+1)*(lmax+2)//2, 2*delta_ell+1)
+    height = (lmax+1)*(lmax+2)//2
 
-    parity = delta_ell % 2
-    row = (-1)**np.arange(parity, width+parity)
-    minus_one = np.tensordot(np.ones(height), row, axes=0)
+    minus_one = np.tensordot(np.ones(height), minus_one_row(delta_ell), axes=0)
     
     return minus_one
     
@@ -102,7 +151,7 @@ def minus_one_LplusLp(delta_ell, lmax):
 def transpose(kernel, delta_ell):
     """calculates the transpose kernel (K_mlL)"""
     
-    inv = np.zeros(kernel.shape)
+    inv = np.zeros(kernel.shape, dtype=kernel.dtype)
     for i in range(2*delta_ell+1):
         inv[:, i] = shift(kernel[:, 2*delta_ell-i], i-delta_ell)
     
@@ -190,6 +239,278 @@ def mL2indx(m, L, lmax, lmin=0):
     return m*(2*lmax+1-m)//2+L
 
 
+def indx2mL(indx, lmax):
+    """convert the row index of the kernel matrix back to (m, L)
+    inverse of mL2indx for 0 <= m <= L <= lmax"""
+
+    m = np.arange(lmax+2)
+    row_start = mL2indx(m, m, lmax)
+
+    m = np.searchsorted(row_start, indx, side='right') - 1
+    L = indx - row_start[m] + m
+
+    return m, L
+
+
+def m_sum_matrix(rows, lmax):
+    """returns the sparse (lmax+1, n_rows) matrix that averages the kernel rows
+    rows.start <= indx < rows.stop over m for each ell' (segmented reduction over the m-major
+    rows): (sum_{m=-ell'}^{ell'} K^m_{ell'})/(2ell'+1) where the m<0 rows are the same as the m>0 ones"""
+    return _m_sum_matrix(rows.start, rows.stop, lmax)
+
+
+@functools.lru_cache(maxsize=64)
+def _m_sum_matrix(start, stop, lmax):
+    m, L = indx2mL(np.arange(start, stop), lmax)
+
+    # m=0 is counted once and m>0 twice (for +m and -m)
+    weights = np.where(m == 0, 1., 2.) / (2*L+1)
+
+    # each row of the kernel (column of the matrix) contributes to a single ell'
+    return sparse.csc_matrix((weights, L, np.arange(stop-start+1)), shape=(lmax+1, stop-start))
+
+
+def band_widths(K_mLl, lmax, delta_ell, tol):
+    """returns the half-width w(ell') of the band for each ell' (array of length lmax+1):
+    the largest |ell-ell'| with |K^m_{ell' ell}| > tol for any m"""
+
+    widths = np.zeros(lmax+1, dtype=int)
+    offsets = np.abs(np.arange(-delta_ell, delta_ell+1))
+    for rows in row_blocks(lmax):
+        _, Lp = indx2mL(np.arange(rows.start, rows.stop), lmax)
+        row_widths = np.max(np.where(np.abs(K_mLl[rows]) > tol, offsets, 0), axis=1)
+        np.maximum.at(widths, Lp, row_widths)
+
+    return widths
+
+
+def ragged_mask(rows, widths, lmax, delta_ell, half=False):
+    """returns the mask of the kernel elements of the rows rows.start <= indx < rows.stop
+    that are inside the band half-widths (see band_widths)
+    if half is True, only the ell <= ell' half of the band is masked (see band2half)"""
+
+    _, Lp = indx2mL(np.arange(rows.start, rows.stop), lmax)
+    offsets = np.arange(-delta_ell, 1 if half else delta_ell+1)
+    return np.abs(offsets) <= widths[Lp][:, None]
+
+
+def band2ragged(K_mLl, widths, lmax, delta_ell):
+    """returns the kernel elements inside the band half-widths (see band_widths) as a flat
+    array. The 2w(ell')+1 elements of each row (w(ell')+1 for a half band) are stored one
+    row after the other."""
+
+    half = (K_mLl.shape[1] == delta_ell+1)
+    return np.concatenate([K_mLl[rows][ragged_mask(rows, widths, lmax, delta_ell, half)]
+                           for rows in row_blocks(lmax)])
+
+
+def ragged2band(K_ragged, widths, lmax, delta_ell, half=False):
+    """inverse of band2ragged: returns the kernel elements in the (n_rows, 2*delta_ell+1)
+    layout (or (n_rows, delta_ell+1) if half is True) with zeros outside the band
+    half-widths"""
+
+    return np.asarray(RaggedRows(K_ragged, widths, lmax, delta_ell, half=half))
+
+
+def band2half(K_mLl, delta_ell):
+    """returns the ell <= ell' half of the band (the first delta_ell+1 columns)
+    for d=1 the other half follows from K^m_{ell ell'} = (-1)^(ell+ell') K^m_{ell' ell}
+    (see half2band)"""
+
+    if isinstance(K_mLl, HalfBandRows):
+        return K_mLl.half
+
+    return np.ascontiguousarray(K_mLl[:, :delta_ell+1])
+
+
+def half2band(K_half, lmax, delta_ell, sign=1):
+    """inverse of band2half: returns the full band of a d=1 kernel with the ell > ell'
+    elements K^m_{ell' ell} = sign (-1)^(ell-ell') K^m_{ell ell'} taken from the row (m, ell)
+    (the elements with ell > lmax are zero). sign=-1 is used for the antisymmetric
+    combinations of the kernels (e.g. the EB kernel)"""
+
+    return half2band_rows(K_half, slice(0, len(K_half)), lmax, delta_ell, sign=sign)
+
+
+def half2band_rows(K_half, rows, lmax, delta_ell, sign=1):
+    """returns the rows rows.start <= indx < rows.stop of half2band(K_half, ...). Only the
+    rows of K_half up to rows.stop+delta_ell are read."""
+
+    height = (lmax+1)*(lmax+2)//2
+
+    # mL2indx is linear in ell, so the row (m, ell'+j) is j rows below (m, ell')
+    K_rows = np.asarray(K_half[rows.start:min(rows.stop+delta_ell, height)])
+    n_rows = rows.stop - rows.start
+
+    K_mLl = np.zeros((n_rows, 2*delta_ell+1), dtype=K_rows.dtype)
+    K_mLl[:, :delta_ell+1] = K_rows[:n_rows]
+
+    _, Lp = indx2mL(np.arange(rows.start, rows.stop), lmax)
+    for j in range(1, delta_ell+1):
+        n = min(n_rows, len(K_rows)-j)
+        if n <= 0:
+            break
+        inside = (Lp[:n] + j <= lmax)
+        K_mLl[:n, delta_ell+j] = np.where(inside, sign * (-1)**j * K_rows[j:j+n, delta_ell-j], 0)
+
+    return K_mLl
+
+
+class BandRows(object):
+    """read-only kernel in the (n_rows, width) layout (width = 2*delta_ell+1, or delta_ell+1
+    for half of the band) that is kept in a compact layout (see HalfBandRows and
+    RaggedRows). The rows are rebuilt when they are indexed with a slice (K[rows],
+    K[rows, cols] or K[..., rows, cols]), so only one block of rows is held with the full
+    width. np.asarray(K) (or full_band(K)) builds the whole kernel."""
+
+    def __init__(self, lmax, width, dtype):
+        self.lmax = lmax
+        self.dtype = np.dtype(dtype)
+        self.shape = ((lmax+1)*(lmax+2)//2, width)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _rows(self, rows):
+        """returns the rows rows.start <= indx < rows.stop with the full width"""
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if key and key[0] is Ellipsis:
+            key = key[1:]
+        if not 1 <= len(key) <= 2 or not isinstance(key[0], slice) or key[0].step not in (None, 1):
+            raise IndexError("the rows of {} are indexed with a slice"
+                             .format(type(self).__name__))
+
+        start, stop, _ = key[0].indices(len(self))
+        K_rows = self._rows(slice(start, max(start, stop)))
+        return K_rows if len(key) == 1 else K_rows[:, key[1]]
+
+    def __array__(self, dtype=None, copy=None):
+        K_mLl = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+        for rows in row_blocks(self.lmax):
+            K_mLl[rows] = self._rows(rows)
+        return K_mLl
+
+
+class HalfBandRows(BandRows):
+    """d=1 kernel stored as the ell <= ell' half of the band (see band2half), e.g. as a memory
+    map. The rows of the full band are rebuilt with half2band_rows.
+
+    Usage example:
+
+    K_mLl = HalfBandRows(K_half, lmax, delta_ell)
+    K_rows = K_mLl[rows]  # full band of a block of rows
+    """
+
+    def __init__(self, K_half, lmax, delta_ell, sign=1):
+        BandRows.__init__(self, lmax, 2*delta_ell+1, K_half.dtype)
+        self.half = K_half
+        self.delta_ell = delta_ell
+        self.sign = sign
+
+    def _rows(self, rows):
+        return half2band_rows(self.half, rows, self.lmax, self.delta_ell, sign=self.sign)
+
+
+class RaggedRows(BandRows):
+    """kernel stored with only the elements inside the band half-widths (see band2ragged),
+    e.g. as a memory map. The rows are rebuilt with zeros outside the band, and only the
+    elements of the requested rows are read.
+
+    Usage example:
+
+    K_mLl = RaggedRows(K_ragged, widths, lmax, delta_ell)
+    K_rows = K_mLl[rows]  # (n_rows, 2*delta_ell+1) block with zeros outside the band
+    """
+
+    def __init__(self, K_ragged, widths, lmax, delta_ell, half=False):
+        BandRows.__init__(self, lmax, delta_ell+1 if half else 2*delta_ell+1, K_ragged.dtype)
+        self.ragged = K_ragged
+        self.widths = np.asarray(widths)
+        self.delta_ell = delta_ell
+        self.half = half
+
+        # cumulative sums of the widths for the offsets of the rows (see _offset)
+        self._width_sums = np.concatenate(([0], np.cumsum(self.widths)))
+        self._m_sums = np.concatenate(([0], np.cumsum(self._width_sums[:-1])))
+
+    def _offset(self, indx):
+        """returns the position of the first element of the row indx in K_ragged
+        a row (m, ell') has 2w(ell')+1 elements (w(ell')+1 for a half band), and the rows before
+        it are all the ell'' >= m' of m' < m and the ell'' < ell' of m (see mL2indx)"""
+        if indx == len(self):
+            return len(self.ragged)
+
+        m, Lp = indx2mL(indx, self.lmax)
+        total = self._width_sums[-1]
+        widths_before = (m*total - self._m_sums[m]) + (self._width_sums[Lp] - self._width_sums[m])
+
+        return indx + (1 if self.half else 2)*widths_before
+
+    def _rows(self, rows):
+        start, stop = self._offset(rows.start), self._offset(rows.stop)
+        mask = ragged_mask(rows, self.widths, self.lmax, self.delta_ell, self.half)
+
+        K_rows = np.zeros(mask.shape, dtype=self.dtype)
+        K_rows[mask] = self.ragged[start:stop]
+        return K_rows
+
+
+def full_band(K_mLl):
+    """returns the kernel K_mLl as an array: a BandRows is rebuilt with the full band, and
+    arrays (and memory maps) are returned as they are"""
+
+    return np.asarray(K_mLl) if isinstance(K_mLl, BandRows) else K_mLl
+
+
+def band_product(K1_mLl, K2_mLl, lmax, delta_ell):
+    """returns the kernel elements of the product K1 K2 (the boost of K2 followed by K1)
+    truncated to the band |ell-ell'| <= delta_ell
+
+    the element (m, ell', ell) of the product is sum_k K1^m_{ell' k} K2^m_{k ell}. The row
+    (m, k) of K2 is k-ell' rows away from (m, ell'), since mL2indx is linear in ell. The
+    elements of K1 and of the product with ell < m or ell > lmax are set to zero."""
+
+    height = (lmax+1)*(lmax+2)//2
+    width = 2*delta_ell+1
+
+    K_mLl = np.zeros((height, width), dtype=np.result_type(K1_mLl, K2_mLl))
+    for rows in row_blocks(lmax):
+        Mmatrix, Lmatrix = get_ML_block(rows, delta_ell, lmax)
+        valid = (Lmatrix >= Mmatrix) & (Lmatrix <= lmax)
+        K1_rows = np.where(valid, K1_mLl[rows], 0)
+
+        indx = np.arange(rows.start, rows.stop)
+        for i in range(width):
+            # row (m, k = ell'-delta_ell+i) of K2
+            K2_rows = K2_mLl[np.clip(indx + i - delta_ell, 0, height-1)]
+            for j in range(max(0, i-delta_ell), min(width, i+delta_ell+1)):
+                K_mLl[rows, j] += K1_rows[:, i] * K2_rows[:, j + delta_ell - i]
+
+        K_mLl[rows] *= valid
+
+    return K_mLl
+
+
+def parity(lmax):
+    """returns (-1)^ell for each row (m, ell) of the kernel (or alm) index"""
+
+    _, L = indx2mL(np.arange((lmax+1)*(lmax+2)//2), lmax)
+    return (1 - 2*(L % 2)).astype(np.int8)
+
+
+def row_blocks(lmax, block_rows=BLOCK_ROWS):
+    """split the rows of the kernel matrix into slices of block_rows rows"""
+
+    height = (lmax+1)*(lmax+2)//2
+
+    for start in range(0, height, block_rows):
+        yield slice(start, min(start+block_rows, height))
+
+
 def getindxminmax(m, l, lmin, lmax):
     """find the min and max column indeces based on lmin and lmax """
     if m <= lmin:
@@ -0,0 +1,90 @@
+"""
+library containing the pixel space (approximate) boost of healpix maps
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+# default number of pixels remapped at a time
+CHUNK_PIXELS = 2**20
+
+
+def _import_healpy():
+    try:
+        import healpy as hp
+    except ImportError as e:
+        raise ImportError("healpy is needed for boosting maps in pixel space") from e
+    return hp
+
+
+def aberrate_cos_theta(cos_theta, beta):
+    """returns the cosine of the rest frame colatitude of the direction observed at
+    colatitude theta (the boost is along the z axis)"""
+    return (cos_theta - beta) / (1. - beta * cos_theta)
+
+
+def doppler_factor(cos_theta, beta):
+    """returns the Doppler factor D = nu_obs/nu_rest in the observed direction theta"""
+    gamma = 1. / np.sqrt(1. - beta ** 2)
+    return 1. / (gamma * (1. - beta * cos_theta))
+
+
+def doppler_weight(D, d, nu=None, freq_func=None, T_0=None, normalize=True):
+    """returns the weight of the boosted map: D^d, or D^d F(nu/D) (divided by F(nu) if
+    normalize is True) at frequency nu [GHz]. This is the sum of the beta expansion used by
+    the generalized kernel (see KernelRecursive.get_nu_weights)."""
+    weight = D ** d
+    if nu is not None:
+        weight = weight * freq_func(nu / D, T_0)
+        if normalize:
+            weight = weight / freq_func(nu, T_0)
+    return weight
+
+
+def boost_map_chunk(maps, pix, nside, beta, weight_func, nest=False):
+    """returns the boosted maps (T or (n_fields, npix)) in the pixels pix
+
+    the value at each observed direction is interpolated (bilinearly) from the rest frame
+    map at the aberrated direction and multiplied by weight_func(D)"""
+    hp = _import_healpy()
+
+    theta, phi = hp.pix2ang(nside, pix, nest=nest)
+    cos_theta = np.cos(theta)
+
+    theta_rest = np.arccos(aberrate_cos_theta(cos_theta, beta))
+    neighbors, weights = hp.get_interp_weights(nside, theta_rest, phi, nest=nest)
+
+    # only the neighboring pixels of this chunk are read from maps
+    values = np.sum(maps[..., neighbors] * weights, axis=-2)
+
+    return weight_func(doppler_factor(cos_theta, beta)) * values
+
+
+def boost_map(maps, beta, weight_func, chunk_pixels=CHUNK_PIXELS, out=None, nest=False):
+    """boost healpix maps (npix,) or (n_fields, npix) in pixel space, chunk_pixels pixels at
+    a time. The boosted maps are written to out (e.g. a memory map) if it is provided.
+
+    The polarization basis is parallel transported along the meridians, which the
+    aberration maps to themselves, so Q and U are remapped like T."""
+    hp = _import_healpy()
+
+    maps = np.asarray(maps)
+    npix = maps.shape[-1]
+    nside = hp.npix2nside(npix)
+
+    if out is None:
+        dtype = maps.dtype if np.issubdtype(maps.dtype, np.floating) else np.float64
+        out = np.empty(maps.shape, dtype=dtype)
+
+    for start in range(0, npix, chunk_pixels):
+        stop = min(start + chunk_pixels, npix)
+        out[..., start:stop] = boost_map_chunk(maps, np.arange(start, stop), nside, beta,
+                                               weight_func, nest=nest)
+        logger.info("pixels [{}, {}) done".format(start, stop))
+
+    return out
@@ -0,0 +1,228 @@
+"""
+library containing the Wigner-d rotations of alm (used for boosts in arbitrary directions)
+"""
+__author__ = " Siavash Yasini"
+__email__ = "yasini@usc.edu"
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import eigh_tridiagonal
+
+from cosmoboost.lib import MatrixHandler as mh
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARN)
+
+# memory budget [bytes] of the cached rotation matrices (see get_rotation)
+# one rotation holds sum_ell 2 (ell+1)^2 doubles (see rotation_nbytes): 0.7 GB at lmax=512,
+# 5.4 GB at lmax=1000 and 43 GB at lmax=2000
+ROTATION_MAX_BYTES = 2**30
+
+
+def direction_angles(direction):
+    """returns the colatitude and longitude (theta, phi) [radians] of direction, given either as
+    (theta, phi) or as a 3D vector (x, y, z)"""
+    direction = np.asarray(direction, dtype=float)
+
+    if direction.shape == (2,):
+        return float(direction[0]), float(direction[1])
+
+    if direction.shape == (3,):
+        x, y, z = direction / np.linalg.norm(direction)
+        return float(np.arccos(np.clip(z, -1., 1.))), float(np.arctan2(y, x))
+
+    raise ValueError("direction should be either (theta, phi) or a 3D vector (x, y, z)")
+
+
+def wigner_delta(ell):
+    """returns the matrix Delta^ell[k, m] = d^ell_{km}(pi/2) (up to the phase i^(m-k))
+    with k, m = -ell...ell (index k+ell, m+ell)
+
+    The columns are the eigenvectors of J_x (the real tridiagonal matrix with off-diagonal
+    elements sqrt((ell-m)(ell+m+1))/2), which makes them accurate at high ell where the
+    recursions in ell underflow. Their signs are fixed from the ladder relation
+    J_z Delta = Delta J_x."""
+    m = np.arange(-ell, ell + 1)
+    if ell == 0:
+        return np.ones((1, 1))
+
+    c = np.sqrt((ell - m[:-1]) * (ell + m[:-1] + 1.)) / 2.
+    _, Delta = eigh_tridiagonal(np.zeros(2 * ell + 1), c, lapack_driver='stemr')
+
+    # the last column sums to a positive number and Delta_k^T J_z Delta_{k+1} < 0
+    ladder = np.einsum('ik,ik->k', Delta[:, :-1], m[:, None] * Delta[:, 1:])
+    signs = np.append(np.cumprod(-np.sign(ladder)[::-1])[::-1], 1.)
+    signs *= np.sign(Delta[:, -1].sum())
+
+    return Delta * signs
+
+
+def wigner_d(ell, theta):
+    """returns the rows m >= 0 of the Wigner-d matrix d^ell_{m m'}(theta) with shape
+    (ell+1, 2*ell+1) (m' = -ell...ell)
+
+    d^ell(theta) = diag(i^m) Delta^T diag(exp(-i k theta)) Delta diag(i^-m)"""
+    m = np.arange(-ell, ell + 1)
+    Delta = wigner_delta(ell)
+
+    # Delta_{-k,m} = (-1)^(ell+m) Delta_{k,m}, so the sum over k < 0 doubles the k > 0 terms
+    # of cos (m+m' even) and sin (m+m' odd), which are the only ones used below
+    k = np.arange(ell + 1)
+    weight = np.where(k > 0, 2., 1.)
+    Delta = Delta[ell:]
+
+    cos = Delta[:, ell:].T @ ((weight * np.cos(k * theta))[:, None] * Delta)
+    sin = Delta[:, ell:].T @ ((weight * np.sin(k * theta))[:, None] * Delta)
+
+    # real part of i^(m-m') (cos - i sin)
+    q = np.subtract.outer(m[ell:], m) % 4
+    return np.select([q == 0, q == 1, q == 2], [cos, sin, -cos], -sin)
+
+
+def rotation_nbytes(lmax):
+    """returns the memory [bytes] of the folded Wigner-d matrices of an AlmRotation:
+    two (ell+1, ell+1) float64 matrices per ell, O(lmax^3)"""
+    ell = np.arange(lmax + 1)
+    return int(np.sum(2 * (ell + 1) ** 2 * 8))
+
+
+class AlmRotation(object):
+    """Rotation of (real field) alm by the colatitude theta about the y axis
+
+    For each ell the rows m >= 0 of d^ell(theta) are folded with the reality condition
+    a_{ell,-m} = (-1)^m a*_{ell,m} into two real (ell+1, ell+1) matrices, which act on the
+    real and imaginary parts of the healpy alm. All the alms (simulations and T, E, B fields)
+    are rotated together with one matrix product per ell.
+
+    The boost frame of the direction (theta, phi) is reached with the Euler angles
+    (0, -theta, -phi) and left with (phi, theta, 0). Rotations about the z axis are phases
+    e^{-i m phi} that commute with the boost kernel, so only d^ell(theta) is stored.
+
+    Building the matrices costs O(lmax^3) operations, and storing them O(lmax^3) memory
+    (rotation_nbytes). With store=False nothing is kept: the matrices of each ell are built
+    again every time alms are rotated, which needs O(lmax^2) memory but repeats the
+    O(lmax^3) work for every rotation.
+
+    Usage example:
+
+    rotation = get_rotation(lmax, theta)
+    alm_z = rotation.to_z(alm, phi)      # the direction (theta, phi) is the z axis of alm_z
+    alm = rotation.from_z(alm_z, phi)
+    """
+
+    def __init__(self, lmax, theta, store=True):
+        self.lmax = lmax
+        self.theta = theta
+
+        # healpy indices of the (ell, m >= 0) alm of each ell
+        self.indices = [mh.mL2indx(np.arange(ell + 1), ell, lmax) for ell in range(lmax + 1)]
+
+        self.matrices = None
+        if store:
+            logger.info("building Wigner-d matrices (lmax = {}, theta = {})".format(lmax, theta))
+            self.matrices = list(self._build())
+
+    def _build(self):
+        """yields the folded matrices of each ell (see _fold)"""
+        for ell in range(self.lmax + 1):
+            yield self._fold(ell, wigner_d(ell, self.theta))
+
+    @staticmethod
+    def _fold(ell, d_ell):
+        """returns the matrices acting on the real and imaginary parts of a_{ell, m>=0}"""
+        sign = (-1.) ** np.arange(ell + 1)
+        d_plus, d_minus = d_ell[:, ell:], d_ell[:, ell::-1] * sign
+
+        real, imag = d_plus + d_minus, d_plus - d_minus
+        real[:, 0] = d_plus[:, 0]
+        return real, imag
+
+    @property
+    def nbytes(self):
+        if self.matrices is None:
+            return 0
+        return sum(real.nbytes + imag.nbytes for real, imag in self.matrices)
+
+    def _rotate(self, alms, phase_in, phase_out):
+        """returns phase_out * d(theta) (phase_in * alms) with the phases indexed by m"""
+        alms = np.asarray(alms)
+        shape = alms.shape
+        alms = alms.reshape(-1, shape[-1])
+
+        if shape[-1] != len(phase_in):
+            raise ValueError("alm should have (lmax+1)*(lmax+2)/2 = {} elements"
+                             .format(len(phase_in)))
+
+        matrices = self._build() if self.matrices is None else self.matrices
+
+        rotated = np.empty(alms.shape, dtype=np.result_type(alms.dtype, np.complex64))
+        for (real, imag), indx in zip(matrices, self.indices):
+            alm_ell = alms[:, indx] * phase_in[indx]
+            rotated[:, indx] = (alm_ell.real @ real.T + 1j * (alm_ell.imag @ imag.T)) \
+                * phase_out[indx]
+
+        return rotated.reshape(shape)
+
+    def _phases(self, phi, sign):
+        m = mh.indx2mL(np.arange((self.lmax + 1) * (self.lmax + 2) // 2), self.lmax)[0]
+        return np.exp(sign * 1j * m * phi), (-1.) ** m
+
+    def to_z(self, alms, phi=0.):
+        """rotate alms (..., n_alm) so that the direction (theta, phi) is along the z axis
+        d(-theta) = P d(theta) P with P = diag((-1)^m)"""
+        phase, parity = self._phases(phi, 1)
+        return self._rotate(alms, parity * phase, parity)
+
+    def from_z(self, alms, phi=0.):
+        """rotate alms (..., n_alm) so that the z axis is along the direction (theta, phi)
+        (the inverse of to_z)"""
+        phase, _ = self._phases(phi, -1)
+        return self._rotate(alms, np.ones_like(phase), phase)
+
+
+class _RotationCache(object):
+    """in-memory LRU cache of AlmRotations keyed by (lmax, theta), limited to max_bytes
+    a rotation larger than max_bytes is not cached (nor stored, see AlmRotation)"""
+
+    def __init__(self, max_bytes=ROTATION_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._rotations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, lmax, theta):
+        key = (int(lmax), float(theta))
+
+        if rotation_nbytes(key[0]) > self.max_bytes:
+            logger.warning("the Wigner-d matrices of lmax = {} ({:.3g} bytes) do not fit in "
+                           "max_bytes = {:.3g}; they are built for every rotation".format(
+                               key[0], rotation_nbytes(key[0]), self.max_bytes))
+            return AlmRotation(*key, store=False)
+
+        with self._lock:
+            if key in self._rotations:
+                self._rotations.move_to_end(key)
+                return self._rotations[key]
+
+        rotation = AlmRotation(*key)
+
+        with self._lock:
+            self._rotations[key] = rotation
+            while sum(rot.nbytes for rot in self._rotations.values()) > self.max_bytes:
+                self._rotations.popitem(last=False)
+
+        return rotation
+
+    def clear(self):
+        with self._lock:
+            self._rotations.clear()
+
+
+_rotation_cache = _RotationCache()
+
+
+def get_rotation(lmax, theta):
+    """returns the (cached) AlmRotation of lmax and colatitude theta"""
+    return _rotation_cache.get(lmax, theta)
@@ -12,7 +12,6 @@ plt.rcParams['figure.dpi'] = 150
 import healpy as hp
 import cosmoboost as cb
 from tqdm import trange
-from tqdm import tqdm
 
 # read the default parameters from cosmoboost
 pars = cb.DEFAULT_PARS
@@ -49,12 +48,11 @@ Cl_TT = Cl_camb["TT"][:lmax + 1]
 if __name__ == "__main__":
 
     # simulate the rest frame alms
-    alm_T_r_arr = [hp.synalm(Cl_TT, lmax=lmax, new=True, verbose=True)
-        for _ in trange(n_sims)]
+    alm_T_r_arr = np.array([hp.synalm(Cl_TT, lmax=lmax, new=True, verbose=True)
+        for _ in trange(n_sims)])
 
-    # boost the alms
-    alm_T_b_arr = [cb.boost_alm(alm_T_r, kernel)
-                   for alm_T_r in tqdm(alm_T_r_arr, total=n_sims)]
+    # boost all the alms at once
+    alm_T_b_arr = cb.boost_alm_batch(alm_T_r_arr, kernel)
 
 
     #alms = np.array(alm_T_r_arr, alm_T_b_arr)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import MatrixHandler as mh
+
+# small kernels solved with the matrix exponential (a few seconds in total)
+LMAX = 32
+DELTA_ELL = 6
+
+
+@pytest.fixture(scope="session", autouse=True)
+def kernel_cache(tmp_path_factory):
+    """keep the kernels of the tests out of the user cache"""
+    return cb.set_default_cache(str(tmp_path_factory.mktemp("cosmoboost_cache")))
+
+
+@pytest.fixture
+def pars():
+    return dict(cb.DEFAULT_PARS, lmax=LMAX, delta_ell=DELTA_ELL, beta=0.01, method='expm')
+
+
+@pytest.fixture
+def alm():
+    """random T, E and B alm of real fields"""
+    rng = np.random.default_rng(0)
+    n_alm = (LMAX + 1) * (LMAX + 2) // 2
+    alm = rng.normal(size=(3, n_alm)) + 1j * rng.normal(size=(3, n_alm))
+    # m = 0 alm are real
+    alm[:, :LMAX + 1] = alm[:, :LMAX + 1].real
+    # no monopole and dipole in E and B
+    alm[1:, [0, 1, LMAX + 1]] = 0
+    return alm
+
+
+@pytest.fixture
+def smooth_alm(alm):
+    """alm with a red spectrum, which healpy interpolates accurately in pixel space"""
+    m, ell = mh.indx2mL(np.arange(alm.shape[-1]), LMAX)
+    return alm * np.exp(-ell / 10.)
+
+
+@pytest.fixture
+def pixel_boost():
+    """returns a function that boosts alm in pixel space (cb.boost_map) at nside"""
+    hp = pytest.importorskip("healpy")
+
+    def boost(alm, pars, nu=(), nside=256):
+        lmax = hp.Alm.getlmax(alm.shape[-1])
+        maps = hp.alm2map(alm, nside, lmax=lmax, pol=True)
+        return hp.map2alm(cb.boost_map(maps, pars, *nu), lmax=lmax, pol=True, iter=3)
+
+    return boost
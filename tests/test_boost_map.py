@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("d, nu", [(1, ()), (3, ()), (1, (217.,))])
+def test_boost_map_matches_boost_alm(pars, smooth_alm, pixel_boost, d, nu):
+    pars = dict(pars, d=d)
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+
+    boosted = cb.boost_alm(smooth_alm, cb.Kernel(pars), *nu)
+    boosted_map = pixel_boost(smooth_alm, pars, nu)
+
+    # the lifted kernels are truncated at lmax
+    ell = np.concatenate([np.arange(m, lmax + 1) for m in range(lmax + 1)])
+    low = ell <= lmax - delta_ell
+
+    # T, E and B, relative to the change of each field
+    effect = np.abs(boosted - smooth_alm)[:, low].max(axis=1)
+    error = np.abs(boosted_map - boosted)[:, low].max(axis=1)
+    assert np.all(error < 0.02 * effect)
+
+
+def test_boost_map_writes_each_frequency(pars, smooth_alm):
+    hp = pytest.importorskip("healpy")
+    maps = hp.alm2map(smooth_alm, 32, lmax=pars['lmax'], pol=True)
+    nus = np.array([100., 217.])
+
+    out = np.zeros((len(nus),) + maps.shape)
+    boosted = cb.boost_map(maps, pars, nus, out=out)
+
+    assert boosted is out
+    for i, nu in enumerate(nus):
+        assert np.array_equal(out[i], cb.boost_map(maps, pars, nu))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import MatrixHandler as mh
+
+
+def _leakage(plan, Cl, lmax):
+    """the BB spectrum of the boosted pure-E sky with spectrum Cl from the EB operator:
+    sum_m sum_ell |K_EB^m_{L ell}|^2 Cl_ell / (2L+1) (the m<0 rows are the same)"""
+    m, ell = mh.indx2mL(np.arange((lmax + 1) * (lmax + 2) // 2), lmax)
+    K_EB2 = abs(plan.as_sparse('EB')).power(2)
+    weights = np.where(m == 0, 1., 2.) / (2 * ell + 1)
+
+    return np.bincount(ell, weights * (K_EB2 @ Cl[ell]), minlength=lmax + 1)
+
+
+@pytest.mark.parametrize("nu", [(), (217.,)])
+def test_BB_picks_up_EE_leakage(pars, nu):
+    kernel = cb.Kernel(dict(pars, d=3))
+    lmax = pars['lmax']
+    ell = np.arange(lmax + 1)
+
+    Cl = np.zeros((4, lmax + 1))
+    Cl[1, 2:] = 1. / ell[2:] ** 2  # EE only
+
+    boosted = cb.boost_Cl(Cl, kernel, *nu)
+    expected = _leakage(kernel.boost_plan(*nu, polarization=True), Cl[1], lmax)
+
+    assert np.all(boosted[2, 2:] > 0)
+    assert np.allclose(boosted[2], expected, rtol=1e-10, atol=0)
+
+
+def test_no_leakage_for_d_1(pars):
+    Cl = np.ones((4, pars['lmax'] + 1))
+    Cl[2] = 0
+
+    assert not np.any(cb.Kernel(pars).transfer_matrices()['EB'])
+    assert np.all(cb.boost_Cl(Cl, cb.Kernel(pars))[2] == 0)
+
+
+def test_nu_Ll_matches_the_squared_kernel(pars):
+    # the BPTM at nu comes from the cross moments of the K_d array, not from nu_mLl
+    lmax = pars['lmax']
+    kernel = cb.Kernel(dict(pars, d=3))
+    nus = np.array([100., 217.])
+
+    m, L = mh.indx2mL(np.arange((lmax + 1) * (lmax + 2) // 2), lmax)
+    weights = np.where(m == 0, 1., 2.) / (2 * L + 1)
+
+    for nu, K_Ll in zip(nus, kernel.nu_Ll(nus)):
+        K2 = weights[:, None] * kernel.nu_mLl(nu) ** 2
+        expected = np.array([K2[L == ell].sum(axis=0) for ell in range(lmax + 1)])
+        assert np.allclose(K_Ll, expected, rtol=1e-10, atol=1e-14)
@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import cosmoboost as cb
+from cosmoboost.lib import KernelCache as kc
+
+
+def test_cache_key_is_normalized(pars):
+    assert kc.kernel_hash(dict(pars, beta=0.00123)) == kc.kernel_hash(dict(pars, beta=1.23e-3))
+    assert kc.kernel_hash(dict(pars, beta=np.float32(0.5))) == kc.kernel_hash(dict(pars, beta=0.5))
+    # the sign of s is carried by the keys of the lifts
+    assert kc.kernel_hash(dict(pars, s=-2)) == kc.kernel_hash(dict(pars, s=2))
+
+    assert kc.kernel_hash(dict(pars, lmax=33)) != kc.kernel_hash(pars)
+    assert kc.kernel_hash(pars, {'tol': 1e-8}) != kc.kernel_hash(pars, {'tol': 1e-10})
+
+
+def test_kernel_is_reused_across_spellings_of_beta(pars, tmp_path):
+    cache = cb.KernelCache(str(tmp_path))
+    K_mLl = np.array(cb.Kernel(dict(pars, beta=0.00123), cache=cache).mLl)
+    hits = cache.stats['hits']
+
+    assert np.array_equal(cb.Kernel(dict(pars, beta=1.23e-3), cache=cache).mLl, K_mLl)
+    assert cache.stats['hits'] == hits + 1
+
+
+def test_least_recently_used_entries_are_evicted(pars, tmp_path):
+    K_mLl = np.zeros((1000, 10))
+    cache = cb.KernelCache(str(tmp_path), max_bytes=2.5 * K_mLl.nbytes)
+    first, second, third = (dict(pars, beta=beta) for beta in (0.1, 0.2, 0.3))
+
+    def use(entry_pars, t):
+        # set the time of last use explicitly (the mtime resolution depends on the file system)
+        name = os.path.join(cache.entry_dirname(entry_pars), kc.LAST_USED_NAME)
+        os.utime(name, (t, t))
+
+    cache.put(first, 'D1', K_mLl)
+    use(first, 1.)
+    cache.put(second, 'D1', K_mLl)
+    use(second, 2.)
+    assert cache.get(first, 'D1') is not None
+    use(first, 3.)
+
+    cache.put(third, 'D1', K_mLl)
+
+    assert cache.get(second, 'D1') is None
+    assert cache.get(first, 'D1') is not None and cache.get(third, 'D1') is not None
+    assert cache.stats['evictions'] == 1
+    assert cache.size() <= cache.max_bytes
+
+
+def _get_or_compute(cache_dir, pars, calls_dir):
+    def compute():
+        # record the call and give the other processes time to find the kernel missing
+        open(os.path.join(calls_dir, str(os.getpid())), "w").close()
+        time.sleep(0.5)
+        return np.full((10, 3), float(os.getpid()))
+
+    K_mLl = cb.KernelCache(cache_dir).get_or_compute(pars, 'D1', compute)
+    return float(K_mLl[0, 0])
+
+
+def test_missing_kernel_is_computed_once(pars, tmp_path):
+    calls_dir = tmp_path / "calls"
+    calls_dir.mkdir()
+    args = (str(tmp_path / "cache"), pars, str(calls_dir))
+
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        results = pool.starmap(_get_or_compute, [args] * 4)
+
+    # the other processes wait for the first one and load its kernel
+    assert len(os.listdir(calls_dir)) == 1
+    assert len(set(results)) == 1
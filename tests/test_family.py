@@ -0,0 +1,21 @@
+import numpy as np
+
+import cosmoboost as cb
+
+
+def test_family_matches_direct_kernel(pars):
+    family = cb.KernelFamily(pars, beta_min=0.009, beta_max=0.011, n_nodes=8)
+    beta = 0.0101  # not a node
+    kernel = cb.Kernel(dict(pars, beta=beta))
+
+    K_mLl, error_mLl = family.mLl(beta, return_error=True)
+    K_Ll, error_Ll = family.Ll(beta, return_error=True)
+
+    # the interpolation error is far below the tolerance of the matrix exponential
+    assert np.abs(K_mLl - kernel.mLl).max() < 1e-9
+    assert np.abs(K_Ll - kernel.Ll).max() < 1e-9
+    assert np.max(error_mLl) < 1e-9 and np.max(error_Ll) < 1e-9
+
+    # the BPTM of the family kernel (d=1, s=0) boosts each spectrum like TT
+    Cl = np.ones(pars['lmax'] + 1)
+    assert np.allclose(family.boost_Cl(Cl, beta), cb.boost_Cl(Cl, kernel), rtol=1e-9, atol=0)
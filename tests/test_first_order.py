@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("d, nu, direction", [(1, None, None),
+                                              (3, None, None),
+                                              (1, 217., None),
+                                              (3, None, (0.7, 1.3)),
+                                              (1, 217., (0.7, 1.3))])
+def test_first_order_boost_matches_boost_alm(pars, alm, d, nu, direction):
+    pars = dict(pars, d=d, beta=1e-4)
+    nu_args = () if nu is None else (nu,)
+
+    boosted = cb.boost_alm(alm, cb.Kernel(pars), *nu_args, direction=direction)
+    first_order = cb.FirstOrderBoost(pars, beta=pars['beta'], direction=direction,
+                                     nu=nu).apply(alm)
+
+    # the error is second order, (beta*lmax)^2 ~ 1e-5 of the alm and ~1e-3 of the effect
+    effect = np.abs(boosted - alm).max(axis=1)
+    error = np.abs(first_order - boosted).max(axis=1)
+    assert np.all(error < 3e-3 * effect)
+
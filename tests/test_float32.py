@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("nu", [(), (217.,)])
+def test_float32_error_budget(pars, alm, tmp_path, nu):
+    # the error budget of the README: relative error of about 2e-7 of the boosted alm
+    kernel = cb.Kernel(pars)
+    kernel32 = cb.Kernel(pars, dtype=np.float32, cache=cb.KernelCache(str(tmp_path)))
+
+    boosted = cb.boost_alm(alm, kernel, *nu)
+    boosted32 = cb.boost_alm(alm, kernel32, *nu)
+    boosted32_acc = cb.boost_alm(alm, kernel32, *nu, accumulate=np.float64)
+
+    assert boosted32.dtype == np.complex64
+    scale = np.abs(boosted).max()
+    assert np.abs(boosted32 - boosted).max() < 1e-6 * scale
+    assert np.abs(boosted32_acc - boosted).max() < 1e-6 * scale
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib.FrequencyFunctions import FREQ_FUNCTIONS, FrequencyFunction
+
+
+NUS = np.array([100., 217., 353.])
+
+
+def test_array_of_nu_matches_scalar_calls(pars, alm, tmp_path):
+    kernel = cb.Kernel(dict(pars, d=3))
+
+    K_nu = kernel.nu_mLl(NUS)
+    assert K_nu.shape == (len(NUS),) + kernel.mLl.shape
+    for K, nu in zip(K_nu, NUS):
+        assert np.allclose(K, kernel.nu_mLl(nu), rtol=0, atol=1e-14)
+
+    K_Ll = kernel.nu_Ll(NUS)
+    for K, nu in zip(K_Ll, NUS):
+        assert np.allclose(K, kernel.nu_Ll(nu), rtol=0, atol=1e-14)
+
+    # the plans of all the frequencies are built together; compare them with a fresh kernel
+    fresh = cb.Kernel(dict(pars, d=3), cache=cb.KernelCache(str(tmp_path)))
+    boosted = cb.boost_alm(alm, kernel, NUS)
+    for boosted_nu, nu in zip(boosted, NUS):
+        assert np.allclose(boosted_nu, cb.boost_alm(alm, fresh, nu), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("name", ["CMB", "kSZ", "tSZ"])
+@pytest.mark.parametrize("n", [1, 2, 3])
+def test_analytic_derivatives_match_finite_differences(name, n):
+    T = cb.DEFAULT_PARS['T_0']
+    nu = np.linspace(30., 600., 58)
+    freq_func = FREQ_FUNCTIONS[name]
+    finite_differences = FrequencyFunction(freq_func.func)
+
+    analytic = freq_func.derivative(nu, T, n)
+    expected = finite_differences.derivative(nu, T, n, dnu=1.)
+
+    # tSZ crosses zero near 217 GHz, so the error is compared with the largest derivative
+    assert np.abs(analytic - expected).max() < 1e-6 * np.abs(expected).max()
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import MatrixHandler as mh
+
+
+def test_half_band_round_trip(pars, tmp_path):
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+    K_mLl = np.array(cb.Kernel(pars).mLl)
+
+    K_half = mh.band2half(K_mLl, delta_ell)
+
+    # the symmetry of the band holds to the tolerance of the matrix exponential
+    assert np.allclose(mh.half2band(K_half, lmax, delta_ell), K_mLl, rtol=0, atol=1e-10)
+
+    kernel = cb.Kernel(pars, half_band=True, cache=cb.KernelCache(str(tmp_path)))
+    assert np.allclose(np.array(kernel.mLl), K_mLl, rtol=0, atol=1e-10)
+
+    # only the memory map of the stored half is kept
+    reloaded = cb.Kernel(pars, half_band=True, cache=cb.KernelCache(str(tmp_path)))
+    assert isinstance(reloaded._mLl_d1.half, np.memmap)
+    assert reloaded._mLl_d1.half.shape == (len(K_mLl), delta_ell + 1)
+
+
+@pytest.mark.parametrize("d, nu, inverse", [(1, None, False),
+                                            (1, None, True),
+                                            (3, None, False),
+                                            (1, 217., True)])
+def test_half_band_matches_full_band(pars, alm, tmp_path, d, nu, inverse):
+    pars = dict(pars, d=d)
+    nu_args = () if nu is None else (nu,)
+    kernel = cb.Kernel(pars)
+    half = cb.Kernel(pars, half_band=True, cache=cb.KernelCache(str(tmp_path)))
+
+    assert np.allclose(half.Ll, kernel.Ll, rtol=0, atol=1e-10)
+    for key, K_Ll in kernel.transfer_matrices(nu).items():
+        assert np.allclose(half.transfer_matrices(nu)[key], K_Ll, rtol=0, atol=1e-10)
+
+    expected = cb.boost_alm(alm, kernel, *nu_args, inverse=inverse)
+    assert np.allclose(cb.boost_alm(alm, half, *nu_args, inverse=inverse), expected,
+                       rtol=0, atol=1e-10)
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+def _cache_entries(path):
+    return sorted(os.listdir(path))
+
+
+@pytest.mark.parametrize("d, nu, half_band", [(1, None, False), (1, None, True),
+                                              (3, None, False), (1, 217., False)])
+def test_inverse_is_the_kernel_of_minus_beta(pars, alm, tmp_path, d, nu, half_band):
+    # alm has E and B (s=2), which are mixed for d != 1 and at a frequency nu
+    kernel = cb.Kernel(dict(pars, d=d), half_band=half_band)
+    nus = () if nu is None else (nu,)
+    mixed = (d != 1 or nu is not None)
+    assert np.any(kernel.boost_plan(*nus, polarization=True, inverse=True).EB) == mixed
+
+    deboosted = cb.deboost_alm(alm, kernel, *nus)
+
+    # the kernel of -beta is solved in its own cache
+    kernel_minus = cb.Kernel(dict(pars, d=d, beta=-pars['beta']), half_band=half_band,
+                             cache=cb.KernelCache(str(tmp_path)))
+    boosted_minus = cb.boost_alm(alm, kernel_minus, *nus)
+
+    assert np.allclose(deboosted, boosted_minus, rtol=0, atol=1e-12 * np.abs(alm).max())
+
+
+def test_inverse_does_not_solve_again(pars, alm, tmp_path):
+    kernel = cb.Kernel(pars, cache=cb.KernelCache(str(tmp_path)))
+    cb.boost_alm(alm, kernel, 217.)
+    entries = _cache_entries(tmp_path)
+
+    cb.deboost_alm(alm, kernel, 217.)
+
+    assert _cache_entries(tmp_path) == entries
+
+
+@pytest.mark.parametrize("d", [1, 3])
+def test_deboost_boost(pars, alm, d):
+    # at a frequency nu the kernel is expanded in the Doppler weight, and the round trip is
+    # exact only up to that expansion, so it is tested with a fixed Doppler weight
+    kernel = cb.Kernel(dict(pars, d=d))
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+
+    alm_round = cb.deboost_alm(cb.boost_alm(alm, kernel), kernel)
+
+    # the band of the kernels is truncated at lmax, so the round trip is exact below
+    # lmax - 2 delta_ell only
+    ell = np.concatenate([np.arange(m, lmax + 1) for m in range(lmax + 1)])
+    low = ell <= lmax - 2 * delta_ell
+    assert np.allclose(alm_round[:, low], alm[:, low], rtol=0, atol=1e-10 * np.abs(alm).max())
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from cosmoboost.lib import KernelODE
+from cosmoboost.lib import KernelPool as kp
+
+
+def test_balanced_m_ranges_cover_all_m(pars):
+    lmax = pars['lmax']
+    m_ranges = kp.balanced_m_ranges(lmax, 8)
+
+    assert m_ranges[0][0] == 0 and m_ranges[-1][1] == lmax + 1
+    assert all(stop == start for (_, stop), (start, _) in zip(m_ranges[:-1], m_ranges[1:]))
+
+
+@pytest.mark.parametrize("block_func, exact", [(KernelODE.est_K_T_block, True),
+                                               (KernelODE.expm_K_T_block, False)])
+def test_workers_match_serial(pars, block_func, exact):
+    K_T = kp.build_kernel(block_func, pars, n_workers=1)
+    K_T_pool = kp.build_kernel(block_func, pars, n_workers=2)
+
+    if exact:
+        assert np.array_equal(K_T_pool, K_T)
+    else:
+        # the matrix exponential of each m-range is scaled by its own largest Blm
+        assert np.allclose(K_T_pool, K_T, rtol=0, atol=1e-10)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("spin, nu, inverse", [(0, None, False), (0, 217., True),
+                                               (2, None, False), (2, 217., False)])
+@pytest.mark.parametrize("kwargs", [{}, {'half_band': True}, {'band_tol': 1e-6}])
+def test_adjoint_is_the_conjugate_transpose(pars, tmp_path, spin, nu, inverse, kwargs):
+    kernel = cb.Kernel(pars, cache=cb.KernelCache(str(tmp_path)), **kwargs)
+    A = kernel.as_linear_operator(spin=spin, nu=nu, inverse=inverse)
+    n = A.shape[0]
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(n, 2)) + 1j * rng.normal(size=(n, 2))
+
+    dense = A @ np.eye(n)
+
+    assert np.allclose(A.H @ x, dense.conj().T @ x, rtol=0, atol=1e-12)
+    assert np.allclose(A.rmatvec(x[:, 0]), dense.conj().T @ x[:, 0], rtol=0, atol=1e-12)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import MatrixHandler as mh
+
+
+def test_ragged_round_trip(pars, tmp_path):
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+    K_mLl = np.array(cb.Kernel(pars).mLl)
+    band_tol = 1e-5
+
+    widths = mh.band_widths(K_mLl, lmax, delta_ell, band_tol)
+    K_ragged = mh.band2ragged(K_mLl, widths, lmax, delta_ell)
+    K_band = mh.ragged2band(K_ragged, widths, lmax, delta_ell)
+
+    assert K_ragged.size < K_mLl.size
+    assert np.abs(K_band - K_mLl).max() <= band_tol
+
+    kernel = cb.Kernel(pars, band_tol=band_tol, cache=cb.KernelCache(str(tmp_path)))
+    assert np.abs(np.array(kernel.mLl) - K_mLl).max() <= band_tol
+
+    # any block of rows is read from the stored ragged band
+    for rows in (slice(0, 7), slice(100, 181), slice(len(K_band) - 5, len(K_band))):
+        assert np.array_equal(kernel._mLl_d1[rows], K_band[rows])
+
+
+@pytest.mark.parametrize("d, nu, inverse, half_band", [(1, None, False, False),
+                                                       (3, None, True, False),
+                                                       (1, 217., False, False),
+                                                       (1, None, True, True)])
+def test_ragged_kernel_matches_full_band(pars, alm, tmp_path, d, nu, inverse, half_band):
+    pars = dict(pars, d=d)
+    nu_args = () if nu is None else (nu,)
+    kernel = cb.Kernel(pars)
+    cache = cb.KernelCache(str(tmp_path))
+    cb.Kernel(pars, band_tol=1e-6, half_band=half_band, cache=cache)
+
+    # the stored kernels are read as memory maps, not unpacked to the full band
+    ragged = cb.Kernel(pars, band_tol=1e-6, half_band=half_band, cache=cache)
+    D1 = ragged._mLl_d1.half if half_band else ragged._mLl_d1
+    assert isinstance(D1, mh.RaggedRows) and isinstance(D1.ragged, np.memmap)
+
+    # the elements outside the band are smaller than band_tol
+    assert np.allclose(ragged.Ll, kernel.Ll, rtol=0, atol=1e-5)
+
+    expected = cb.boost_alm(alm, kernel, *nu_args, inverse=inverse)
+    boosted = cb.boost_alm(alm, ragged, *nu_args, inverse=inverse)
+    assert np.abs(boosted - expected).max() < 2e-5 * np.abs(alm).max()
+
+    # plans of the stored kernels keep only the elements inside the band
+    if nu is None:
+        assert isinstance(ragged.boost_plan(inverse=inverse).T, mh.RaggedRows)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("lmax, kwargs", [(24, {}),
+                                          (40, {}),
+                                          (40, {'half_band': True, 'band_tol': 1e-6})])
+def test_resized_kernel_matches_fresh_solve(pars, tmp_path, capsys, lmax, kwargs):
+    cache = cb.KernelCache(str(tmp_path / "resized"))
+    cb.Kernel(pars, cache=cache, **kwargs)
+
+    capsys.readouterr()
+    resized = cb.Kernel(dict(pars, lmax=lmax), cache=cache, **kwargs)
+    assert "Resizing the d=1 kernel of lmax = {}".format(pars['lmax']) in capsys.readouterr().out
+
+    fresh = cb.Kernel(dict(pars, lmax=lmax), cache=cb.KernelCache(str(tmp_path / "fresh")),
+                      **kwargs)
+
+    # the rows are the same up to the tolerance of the matrix exponential
+    assert np.allclose(resized.mLl, fresh.mLl, rtol=0, atol=1e-9)
@@ -0,0 +1,32 @@
+import healpy as hp
+import numpy as np
+
+import cosmoboost as cb
+from cosmoboost.lib import Rotation
+
+
+def test_rotation_matches_healpy(alm):
+    lmax = hp.Alm.getlmax(alm.shape[-1])
+    theta, phi = 0.7, 2.1
+    rotation = Rotation.get_rotation(lmax, theta)
+
+    expected = alm[0].copy()
+    hp.rotate_alm(expected, 0., theta, phi)
+
+    assert np.allclose(rotation.from_z(alm[0], phi), expected, rtol=0, atol=1e-10)
+    assert np.allclose(rotation.to_z(expected, phi), alm[0], rtol=0, atol=1e-10)
+
+
+def test_boost_direction_matches_rotated_boost(pars, alm):
+    theta, phi = 0.7, 2.1
+    kernel = cb.Kernel(pars)
+
+    # rotate the boost frame to the z axis, boost along z and rotate back
+    alm_z = alm.copy()
+    hp.rotate_alm(alm_z, -phi, -theta, 0.)
+    expected = cb.boost_alm(alm_z, kernel)
+    hp.rotate_alm(expected, 0., theta, phi)
+
+    boosted = cb.boost_alm(alm, kernel, direction=(theta, phi))
+
+    assert np.allclose(boosted, expected, rtol=0, atol=1e-10)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import KernelODE
+
+
+def test_expm_matches_ode(pars, tmp_path):
+    # the ODE is solved with rtol=1e-3, so only that accuracy is expected
+    K_expm = np.array(cb.Kernel(pars).mLl)
+    K_ode = np.array(cb.Kernel(dict(pars, method='ODE'), cache=cb.KernelCache(str(tmp_path))).mLl)
+
+    assert np.abs(K_ode - K_expm).max() < 1e-3 * np.abs(K_expm).max()
+
+
+@pytest.mark.parametrize("solver, exact", [(KernelODE.est_K_T_ODE, True),
+                                           (KernelODE.solve_K_T_ODE, False),
+                                           (KernelODE.solve_K_T_expm, False)])
+def test_blocks_match_single_block(pars, solver, exact):
+    # the rows are solved independently, so the blocks only change the ODE steps
+    K_T = solver(pars, save_kernel=False, block_rows=10**6)
+    K_T_blocks = solver(pars, save_kernel=False, block_rows=50)
+
+    if exact:
+        assert np.array_equal(K_T_blocks, K_T)
+    else:
+        assert np.abs(K_T_blocks - K_T).max() < 1e-3 * np.abs(K_T).max()
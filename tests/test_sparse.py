@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+from cosmoboost.lib import MatrixHandler as mh
+
+
+def _gather(K_mLl, almT, lmax, delta_ell):
+    """the boost of the original implementation: a sum over the gathered alm of each row"""
+    Mmatrix, Lmatrix = mh.get_ML_matrix(delta_ell, lmax)
+    almT = np.append(almT, np.zeros(delta_ell))
+    return np.sum(K_mLl * almT[mh.mL2indx(Mmatrix, Lmatrix, lmax)], axis=1)
+
+
+@pytest.mark.parametrize("nu", [None, 217.])
+def test_csr_matches_gather(pars, alm, nu):
+    kernel = cb.Kernel(pars)
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+    K_mLl = kernel.mLl if nu is None else kernel.copy(d=3).nu_mLl(nu)
+
+    expected = _gather(np.array(K_mLl), alm[0], lmax, delta_ell)
+
+    assert np.allclose(kernel.as_sparse('T', nu=nu) @ alm[0], expected, rtol=0, atol=1e-12)
+    assert np.allclose(kernel.boost_plan(nu).apply(alm[0]), expected, rtol=0, atol=1e-12)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import cosmoboost as cb
+
+
+@pytest.mark.parametrize("d", [1, 3])
+def test_minus_s_kernel_is_the_odd_lift(pars, d, tmp_path):
+    # the kernel solved for s=-2 (in its own cache) is the lift of the s=+2 D1 with -S
+    pair = cb.Kernel(dict(pars, d=d)).spin_pair(s=2)
+    K_minus = np.array(cb.Kernel(dict(pars, s=-2, d=d), cache=cb.KernelCache(str(tmp_path))).mLl)
+
+    assert np.array_equal(np.array(pair.mLl[1]), K_minus)
+    # the spin term vanishes for d=1
+    assert np.array_equal(np.array(pair.mLl[0]), K_minus) == (d == 1)
+
+
+@pytest.mark.parametrize("d, nu", [(3, ()), (1, (217.,))])
+def test_E_to_B_matches_the_pixel_space_boost(pars, smooth_alm, pixel_boost, d, nu):
+    pars = dict(pars, d=d)
+    lmax, delta_ell = pars['lmax'], pars['delta_ell']
+    alm_E = smooth_alm.copy()
+    alm_E[0] = alm_E[2] = 0
+
+    boosted = cb.boost_alm(alm_E, cb.Kernel(pars), *nu)
+    expected = pixel_boost(alm_E, pars, nu)
+
+    # the lifted kernels are truncated at lmax
+    ell = np.concatenate([np.arange(m, lmax + 1) for m in range(lmax + 1)])
+    low = ell <= lmax - delta_ell
+
+    effect_E = np.abs(expected[1] - alm_E[1])[low].max()
+    effect_B = np.abs(expected[2])[low].max()
+    assert effect_B > 0.1 * effect_E
+    assert np.abs(boosted[1] - expected[1])[low].max() < 0.02 * effect_E
+    assert np.abs(boosted[2] - expected[2])[low].max() < 0.03 * effect_B